@@ -2,9 +2,11 @@ from fastapi import FastAPI, HTTPException, Depends, Request
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
 from sqlmodel import Session, select, col
 from typing import List
-from datetime import datetime
+from datetime import datetime, timedelta
 from models import Image, Usage
-from services import get_db, create_db_and_tables
+from services import engine, get_db, create_db_and_tables
+from metrics_buffer import MetricsBuffer
+from metrics_rollup import MetricsRollup
 import os
 import time
 import logging
@@ -30,6 +32,31 @@ app = FastAPI()
 
 API_KEY = os.getenv("API_KEY")
 
+# Request metrics, kept in memory and written to the database in bulk
+service_metrics = MetricsBuffer(
+    engine,
+    ServiceMetrics,
+    batch_size=int(os.getenv("METRICS_BATCH_SIZE", "500")),
+    flush_interval=float(os.getenv("METRICS_FLUSH_INTERVAL", "2")),  # seconds
+    max_rows=int(os.getenv("METRICS_MAX_ROWS", "10000")),
+)
+
+# Per-minute and per-hour aggregates of the request metrics of all services,
+# queried by the dashboards, and retention of the raw rows
+# Hour rollups are kept unless METRICS_HOUR_RETENTION_DAYS is set
+hour_retention_days = float(os.getenv("METRICS_HOUR_RETENTION_DAYS", "0"))
+metrics_rollup = MetricsRollup(
+    engine,
+    interval=float(os.getenv("METRICS_ROLLUP_INTERVAL", "60")),  # seconds
+    delay=float(os.getenv("METRICS_ROLLUP_DELAY", "120")),  # seconds
+    late_window=float(os.getenv("METRICS_ROLLUP_LATE_WINDOW", "900")),  # seconds
+    raw_retention=timedelta(days=float(os.getenv("METRICS_RAW_RETENTION_DAYS", "7"))),
+    minute_retention=timedelta(
+        days=float(os.getenv("METRICS_MINUTE_RETENTION_DAYS", "30"))
+    ),
+    hour_retention=timedelta(days=hour_retention_days) if hour_retention_days else None,
+)
+
 
 @app.middleware("http")
 async def validate_api_key(request: Request, call_next):
@@ -43,6 +70,15 @@ async def validate_api_key(request: Request, call_next):
 def on_startup():
     create_db_and_tables()
     logger.debug("Creating database tables...")
+    service_metrics.start()
+    metrics_rollup.start()
+
+
+@app.on_event("shutdown")
+def on_shutdown():
+    metrics_rollup.stop()
+    # Write the metrics still buffered
+    service_metrics.stop()
 
 
 @app.get("/categories")
@@ -122,23 +158,19 @@ def get_images_by_category(
 
 # Log the service metrics that will be sent to Grafana via the postgreSQL database
 def log_response_time(
-    db: Session,
     service_name: str,
     endpoint: str,
     response_time: float,
     status_code: int,
 ):
-    new_metric = ServiceMetrics(
+    # Buffered, the rows are inserted in bulk by the writer thread
+    service_metrics.add(
         service_name=service_name,
         endpoint=endpoint,
         response_time=response_time,
         status_code=status_code,
         timestamp=datetime.utcnow(),
     )
-    db.add(new_metric)
-    db.commit()
-    db.refresh(new_metric)
-    return new_metric
 
 
 @app.middleware("http")
@@ -147,17 +179,11 @@ async def log_requests(request: Request, call_next):
     response = await call_next(request)
     response_time = (time.time() - start_time) * 1000  # Convert to milliseconds
 
-    # Use a new database session for logging
-    db = next(get_db())
-    try:
-        log_response_time(
-            db=db,
-            service_name="model_api",
-            endpoint=request.url.path,
-            response_time=response_time,
-            status_code=response.status_code,
-        )
-    finally:
-        db.close()  # Ensure the database session is closed
+    log_response_time(
+        service_name="model_api",
+        endpoint=request.url.path,
+        response_time=response_time,
+        status_code=response.status_code,
+    )
 
     return response
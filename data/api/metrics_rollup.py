@@ -0,0 +1,348 @@
+import bisect
+import logging
+import math
+import threading
+from datetime import datetime, timedelta
+from typing import Dict, Optional, Tuple, Type
+
+from sqlalchemy import delete, func, insert, select, text
+from sqlalchemy.engine import Connection, Engine
+
+from models import (
+    ServiceMetrics,
+    ServiceMetricsHour,
+    ServiceMetricsMinute,
+    ServiceMetricsRollup,
+)
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds of the latency histogram buckets, in ms: 4 buckets per doubling
+# from 0.1ms to ~7min, so quantiles are within 10% of the exact ones. The last
+# bucket counts the slower requests. Changing them invalidates the rollups.
+LATENCY_BOUNDS = tuple(0.1 * 2 ** (i / 4) for i in range(88))
+
+# Status codes from which requests count as errors
+ERROR_STATUS = 500
+
+# Key of the PostgreSQL advisory lock held by the replica rolling up
+ROLLUP_LOCK_ID = 7_241_903_517
+
+
+class LatencyHistogram:
+    """
+    Response times counted by bucket of `LATENCY_BOUNDS`, along with their
+    count, sum, min and max. Histograms are merged by adding their counts,
+    which makes the quantiles of an hour computable from its minutes.
+    """
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BOUNDS) + 1)
+        self.count = 0
+        self.error_count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, response_time: float, status_code: int) -> None:
+        self.counts[bisect.bisect_left(LATENCY_BOUNDS, response_time)] += 1
+        self.count += 1
+        self.error_count += status_code >= ERROR_STATUS
+        self.sum += response_time
+        self.min = min(self.min, response_time)
+        self.max = max(self.max, response_time)
+
+    def merge(self, rollup: ServiceMetricsRollup) -> None:
+        for i, count in enumerate(rollup.histogram):
+            self.counts[i] += count
+        self.count += rollup.count
+        self.error_count += rollup.error_count
+        self.sum += rollup.response_time_sum
+        self.min = min(self.min, rollup.response_time_min)
+        self.max = max(self.max, rollup.response_time_max)
+
+    def quantile(self, q: float) -> float:
+        """
+        Interpolated linearly within the bucket of the `q` quantile, and
+        clamped to the min and max of the response times.
+        """
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = LATENCY_BOUNDS[i - 1] if i > 0 else 0.0
+                upper = LATENCY_BOUNDS[i] if i < len(LATENCY_BOUNDS) else self.max
+                value = lower + (upper - lower) * (rank - seen) / count
+                return min(max(value, self.min), self.max)
+            seen += count
+        return self.max
+
+    def row(self, bucket: datetime, service_name: str, endpoint: str) -> Dict:
+        return {
+            "bucket": bucket,
+            "service_name": service_name,
+            "endpoint": endpoint,
+            "count": self.count,
+            "error_count": self.error_count,
+            "response_time_sum": self.sum,
+            "response_time_min": self.min,
+            "response_time_max": self.max,
+            "p50": self.quantile(0.5),
+            "p90": self.quantile(0.9),
+            "p99": self.quantile(0.99),
+            "histogram": self.counts,
+        }
+
+
+def floor_minute(t: datetime) -> datetime:
+    return t.replace(second=0, microsecond=0)
+
+
+def floor_hour(t: datetime) -> datetime:
+    return t.replace(minute=0, second=0, microsecond=0)
+
+
+class MetricsRollup:
+    """
+    Aggregates the service_metrics rows into service_metrics_minute and
+    service_metrics_hour, per service and endpoint, so that dashboards query
+    a few rows per minute or hour rather than every request.
+
+    Every `interval` seconds, the minutes not rolled up yet are aggregated up
+    to `delay` seconds ago, which leaves the services time to write their
+    buffered rows, then the hours they belong to are recomputed from the
+    minutes. Rows written later than that, e.g. by a service that could not
+    reach the database for a while, are rolled up on the next run as long as
+    they are within `late_window` seconds of the last minute rolled up: the
+    minutes of that window are rolled up again when they have more raw rows
+    than rollup counts. Rolled up rows older than their retention are deleted: raw rows
+    after `raw_retention` (and never within the late window), minute rollups after `minute_retention` and hour
+    rollups after `hour_retention` (kept if None).
+
+    Every replica of the Data API runs it. On PostgreSQL, each transaction
+    first takes an advisory lock and the run stops if another replica holds
+    it. Elsewhere, the unique (bucket, service, endpoint) constraint of the
+    rollup tables makes the transaction of the slower replica fail instead
+    of duplicating the rollups.
+    """
+
+    def __init__(
+        self,
+        engine: Engine,
+        interval: float = 60.0,
+        delay: float = 120.0,
+        late_window: float = 900.0,
+        raw_retention: timedelta = timedelta(days=7),
+        minute_retention: timedelta = timedelta(days=30),
+        hour_retention: Optional[timedelta] = None,
+        chunk: timedelta = timedelta(hours=1),
+    ):
+        self.engine = engine
+        self.interval = interval
+        self.delay = timedelta(seconds=delay)
+        self.late_window = timedelta(seconds=late_window)
+        self.raw_retention = raw_retention
+        self.minute_retention = minute_retention
+        self.hour_retention = hour_retention
+        # Raw rows are aggregated `chunk` at a time, which bounds the memory
+        # and the length of the transactions when catching up
+        self.chunk = chunk
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="metrics-rollup", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        if self._thread is None:
+            return
+        self._stopping.set()
+        self._thread.join()
+        self._thread = None
+
+    def run(self, now: Optional[datetime] = None) -> Dict[str, int]:
+        """
+        Rolls up the late rows, then the minutes and hours up to `delay`
+        before `now` (default: the current UTC time), and applies the
+        retention. Returns the number of rollups written and of rows deleted.
+        """
+        now = now or datetime.utcnow()
+        end = floor_minute(now - self.delay)
+        stats = {"minute_rows": 0, "hour_rows": 0, "late_minute_rows": 0}
+        with self.engine.begin() as connection:
+            if not self._lock(connection):
+                logger.debug("Service metrics rolled up by another replica")
+                return stats
+            stats["late_minute_rows"] = self._roll_up_late_rows(connection)
+        while True:
+            with self.engine.begin() as connection:
+                if not self._lock(connection):
+                    logger.debug("Service metrics rolled up by another replica")
+                    return stats
+                start = self._next_minute(connection)
+                if start is None or start >= end:
+                    break
+                chunk_end = min(start + self.chunk, end)
+                stats["minute_rows"] += self._roll_up_minutes(
+                    connection, start, chunk_end
+                )
+                stats["hour_rows"] += self._roll_up_hours(
+                    connection, floor_hour(start), chunk_end
+                )
+        with self.engine.begin() as connection:
+            if self._lock(connection):
+                stats.update(self._apply_retention(connection, now))
+        return stats
+
+    @staticmethod
+    def _lock(connection: Connection) -> bool:
+        """Takes the rollup lock until the end of the transaction, if free."""
+        if connection.dialect.name != "postgresql":
+            return True
+        return connection.execute(
+            text("SELECT pg_try_advisory_xact_lock(:id)"), {"id": ROLLUP_LOCK_ID}
+        ).scalar()
+
+    def _next_minute(self, connection: Connection) -> Optional[datetime]:
+        """
+        Minute of the first raw row not rolled up yet, None if there is none.
+        Minutes without requests are skipped.
+        """
+        query = select(func.min(ServiceMetrics.timestamp))
+        last = connection.execute(
+            select(func.max(ServiceMetricsMinute.bucket))
+        ).scalar()
+        if last is not None:
+            query = query.where(ServiceMetrics.timestamp >= last + timedelta(minutes=1))
+        first = connection.execute(query).scalar()
+        return floor_minute(first) if first is not None else None
+
+    def _late_window_start(self, last: datetime) -> datetime:
+        return floor_minute(last + timedelta(minutes=1) - self.late_window)
+
+    def _roll_up_late_rows(self, connection: Connection) -> int:
+        """
+        Rolls up the late window again if raw rows were written there since
+        it was rolled up. Returns the number of minute rollups written.
+        """
+        last = connection.execute(
+            select(func.max(ServiceMetricsMinute.bucket))
+        ).scalar()
+        if last is None or not self.late_window:
+            return 0
+        start, end = self._late_window_start(last), last + timedelta(minutes=1)
+        raw = connection.execute(
+            select(func.count()).where(
+                ServiceMetrics.timestamp >= start, ServiceMetrics.timestamp < end
+            )
+        ).scalar()
+        rolled_up = connection.execute(
+            select(func.coalesce(func.sum(ServiceMetricsMinute.count), 0)).where(
+                ServiceMetricsMinute.bucket >= start, ServiceMetricsMinute.bucket < end
+            )
+        ).scalar()
+        # Raw rows of the window are kept, so they only outnumber the rollups if
+        # some were written late
+        if raw <= rolled_up:
+            return 0
+        logger.info(f"Rolling up {raw - rolled_up} late service metrics from {start}")
+        rows = self._roll_up_minutes(connection, start, end)
+        self._roll_up_hours(connection, floor_hour(start), end)
+        return rows
+
+    def _roll_up_minutes(
+        self, connection: Connection, start: datetime, end: datetime
+    ) -> int:
+        rows = connection.execute(
+            select(
+                ServiceMetrics.timestamp,
+                ServiceMetrics.service_name,
+                ServiceMetrics.endpoint,
+                ServiceMetrics.response_time,
+                ServiceMetrics.status_code,
+            ).where(ServiceMetrics.timestamp >= start, ServiceMetrics.timestamp < end)
+        )
+        histograms: Dict[Tuple[datetime, str, str], LatencyHistogram] = {}
+        for timestamp, service_name, endpoint, response_time, status_code in rows:
+            key = (floor_minute(timestamp), service_name, endpoint)
+            if key not in histograms:
+                histograms[key] = LatencyHistogram()
+            histograms[key].add(response_time, status_code)
+        return self._replace(connection, ServiceMetricsMinute, start, end, histograms)
+
+    def _roll_up_hours(
+        self, connection: Connection, start: datetime, end: datetime
+    ) -> int:
+        minutes = connection.execute(
+            select(ServiceMetricsMinute.__table__).where(
+                ServiceMetricsMinute.bucket >= start, ServiceMetricsMinute.bucket < end
+            )
+        )
+        histograms: Dict[Tuple[datetime, str, str], LatencyHistogram] = {}
+        for minute in minutes:
+            key = (floor_hour(minute.bucket), minute.service_name, minute.endpoint)
+            if key not in histograms:
+                histograms[key] = LatencyHistogram()
+            histograms[key].merge(minute)
+        return self._replace(connection, ServiceMetricsHour, start, end, histograms)
+
+    @staticmethod
+    def _replace(
+        connection: Connection,
+        table: Type[ServiceMetricsRollup],
+        start: datetime,
+        end: datetime,
+        histograms: Dict[Tuple[datetime, str, str], LatencyHistogram],
+    ) -> int:
+        # Replaced rather than updated, so that rolling a range up again (the
+        # current hour, or after a failure) is idempotent
+        connection.execute(
+            delete(table).where(table.bucket >= start, table.bucket < end)
+        )
+        rows = [histogram.row(*key) for key, histogram in histograms.items()]
+        if rows:
+            connection.execute(insert(table), rows)
+        return len(rows)
+
+    def _apply_retention(self, connection: Connection, now: datetime) -> Dict[str, int]:
+        # Raw rows are only deleted once rolled up, and out of the late window
+        # which may be rolled up again, i.e. before the start of that window
+        last = connection.execute(
+            select(func.max(ServiceMetricsMinute.bucket))
+        ).scalar()
+        retentions = (
+            (ServiceMetrics, self.raw_retention),
+            (ServiceMetricsMinute, self.minute_retention),
+            (ServiceMetricsHour, self.hour_retention),
+        )
+        deleted = {}
+        for table, retention in retentions:
+            if retention is None:
+                continue
+            cutoff = now - retention
+            if table is ServiceMetrics:
+                if last is None:
+                    continue
+                cutoff = min(cutoff, self._late_window_start(last))
+                column = ServiceMetrics.timestamp
+            else:
+                column = table.bucket
+            result = connection.execute(delete(table).where(column < cutoff))
+            deleted[f"{table.__tablename__}_deleted"] = result.rowcount
+        return deleted
+
+    def _run(self) -> None:
+        # Catches up on start, then every `interval` seconds
+        while True:
+            try:
+                logger.debug(f"Rolled up the service metrics: {self.run()}")
+            except Exception as e:
+                logger.error(f"Failed to roll up the service metrics: {e}")
+            if self._stopping.wait(self.interval):
+                return
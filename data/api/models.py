@@ -1,4 +1,5 @@
-from typing import Optional
+from typing import List, Optional
+from sqlalchemy import JSON, UniqueConstraint
 from sqlmodel import Field, SQLModel, Relationship
 from datetime import datetime
 
@@ -70,7 +71,36 @@ class ServiceMetrics(SQLModel, table=True):
     endpoint: str
     response_time: float
     status_code: int
-    timestamp: datetime = Field(default_factory=datetime.utcnow)
+    timestamp: datetime = Field(default_factory=datetime.utcnow, index=True)
+
+
+# Requests of one endpoint during one minute or hour. The histogram counts the
+# response times by bucket of metrics_rollup.LATENCY_BOUNDS, rollups are merged
+# by adding their histograms. One row per bucket, service and endpoint.
+class ServiceMetricsRollup(SQLModel):
+    id: int = Field(default=None, primary_key=True)
+    bucket: datetime
+    service_name: str
+    endpoint: str
+    count: int
+    error_count: int
+    response_time_sum: float
+    response_time_min: float
+    response_time_max: float
+    p50: float
+    p90: float
+    p99: float
+    histogram: List[int] = Field(sa_type=JSON)
+
+
+class ServiceMetricsMinute(ServiceMetricsRollup, table=True):
+    __tablename__ = "service_metrics_minute"
+    __table_args__ = (UniqueConstraint("bucket", "service_name", "endpoint"),)
+
+
+class ServiceMetricsHour(ServiceMetricsRollup, table=True):
+    __tablename__ = "service_metrics_hour"
+    __table_args__ = (UniqueConstraint("bucket", "service_name", "endpoint"),)
 
 
 class ModelMetrics(SQLModel, table=True):
@@ -86,4 +116,25 @@ class ModelMetrics(SQLModel, table=True):
     total_time_ms: float
     chunk_size: int
     mc_resolution: int
+    batch_size: Optional[int] = None
+    batch_wait_ms: Optional[float] = None
+    max_batch_size: Optional[int] = None
+    max_batch_wait_ms: Optional[float] = None
+    max_rays_per_batch: Optional[int] = None
+    ff_chunk_size: Optional[int] = None
+    attention_slice_size: Optional[int] = None
+    texture_baking_time_ms: Optional[float] = None
+    peak_rss_mb: Optional[float] = None
+    torch_threads: Optional[int] = None
+    torch_interop_threads: Optional[int] = None
+    timestamp: datetime = Field(default_factory=datetime.utcnow)
+
+
+class CacheMetrics(SQLModel, table=True):
+    __tablename__ = "cache_metrics"
+    id: int = Field(default=None, primary_key=True)
+    cache_name: str
+    object_name: str
+    hit: bool
+    lookup_time_ms: float
     timestamp: datetime = Field(default_factory=datetime.utcnow)
@@ -1,4 +1,5 @@
 import os
+from sqlalchemy import inspect, text
 from sqlmodel import Session, create_engine, SQLModel
 from models import (
     Image,
@@ -8,7 +9,10 @@ from models import (
     Material,
     Usage,
     ServiceMetrics,
+    ServiceMetricsMinute,
+    ServiceMetricsHour,
     ModelMetrics,
+    CacheMetrics,
 )
 
 # Database URL
@@ -18,8 +22,41 @@ NPAIR_DB_URL = os.environ.get("NPAIR_DB_URL")
 engine = create_engine(NPAIR_DB_URL)
 
 
+def add_missing_columns():
+    """
+    create_all only creates missing tables, add the columns introduced since
+    an existing table was created. New columns are nullable.
+    """
+    inspector = inspect(engine)
+    with engine.begin() as connection:
+        for table in SQLModel.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                column_type = column.type.compile(dialect=engine.dialect)
+                connection.execute(
+                    text(
+                        f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"
+                    )
+                )
+
+
+def add_missing_indexes():
+    """
+    create_all does not create the indexes added to an existing table either.
+    """
+    for table in SQLModel.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
+
+
 def create_db_and_tables():
     SQLModel.metadata.create_all(engine)
+    add_missing_columns()
+    add_missing_indexes()
 
 
 def get_db():
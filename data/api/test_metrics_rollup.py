@@ -0,0 +1,173 @@
+import random
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from sqlalchemy import func, insert, select
+from sqlalchemy.exc import IntegrityError
+from sqlmodel import SQLModel, create_engine
+
+from metrics_rollup import LatencyHistogram, MetricsRollup
+from models import ServiceMetrics, ServiceMetricsHour, ServiceMetricsMinute
+
+T0 = datetime(2026, 10, 1, 10, 0, tzinfo=timezone.utc)
+
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'metrics.db'}")
+    SQLModel.metadata.create_all(
+        engine,
+        tables=[
+            ServiceMetrics.__table__,
+            ServiceMetricsMinute.__table__,
+            ServiceMetricsHour.__table__,
+        ],
+    )
+    return engine
+
+
+def add_requests(engine, start, minutes, per_minute=20, seed=0):
+    rng = random.Random(seed)
+    rows = [
+        {
+            "service_name": "model_api",
+            "endpoint": rng.choice(["/jobs", "/generate"]),
+            "response_time": rng.lognormvariate(3, 1),
+            "status_code": 500 if i % 10 == 0 else 200,
+            "timestamp": start + timedelta(seconds=rng.uniform(0, 60 * minutes)),
+        }
+        for i in range(per_minute * minutes)
+    ]
+    with engine.begin() as connection:
+        connection.execute(insert(ServiceMetrics), rows)
+    return rows
+
+
+def total(engine, table, column="count"):
+    with engine.begin() as connection:
+        return connection.execute(select(func.sum(getattr(table, column)))).scalar()
+
+
+def test_merged_histograms_match_a_single_histogram():
+    rng = random.Random(0)
+    values = [rng.lognormvariate(3, 1) for _ in range(1000)]
+    whole, first, second = LatencyHistogram(), LatencyHistogram(), LatencyHistogram()
+    for i, value in enumerate(values):
+        whole.add(value, 200)
+        (first if i % 2 else second).add(value, 500 if i % 7 == 0 else 200)
+
+    merged = LatencyHistogram()
+    for histogram in (first, second):
+        row = histogram.row(T0, "model_api", "/jobs")
+        merged.merge(type("Rollup", (), row))
+
+    assert merged.counts == whole.counts
+    assert merged.count == 1000
+    assert merged.error_count == sum(1 for i in range(1000) if i % 7 == 0)
+    assert merged.sum == pytest.approx(whole.sum)
+    assert (merged.min, merged.max) == (min(values), max(values))
+    for q in (0.5, 0.9, 0.99):
+        assert merged.quantile(q) == pytest.approx(whole.quantile(q))
+
+
+def test_quantiles_are_within_a_bucket_of_the_exact_ones():
+    rng = random.Random(1)
+    values = sorted(rng.lognormvariate(4, 1.5) for _ in range(10000))
+    histogram = LatencyHistogram()
+    for value in values:
+        histogram.add(value, 200)
+
+    for q in (0.5, 0.9, 0.99):
+        exact = values[int(q * len(values))]
+        assert histogram.quantile(q) == pytest.approx(exact, rel=0.1)
+    # Clamped to the observed range
+    single = LatencyHistogram()
+    single.add(42.0, 200)
+    assert single.quantile(0.5) == single.quantile(0.99) == 42.0
+
+
+def test_rolling_up_again_does_not_double_count(engine):
+    rows = add_requests(engine, T0, minutes=150)
+    rollup = MetricsRollup(
+        engine, delay=0, raw_retention=None, chunk=timedelta(minutes=45)
+    )
+
+    stats = rollup.run(now=T0 + timedelta(minutes=150))
+    assert stats["minute_rows"] > 0
+    assert rollup.run(now=T0 + timedelta(minutes=150))["minute_rows"] == 0
+
+    # Rolling up a range that is already rolled up replaces its rollups
+    with engine.begin() as connection:
+        rollup._roll_up_minutes(connection, T0, T0 + timedelta(minutes=90))
+        rollup._roll_up_hours(connection, T0, T0 + timedelta(hours=2))
+
+    assert total(engine, ServiceMetricsMinute) == len(rows)
+    assert total(engine, ServiceMetricsHour) == len(rows)
+    errors = sum(row["status_code"] >= 500 for row in rows)
+    assert total(engine, ServiceMetricsHour, "error_count") == errors
+    with engine.begin() as connection:
+        hours = connection.execute(select(ServiceMetricsHour.__table__)).all()
+    assert len(hours) == 3 * 2  # 3 hours, 2 endpoints
+
+
+def test_rollups_are_unique_per_bucket_service_and_endpoint(engine):
+    add_requests(engine, T0, minutes=5)
+    MetricsRollup(engine, delay=0).run(now=T0 + timedelta(minutes=5))
+
+    with engine.begin() as connection:
+        row = connection.execute(select(ServiceMetricsMinute.__table__)).first()
+    duplicate = {k: v for k, v in row._asdict().items() if k != "id"}
+    with pytest.raises(IntegrityError):
+        with engine.begin() as connection:
+            connection.execute(insert(ServiceMetricsMinute), [duplicate])
+
+
+def test_retention_only_prunes_rolled_up_raw_rows(engine):
+    rows = add_requests(engine, T0, minutes=60)
+    now = T0 + timedelta(minutes=60)
+    rollup = MetricsRollup(
+        engine,
+        delay=20 * 60,
+        late_window=5 * 60,
+        raw_retention=timedelta(0),
+        minute_retention=timedelta(minutes=30),
+    )
+
+    rollup.run(now=now)
+
+    # Minutes from 10:40 on are too recent to be rolled up, and those from 10:35
+    # may be rolled up again with late rows: their rows are kept
+    with engine.begin() as connection:
+        kept = connection.execute(select(ServiceMetrics.timestamp)).scalars().all()
+        buckets = connection.execute(select(ServiceMetricsMinute.bucket)).scalars()
+        buckets = sorted(buckets)
+    late_window = T0 + timedelta(minutes=35)
+    assert sorted(kept) == sorted(
+        row["timestamp"] for row in rows if row["timestamp"] >= late_window
+    )
+    # Minute rollups older than their retention are deleted, hours are kept
+    assert buckets[0] == T0 + timedelta(minutes=30)
+    assert buckets[-1] == T0 + timedelta(minutes=39)
+    assert total(engine, ServiceMetricsHour) == sum(
+        row["timestamp"] < T0 + timedelta(minutes=40) for row in rows
+    )
+
+
+def test_late_rows_are_rolled_up_on_the_next_run(engine):
+    rows = add_requests(engine, T0, minutes=30)
+    rollup = MetricsRollup(engine, delay=120, late_window=10 * 60)
+    now = T0 + timedelta(minutes=32)
+    rollup.run(now=now)
+    assert total(engine, ServiceMetricsMinute) == len(rows)
+
+    # Flushed by a service after the delay, for minutes already rolled up
+    late = add_requests(engine, T0 + timedelta(minutes=25), minutes=3, seed=1)
+    # Older than the late window, not counted
+    add_requests(engine, T0 + timedelta(minutes=5), minutes=1, seed=2)
+    stats = rollup.run(now=now + timedelta(minutes=1))
+
+    assert stats["late_minute_rows"] > 0
+    assert total(engine, ServiceMetricsMinute) == len(rows) + len(late)
+    assert total(engine, ServiceMetricsHour) == len(rows) + len(late)
+    # Nothing new on the next run
+    assert rollup.run(now=now + timedelta(minutes=1))["late_minute_rows"] == 0
@@ -0,0 +1,191 @@
+import logging
+import queue
+import threading
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from datetime import datetime
+from enum import Enum
+from typing import Any, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class JobState(str, Enum):
+    QUEUED = "queued"
+    RUNNING = "running"
+    SUCCEEDED = "succeeded"
+    FAILED = "failed"
+
+
+@dataclass
+class Job:
+    job_id: str
+    params: Dict[str, Any]
+    state: JobState = JobState.QUEUED
+    result: Optional[Dict[str, Any]] = None
+    error: Optional[str] = None
+    # Stage of a running job and its completion in percent
+    progress: Optional[Dict[str, Any]] = None
+    created_at: datetime = field(default_factory=datetime.utcnow)
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+    done: threading.Event = field(default_factory=threading.Event, repr=False)
+
+    @property
+    def finished(self) -> bool:
+        return self.state in (JobState.SUCCEEDED, JobState.FAILED)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "job_id": self.job_id,
+            "state": self.state.value,
+            "result": self.result,
+            "error": self.error,
+            "progress": self.progress,
+            "created_at": self.created_at.isoformat(),
+            "started_at": self.started_at.isoformat() if self.started_at else None,
+            "finished_at": self.finished_at.isoformat() if self.finished_at else None,
+        }
+
+
+class QueueFullError(Exception):
+    def __init__(self, depth: int):
+        super().__init__(f"Job queue is full ({depth} jobs waiting)")
+        self.depth = depth
+
+
+class JobQueue:
+    """
+    Bounded queue of generation jobs drained by a pool of worker threads.
+
+    Workers share the resident engine of the process, so the pool size is the
+    number of generations that run at the same time. The handler is called
+    with the job id and the job parameters. `submit` never blocks: when
+    `max_queued` jobs are already waiting it raises `QueueFullError`.
+    `stop` fails the jobs still waiting and lets the running ones finish.
+    """
+
+    def __init__(
+        self,
+        handler: Callable[[str, Dict[str, Any]], Dict[str, Any]],
+        workers: int = 1,
+        max_queued: int = 8,
+        max_history: int = 256,
+    ):
+        self.handler = handler
+        self.workers = workers
+        self.max_history = max_history
+        self._queue: "queue.Queue[Optional[Job]]" = queue.Queue(maxsize=max_queued)
+        self._jobs: "OrderedDict[str, Job]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._threads: List[threading.Thread] = []
+        self._stopping = threading.Event()
+
+    @property
+    def depth(self) -> int:
+        return self._queue.qsize()
+
+    @property
+    def active(self) -> int:
+        """Number of jobs queued or running."""
+        with self._lock:
+            return sum(not job.finished for job in self._jobs.values())
+
+    def start(self) -> None:
+        if self._threads:
+            return
+        self._stopping.clear()
+        for i in range(self.workers):
+            thread = threading.Thread(
+                target=self._work, name=f"job-worker-{i}", daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+        logger.debug(f"Started {self.workers} job workers")
+
+    def stop(self) -> None:
+        with self._lock:
+            self._stopping.set()
+            # Empty the queue first, a full queue would block the sentinels
+            while True:
+                try:
+                    job = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                self._queue.task_done()
+                if job is not None:
+                    job.error = "Job queue stopped"
+                    job.state = JobState.FAILED
+                    job.finished_at = datetime.utcnow()
+                    job.done.set()
+        # Nothing is submitted any more, the workers take the sentinels
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def submit(self, params: Dict[str, Any]) -> Job:
+        job = Job(job_id=uuid.uuid4().hex, params=params)
+        with self._lock:
+            if self._stopping.is_set():
+                raise QueueFullError(self.depth)
+            try:
+                self._queue.put_nowait(job)
+            except queue.Full:
+                raise QueueFullError(self.depth)
+            self._jobs[job.job_id] = job
+            self._prune()
+        logger.debug(f"Job {job.job_id} queued, depth: {self.depth}")
+        return job
+
+    def complete(self, params: Dict[str, Any], result: Dict[str, Any]) -> Job:
+        """Registers a job that is already finished, without queueing it."""
+        job = Job(job_id=uuid.uuid4().hex, params=params)
+        job.result = result
+        job.state = JobState.SUCCEEDED
+        job.started_at = job.finished_at = datetime.utcnow()
+        job.done.set()
+        with self._lock:
+            self._jobs[job.job_id] = job
+            self._prune()
+        return job
+
+    def report_progress(self, job_id: str, stage: str, percent: float) -> None:
+        """Records the progress of a running job, reported by its handler."""
+        job = self.get(job_id)
+        if job is not None:
+            job.progress = {"stage": stage, "percent": percent}
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def _prune(self) -> None:
+        # Forget the oldest finished jobs once the history is full
+        for job_id in list(self._jobs):
+            if len(self._jobs) <= self.max_history:
+                break
+            if self._jobs[job_id].finished:
+                del self._jobs[job_id]
+
+    def _work(self) -> None:
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            job.state = JobState.RUNNING
+            job.started_at = datetime.utcnow()
+            logger.debug(f"Job {job.job_id} started")
+            try:
+                job.result = self.handler(job.job_id, job.params)
+                job.state = JobState.SUCCEEDED
+            except Exception as e:
+                logger.error(f"Job {job.job_id} failed: {e}")
+                job.error = str(e)
+                job.state = JobState.FAILED
+            finally:
+                job.finished_at = datetime.utcnow()
+                job.done.set()
+                self._queue.task_done()
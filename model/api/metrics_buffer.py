@@ -0,0 +1,117 @@
+import logging
+import threading
+from collections import deque
+from typing import Any, Dict, Type
+
+from sqlalchemy import insert
+from sqlalchemy.engine import Engine
+from sqlmodel import SQLModel
+
+logger = logging.getLogger(__name__)
+
+
+class MetricsBuffer:
+    """
+    Rows of a metrics table buffered in memory and inserted in bulk by a
+    background thread, so that requests never wait on the database.
+
+    `add` only appends to the buffer. The writer thread inserts the buffered
+    rows with a single multi-row insert once `batch_size` rows are waiting or
+    `flush_interval` seconds after the previous flush. At most `max_rows`
+    rows are kept: further rows are dropped and counted, as are the rows of
+    inserts that fail.
+    """
+
+    def __init__(
+        self,
+        engine: Engine,
+        table: Type[SQLModel],
+        batch_size: int = 500,
+        flush_interval: float = 2.0,
+        max_rows: int = 10000,
+    ):
+        self.engine = engine
+        self.table = table.__table__
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_rows = max_rows
+        self._rows: deque = deque()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopping = False
+        self._thread = None
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+
+    def add(self, **row: Any) -> None:
+        with self._lock:
+            if len(self._rows) >= self.max_rows:
+                self.dropped += 1
+                return
+            self._rows.append(row)
+            if len(self._rows) >= self.batch_size:
+                self._wake.set()
+
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+        self._stopping = False
+        self._thread = threading.Thread(
+            target=self._run, name=f"{self.table.name}-writer", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stops the writer thread once the buffered rows are inserted."""
+        if self._thread is None:
+            return
+        self._stopping = True
+        self._wake.set()
+        self._thread.join()
+        self._thread = None
+
+    def flush(self) -> int:
+        """Inserts the buffered rows, returns the number of rows written."""
+        written = 0
+        while True:
+            with self._lock:
+                rows = [
+                    self._rows.popleft()
+                    for _ in range(min(self.batch_size, len(self._rows)))
+                ]
+            if not rows:
+                return written
+            try:
+                with self.engine.begin() as connection:
+                    connection.execute(insert(self.table), rows)
+            except Exception as e:
+                self.failed += len(rows)
+                logger.error(f"Failed to write {len(rows)} {self.table.name} rows: {e}")
+                continue
+            self.written += len(rows)
+            written += len(rows)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            buffered = len(self._rows)
+        return {
+            "buffered": buffered,
+            "written": self.written,
+            "dropped": self.dropped,
+            "failed": self.failed,
+        }
+
+    def _run(self) -> None:
+        dropped = 0
+        while not self._stopping:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+            if self.dropped > dropped:
+                logger.warning(
+                    f"Dropped {self.dropped - dropped} {self.table.name} rows, "
+                    f"the buffer is full ({self.max_rows} rows)"
+                )
+                dropped = self.dropped
+        self.flush()
@@ -1,15 +1,29 @@
 from fastapi import FastAPI, HTTPException, Request, WebSocket, WebSocketDisconnect
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
 from sqlmodel import SQLModel, Field, Session
 import os
+import asyncio
+import json
+import threading
+import sys
 import shutil
-import subprocess
 import logging
 import time
-from glob import glob
-from services import get_db
-from models import ServiceMetrics, ModelMetrics
+from typing import Optional
+from services import engine as db_engine, get_db
+from metrics_buffer import MetricsBuffer
+from models import ServiceMetrics, ModelMetrics, CacheMetrics
+from jobs import Job, JobQueue, JobState, QueueFullError
+from result_cache import ResultCache, link_or_copy
 from datetime import datetime
 
+# The TripoSR sources live next to this file and are imported as the `tsr` package
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "triposr"))
+from tsr.engine import TSREngine
+from tsr.instrumentation import generation_metrics
+from tsr.memory_budget import MemorySettings
+
 # Create logs directory if it doesn't exist
 os.makedirs("/app/logs", exist_ok=True)
 
@@ -33,14 +47,317 @@ async def validate_api_key(request: Request, call_next):
     return await call_next(request)
 
 
+IMAGES_DIR = "/data/storage/images"
 OBJECTS_DIR = "/data/storage/objects"
 RENDERS_DIR = "/data/storage/renders"
+# Per-job scratch directories, on the same volume so results can be renamed into place
+SCRATCH_DIR = "/data/storage/tmp"
 
+MODEL_DEVICE = os.getenv("MODEL_DEVICE", "cuda:0")
+# fp32, bf16 or int8 (CPU only) for the image tokenizer and the backbone
+MODEL_PRECISION = os.getenv("MODEL_PRECISION", "fp32")
+# Compile the triplane query at startup, kept only where it beats eager mode
+MODEL_COMPILE_QUERY = os.getenv("MODEL_COMPILE_QUERY", "1") == "1"
+# Cache scene codes, as float16, so already seen images skip the backbone
+MODEL_SCENE_CACHE = os.getenv("MODEL_SCENE_CACHE", "1") == "1"
+CHUNK_SIZE = 14336  # default: 8192
+MC_RESOLUTION = 256  # default: 256
+FOREGROUND_RATIO = 0.85  # default: 0.85
+SKIP_EMPTY_SPACE = True  # default: True
+COARSE_TO_FINE = True  # default: True
+STREAMING_MESH = True  # default: True
+# Everything besides the image that changes the generated files, part of the cache key.
+# The chunk size and the other memory settings only change how the work is split.
+GENERATION_PARAMETERS = {
+    "mc_resolution": MC_RESOLUTION,
+    "bake_texture": False,
+    "foreground_ratio": FOREGROUND_RATIO,
+    "precision": MODEL_PRECISION,
+    "scene_cache": MODEL_SCENE_CACHE,
+    "skip_empty_space": SKIP_EMPTY_SPACE,
+    "coarse_to_fine": COARSE_TO_FINE,
+    "streaming_mesh": STREAMING_MESH,
+}
 
-@app.post("/generate")
-async def generate_3d_model(model_parameters: dict):
-    chunk_size = "14336"  # defaul: 8192
-    mc_resolution = "256"  # default: 256
+# Scene codes of already seen images, reused when only meshing or rendering changes
+SCENE_CACHE_DIR = "/data/storage/cache/scene_codes"
+# Preprocessed inputs (background removed, foreground resized, 512px) of the image library
+PREPARED_DIR = "/data/storage/prepared"
+PREPARE_IMAGES_ON_STARTUP = os.getenv("PREPARE_IMAGES_ON_STARTUP", "1") == "1"
+
+# Content-addressed store of generated objects, bounded in size
+RESULT_CACHE_DIR = "/data/storage/cache/results"
+RESULT_CACHE_MAX_BYTES = int(os.getenv("RESULT_CACHE_MAX_BYTES", str(2 * 1024**3)))
+
+# Number of concurrent generations and of jobs allowed to wait for a worker
+MODEL_WORKERS = int(os.getenv("MODEL_WORKERS", "1"))
+MODEL_QUEUE_SIZE = int(os.getenv("MODEL_QUEUE_SIZE", "8"))
+# Images encoded within the batching window of each other share one forward pass,
+# batches only fill up when several workers run at the same time
+MODEL_MAX_BATCH_SIZE = int(os.getenv("MODEL_MAX_BATCH_SIZE", str(MODEL_WORKERS)))
+MODEL_MAX_BATCH_WAIT_MS = float(os.getenv("MODEL_MAX_BATCH_WAIT_MS", "50"))
+JOB_POLL_INTERVAL = 0.5  # seconds
+JOB_KEEPALIVE_INTERVAL = 15  # seconds
+
+# Memory bounds of a generation (query chunk, rays per render call, feed-forward
+# chunk, attention heads per call), selected from the memory left in the container
+# for MODEL_WORKERS generations, or fixed by the variables below with MODEL_AUTO_MEMORY=0
+MODEL_AUTO_MEMORY = os.getenv("MODEL_AUTO_MEMORY", "1") == "1"
+MODEL_MAX_RAYS_PER_BATCH = int(os.getenv("MODEL_MAX_RAYS_PER_BATCH", "65536"))
+MODEL_FF_CHUNK_SIZE = int(os.getenv("MODEL_FF_CHUNK_SIZE", "0")) or None
+MODEL_ATTENTION_SLICE_SIZE = int(os.getenv("MODEL_ATTENTION_SLICE_SIZE", "0")) or None
+# Replace the query chunk size by the fastest one on this host within the memory bounds,
+# benchmarked once per host type (results shared with other replicas through the volume)
+MODEL_TUNE_CHUNK_SIZE = os.getenv("MODEL_TUNE_CHUNK_SIZE", "1") == "1"
+CHUNK_TUNING_DIR = "/data/storage/cache/chunk_tuning"
+
+# TripoSR engine, loaded once and reused by every request
+engine: Optional[TSREngine] = None
+
+
+def get_engine() -> TSREngine:
+    global engine
+    if engine is None:
+        engine = TSREngine(
+            device=MODEL_DEVICE,
+            chunk_size=CHUNK_SIZE,
+            scene_cache=MODEL_SCENE_CACHE,
+            scene_cache_dir=SCENE_CACHE_DIR,
+            prepared_dir=PREPARED_DIR,
+            max_batch_size=MODEL_MAX_BATCH_SIZE,
+            max_batch_wait_ms=MODEL_MAX_BATCH_WAIT_MS,
+            precision=MODEL_PRECISION,
+            compile_query=MODEL_COMPILE_QUERY,
+            memory_settings=MemorySettings(
+                CHUNK_SIZE,
+                MODEL_MAX_RAYS_PER_BATCH,
+                MODEL_FF_CHUNK_SIZE,
+                MODEL_ATTENTION_SLICE_SIZE,
+            ),
+            auto_memory=MODEL_AUTO_MEMORY,
+            workers=MODEL_WORKERS,
+            tune_chunk_size=MODEL_TUNE_CHUNK_SIZE,
+            chunk_tuning_dir=CHUNK_TUNING_DIR,
+        )
+    return engine
+
+
+# Request and cache lookup metrics, kept in memory and written to the database in bulk
+METRICS_BATCH_SIZE = int(os.getenv("METRICS_BATCH_SIZE", "500"))
+METRICS_FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", "2"))  # seconds
+METRICS_MAX_ROWS = int(os.getenv("METRICS_MAX_ROWS", "10000"))
+service_metrics = MetricsBuffer(
+    db_engine,
+    ServiceMetrics,
+    METRICS_BATCH_SIZE,
+    METRICS_FLUSH_INTERVAL,
+    METRICS_MAX_ROWS,
+)
+cache_metrics = MetricsBuffer(
+    db_engine,
+    CacheMetrics,
+    METRICS_BATCH_SIZE,
+    METRICS_FLUSH_INTERVAL,
+    METRICS_MAX_ROWS,
+)
+
+# Only one chunk size benchmark at a time
+tuning_lock = threading.Lock()
+
+
+result_cache: Optional[ResultCache] = None
+
+
+def get_result_cache() -> ResultCache:
+    global result_cache
+    if result_cache is None:
+        result_cache = ResultCache(RESULT_CACHE_DIR, RESULT_CACHE_MAX_BYTES)
+    return result_cache
+
+
+def get_output_paths(image_path: str) -> tuple:
+    # Generate unique names for the output files
+    base_name = os.path.basename(image_path)
+    base_name = os.path.splitext(base_name)[0]
+    object_3d_name = f"{base_name}.glb"
+    object_2d_name = f"{base_name}.gif"
+    object_3d_path = os.path.join(OBJECTS_DIR, object_3d_name)
+    object_2d_path = os.path.join(RENDERS_DIR, object_2d_name)
+    return object_3d_path, object_2d_path
+
+
+def run_generation(job_id: str, model_parameters: dict) -> dict:
+    """Job handler: runs one generation and publishes its outputs."""
+    image_path = model_parameters["image_path"]
+    # Every job writes into its own scratch directory
+    job_dir = os.path.join(SCRATCH_DIR, job_id)
+    try:
+        # Run the model with the resident engine
+        try:
+            outputs = get_engine().generate(
+                image_path,
+                job_dir,
+                mc_resolution=MC_RESOLUTION,
+                foreground_ratio=FOREGROUND_RATIO,
+                model_save_format="glb",
+                render=True,
+                skip_empty_space=SKIP_EMPTY_SPACE,
+                coarse_to_fine=COARSE_TO_FINE,
+                streaming_mesh=STREAMING_MESH,
+                progress=lambda stage, percent: get_job_queue().report_progress(
+                    job_id, stage, percent
+                ),
+            )
+        except Exception as e:
+            raise RuntimeError(f"Model generation failed: {e}")
+        # The engine is resident, generations do not pay for its initialization
+        metrics = generation_metrics(outputs)
+        logger.debug(f"Model run succesful, metrics: {metrics}")
+        log_generation_metrics(image_path, metrics)
+        # Check if the 3D object was created
+        generated_object = outputs["mesh"]
+        if not os.path.exists(generated_object):
+            raise RuntimeError("Model generation did not produce expected output files")
+        # Define the output gif path
+        render_gif = outputs["render"]
+        run_data = {"memory": outputs.get("memory"), "metrics": metrics}
+        cache_key = model_parameters.get("cache_key")
+        if cache_key:
+            try:
+                # Cache hits return the metrics of the generation that made the entry
+                run_data_path = os.path.join(job_dir, "run_data.json")
+                with open(run_data_path, "w") as f:
+                    json.dump(run_data, f)
+                get_result_cache().store(
+                    cache_key,
+                    {
+                        "mesh.glb": generated_object,
+                        "render.gif": render_gif,
+                        "run_data.json": run_data_path,
+                    },
+                )
+            except OSError as e:
+                logger.error(f"Failed to cache the results of job {job_id}: {e}")
+        object_3d_path, object_2d_path = get_output_paths(image_path)
+        logger.debug(f"Paths generated by the model: {object_3d_path, object_2d_path}")
+        # Publish the results with atomic renames, readers never see partial files
+        os.replace(generated_object, object_3d_path)
+        os.replace(render_gif, object_2d_path)
+    finally:
+        # Delete the intermediate images along with the scratch directory
+        shutil.rmtree(job_dir, ignore_errors=True)
+    model_data = {"object_3d": object_3d_path, "object_2d": object_2d_path, **run_data}
+    return model_data
+
+
+# Generation jobs, drained by a pool of workers sharing the engine
+job_queue: Optional[JobQueue] = None
+
+
+def get_job_queue() -> JobQueue:
+    global job_queue
+    if job_queue is None:
+        job_queue = JobQueue(
+            run_generation, workers=MODEL_WORKERS, max_queued=MODEL_QUEUE_SIZE
+        )
+        job_queue.start()
+    return job_queue
+
+
+# Load the model weights and the rembg session before serving requests
+@app.on_event("startup")
+def on_startup():
+    get_engine()
+    logger.debug("TripoSR engine loaded")
+    get_job_queue()
+    service_metrics.start()
+    cache_metrics.start()
+    if PREPARE_IMAGES_ON_STARTUP:
+        # Images prepared in an earlier run are only hashed, new ones are prepared
+        threading.Thread(
+            target=get_engine().prepared_images.prepare_all,
+            args=(IMAGES_DIR, FOREGROUND_RATIO),
+            name="prepare-images",
+            daemon=True,
+        ).start()
+
+
+@app.on_event("shutdown")
+def on_shutdown():
+    if job_queue is not None:
+        job_queue.stop()
+    # Write the metrics still buffered
+    service_metrics.stop()
+    cache_metrics.stop()
+
+
+def log_cache_lookup(**kwargs):
+    # Buffered, the rows are inserted in bulk by the writer thread
+    cache_metrics.add(timestamp=datetime.utcnow(), **kwargs)
+
+
+def log_model_metrics(db: Session, **kwargs):
+    new_metric = ModelMetrics(**kwargs)
+    db.add(new_metric)
+    db.commit()
+    return new_metric
+
+
+def log_generation_metrics(image_path: str, metrics: dict):
+    # Use a new database session for logging, from the job worker
+    db = next(get_db())
+    try:
+        log_model_metrics(
+            db=db,
+            object_name=os.path.splitext(os.path.basename(image_path))[0],
+            mc_resolution=MC_RESOLUTION,
+            **metrics,
+        )
+    except Exception as e:
+        logger.error(f"Failed to log model metrics: {e}")
+    finally:
+        db.close()
+
+
+def lookup_result_cache(image_path: str) -> tuple:
+    start_time = time.time()
+    cache = get_result_cache()
+    cache_key = cache.make_key(image_path, GENERATION_PARAMETERS)
+    cached_files = cache.lookup(cache_key)
+    lookup_time = (time.time() - start_time) * 1000  # Convert to milliseconds
+    logger.debug(f"Result cache {'hit' if cached_files else 'miss'}: {cache_key}")
+
+    log_cache_lookup(
+        cache_name="result",
+        object_name=os.path.splitext(os.path.basename(image_path))[0],
+        hit=cached_files is not None,
+        lookup_time_ms=lookup_time,
+    )
+    return cache_key, cached_files
+
+
+def publish_cached_results(image_path: str, cached_files: dict) -> Optional[dict]:
+    """None if the entry was evicted since its lookup, to generate instead."""
+    object_3d_path, object_2d_path = get_output_paths(image_path)
+    # Same fields as a generation, entries stored before run_data.json have none
+    run_data = {"memory": None, "metrics": None}
+    try:
+        link_or_copy(cached_files["mesh.glb"], object_3d_path)
+        link_or_copy(cached_files["render.gif"], object_2d_path)
+        if "run_data.json" in cached_files:
+            with open(cached_files["run_data.json"]) as f:
+                run_data.update(json.load(f))
+    except FileNotFoundError as e:
+        logger.warning(f"Cached results of {image_path} evicted before use: {e}")
+        return None
+    return {"object_3d": object_3d_path, "object_2d": object_2d_path, **run_data}
+
+
+def submit_job(model_parameters: dict) -> Job:
+    """
+    Blocking (the image is hashed and cached results are copied), called from
+    the handlers through the threadpool.
+    """
     if "image_path" not in model_parameters:
         raise HTTPException(status_code=422, detail="image_path is required")
     image_path = model_parameters["image_path"]
@@ -49,59 +366,132 @@ async def generate_3d_model(model_parameters: dict):
     logger.debug(f"Image path received by the model: {image_path}")
     if not os.path.exists(image_path):
         raise HTTPException(status_code=404, detail="Image not found")
-    # Run the model using subprocess
+    # Serve a previous generation of the same image and parameters when possible
+    cache_key, cached_files = lookup_result_cache(image_path)
+    if cached_files is not None:
+        model_data = publish_cached_results(image_path, cached_files)
+        if model_data is not None:
+            return get_job_queue().complete({"image_path": image_path}, model_data)
     try:
-        result = subprocess.run(
-            [
-                "python3",
-                "/app/triposr/run.py",
-                image_path,
-                "--model-save-format",
-                "glb",
-                "--render",
-                "--chunk-size",
-                chunk_size,
-                "--mc-resolution",
-                mc_resolution,
-                "--output-dir",
-                OBJECTS_DIR,
-            ],
-            check=True,
-            capture_output=True,
-            text=True,
+        return get_job_queue().submit(
+            {"image_path": image_path, "cache_key": cache_key}
         )
-        # Access the captured output from the result object
-        standard_output = result.stdout
-        standard_error = result.stderr
-        logger.debug(f"Subprocess output: {standard_output}")
-        logger.debug(f"Subprocess error: {standard_error}")
-    except subprocess.CalledProcessError as e:
+    except QueueFullError as e:
         raise HTTPException(
-            status_code=500, detail=f"Model generation failed: {e.stderr}"
+            status_code=429,
+            detail=str(e),
+            headers={"Retry-After": "30", "X-Queue-Depth": str(e.depth)},
         )
-    logger.debug(f"Subprocess run succesful")
-    # Check if the 3D object was created
-    generated_object = os.path.join(OBJECTS_DIR, "mesh.glb")
-    if not os.path.exists(generated_object):
-        raise HTTPException(
-            status_code=500,
-            detail="Model generation did not produce expected output files",
-        )
-    # Define the output gif path
-    render_gif = os.path.join(OBJECTS_DIR, "render.gif")
-    # Generate unique names for the output files
-    base_name = os.path.basename(image_path)
-    base_name = os.path.splitext(base_name)[0]
-    object_3d_name = f"{base_name}.glb"
-    object_2d_name = f"{base_name}.gif"
-    object_3d_path = os.path.join(OBJECTS_DIR, object_3d_name)
-    object_2d_path = os.path.join(RENDERS_DIR, object_2d_name)
-    logger.debug(f"Paths generated by the model: {object_3d_path, object_2d_path}")
-    # Move the results to the appropriate folders and delete intermediate images
-    shutil.move(generated_object, object_3d_path)
-    shutil.move(render_gif, object_2d_path)
-    png_files = glob(os.path.join(OBJECTS_DIR, "*.png"))
-    for png_file in png_files:
-        os.remove(png_file)
-    model_data = {"object_3d": object_3d_path, "object_2d": object_2d_path}
-    return model_data
+
+
+def lookup_job(job_id: str) -> Job:
+    job = get_job_queue().get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+
+@app.post("/jobs", status_code=202)
+async def create_job(model_parameters: dict):
+    job = await run_in_threadpool(submit_job, model_parameters)
+    return {
+        "job_id": job.job_id,
+        "state": job.state.value,
+        "queue_depth": get_job_queue().depth,
+    }
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    return lookup_job(job_id).to_dict()
+
+
+@app.get("/jobs/{job_id}/events")
+async def stream_job_events(job_id: str):
+    """
+    Server-sent events with the job state and the progress of its stages,
+    until the job has finished.
+    """
+    job = lookup_job(job_id)
+
+    async def events():
+        last_state = None
+        last_sent = time.time()
+        while True:
+            state = (job.state, job.progress)
+            if state != last_state:
+                last_state = state
+                last_sent = time.time()
+                yield f"data: {json.dumps(job.to_dict())}\n\n"
+                if job.finished:
+                    return
+            elif time.time() - last_sent > JOB_KEEPALIVE_INTERVAL:
+                last_sent = time.time()
+                yield ": keep-alive\n\n"
+            await asyncio.sleep(JOB_POLL_INTERVAL)
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+@app.get("/cache")
+async def get_cache_stats():
+    return get_result_cache().stats()
+
+
+@app.get("/tuning")
+async def get_chunk_tuning():
+    return {
+        "chunk_size": get_engine().memory_settings.chunk_size,
+        "tuning": get_engine().chunk_tuning,
+    }
+
+
+@app.post("/tuning")
+def tune_chunk_size():
+    """
+    Benchmarks the query chunk sizes again on this host and switches to the
+    fastest one. Refused while jobs are queued or running, as they would skew
+    the timings and the compiled query is replaced at the end.
+    """
+    if not tuning_lock.acquire(blocking=False):
+        raise HTTPException(status_code=409, detail="Chunk size tuning already running")
+    try:
+        active = get_job_queue().active
+        if active:
+            raise HTTPException(
+                status_code=409, detail=f"{active} jobs are queued or running"
+            )
+        tuning = get_engine().tune_chunk_size(force=True)
+    finally:
+        tuning_lock.release()
+    return {"chunk_size": tuning["chunk_size"], "tuning": tuning}
+
+
+@app.post("/generate")
+async def generate_3d_model(model_parameters: dict):
+    job = await run_in_threadpool(submit_job, model_parameters)
+    # Wait without blocking the event loop while a worker runs the job
+    while not job.done.is_set():
+        await asyncio.sleep(JOB_POLL_INTERVAL)
+    if job.state == JobState.FAILED:
+        raise HTTPException(status_code=500, detail=job.error)
+    return job.result
+
+
+# Log the service metrics that will be sent to Grafana via the postgreSQL database
+@app.middleware("http")
+async def log_requests(request: Request, call_next):
+    start_time = time.time()
+    response = await call_next(request)
+    response_time = (time.time() - start_time) * 1000  # Convert to milliseconds
+
+    # Buffered, the rows are inserted in bulk by the writer thread
+    service_metrics.add(
+        service_name="model_api",
+        endpoint=request.url.path,
+        response_time=response_time,
+        status_code=response.status_code,
+        timestamp=datetime.utcnow(),
+    )
+
+    return response
@@ -1,11 +1,11 @@
 from fastapi import FastAPI, HTTPException, Request
+import json
 import os
-import re
 import shutil
 import subprocess
 import logging
 import time
-from glob import glob
+import uuid
 from services import get_db
 from models import ModelMetrics
 from datetime import datetime
@@ -24,6 +24,12 @@ logger = logging.getLogger(__name__)
 
 OBJECTS_DIR = "/data/storage/objects"
 RENDERS_DIR = "/data/storage/renders"
+# Per-run scratch directories, published by tracking_api once the metrics are logged
+SCRATCH_DIR = "/data/storage/tmp"
+# Scene codes shared by the runs of a sweep, so only the first run of an image pays for the model
+SCENE_CACHE_DIR = "/data/storage/cache/scene_codes"
+# Preprocessed inputs of the image library, see triposr/prepare_images.py
+PREPARED_DIR = "/data/storage/prepared"
 
 app = FastAPI()
 
@@ -36,28 +42,14 @@ app = FastAPI()
 #     return await call_next(request)
 
 
-def parse_model_output(output: str):
-    metrics = {}
-
-    # Regular expressions to match the time entries
-    patterns = {
-        "initialization_time_ms": r"Initializing model finished in (\d+\.\d+)ms",
-        "processing_time_ms": r"Processing images finished in (\d+\.\d+)ms",
-        "running_time_ms": r"Running model finished in (\d+\.\d+)ms",
-        "rendering_time_ms": r"Rendering finished in (\d+\.\d+)ms",
-        "mesh_extraction_time_ms": r"Extracting mesh finished in (\d+\.\d+)ms",
-        "mesh_export_time_ms": r"Exporting mesh finished in (\d+\.\d+)ms",
-    }
-
-    for metric, pattern in patterns.items():
-        match = re.search(pattern, output)
-        if match:
-            metrics[metric] = float(match.group(1))
-
-    # Calculate total time
-    metrics["total_time_ms"] = sum(metrics.values())
-
-    return metrics
+def load_model_metrics(output_dir: str) -> dict:
+    """
+    Metrics of a run, written by run.py to `metrics.json` in its output
+    directory: the time of every stage, the batch, the memory settings and
+    the resources of the process, keyed by the columns of `ModelMetrics`.
+    """
+    with open(os.path.join(output_dir, "metrics.json")) as f:
+        return json.load(f)
 
 
 # The new HTTP POST endpoint for generating 3D models
@@ -75,6 +67,11 @@ async def generate_3d_model(request: Request):
         # Retrieve hyperparameters
         chunk_size = str(model_parameters.get("chunk_size", 8192))
         mc_resolution = str(model_parameters.get("mc_resolution", 256))
+        max_batch_size = str(model_parameters.get("max_batch_size", 1))
+        max_batch_wait_ms = str(model_parameters.get("max_batch_wait_ms", 50.0))
+        max_rays_per_batch = str(model_parameters.get("max_rays_per_batch", 65536))
+        # Every run writes into its own scratch directory
+        output_dir = os.path.join(SCRATCH_DIR, uuid.uuid4().hex)
         # Command to run the external process for model generation
         command = [
             "python3",
@@ -88,11 +85,26 @@ async def generate_3d_model(request: Request):
             "--mc-resolution",
             mc_resolution,
             "--output-dir",
-            OBJECTS_DIR,
+            output_dir,
+            "--scene-cache-dir",
+            SCENE_CACHE_DIR,
+            "--prepared-dir",
+            PREPARED_DIR,
+            "--max-batch-size",
+            max_batch_size,
+            "--max-batch-wait-ms",
+            max_batch_wait_ms,
+            "--max-rays-per-batch",
+            max_rays_per_batch,
         ]
+        for name in ("ff_chunk_size", "attention_slice_size"):
+            if model_parameters.get(name) is not None:
+                command += [f"--{name.replace('_', '-')}", str(model_parameters[name])]
 
         logger.debug(f"Running command: {' '.join(command)}")
 
+        # Handed over to the caller with the metrics, removed on any failure
+        handed_over = False
         try:
             result = subprocess.run(
                 command,
@@ -106,15 +118,18 @@ async def generate_3d_model(request: Request):
                 f"Subprocess output (combined stdout and stderr): {standard_output}"
             )
 
-            # Extract metrics from standard output
-            metrics = parse_model_output(standard_output)
-            return {"metrics": metrics}
+            metrics = load_model_metrics(output_dir)
+            handed_over = True
+            return {"metrics": metrics, "output_dir": output_dir}
 
         except subprocess.CalledProcessError as e:
             logger.error(f"Model generation failed: {e.stderr}")
             raise HTTPException(
                 status_code=500, detail=f"Model generation failed: {e.stderr}"
             )
+        finally:
+            if not handed_over:
+                shutil.rmtree(output_dir, ignore_errors=True)
 
     except Exception as e:
         logger.error(f"Unexpected error: {str(e)}")
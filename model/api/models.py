@@ -70,7 +70,7 @@ class ServiceMetrics(SQLModel, table=True):
     endpoint: str
     response_time: float
     status_code: int
-    timestamp: datetime = Field(default_factory=datetime.utcnow)
+    timestamp: datetime = Field(default_factory=datetime.utcnow, index=True)
 
 
 class ModelMetrics(SQLModel, table=True):
@@ -86,4 +86,25 @@ class ModelMetrics(SQLModel, table=True):
     total_time_ms: float
     chunk_size: int
     mc_resolution: int
+    batch_size: Optional[int] = None
+    batch_wait_ms: Optional[float] = None
+    max_batch_size: Optional[int] = None
+    max_batch_wait_ms: Optional[float] = None
+    max_rays_per_batch: Optional[int] = None
+    ff_chunk_size: Optional[int] = None
+    attention_slice_size: Optional[int] = None
+    texture_baking_time_ms: Optional[float] = None
+    peak_rss_mb: Optional[float] = None
+    torch_threads: Optional[int] = None
+    torch_interop_threads: Optional[int] = None
+    timestamp: datetime = Field(default_factory=datetime.utcnow)
+
+
+class CacheMetrics(SQLModel, table=True):
+    __tablename__ = "cache_metrics"
+    id: int = Field(default=None, primary_key=True)
+    cache_name: str
+    object_name: str
+    hit: bool
+    lookup_time_ms: float
     timestamp: datetime = Field(default_factory=datetime.utcnow)
@@ -0,0 +1,128 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import uuid
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+def link_or_copy(src: str, dst: str) -> None:
+    """Atomically places `src` at `dst`, as a hard link when possible."""
+    tmp = f"{dst}.{uuid.uuid4().hex}.tmp"
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copyfile(src, tmp)
+    os.replace(tmp, dst)
+
+
+class ResultCache:
+    """
+    Content-addressed store of generated objects.
+
+    Entries are directories named after the hash of the input image bytes and
+    of the generation parameters. The total size of the store is bounded by
+    `max_bytes`; the least recently used entries are evicted first. Recency
+    is kept in the directory mtimes, so it survives restarts.
+    """
+
+    def __init__(self, root: str, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        # key -> entry size in bytes, least recently used first
+        self._entries: "OrderedDict[str, int]" = OrderedDict()
+        os.makedirs(self.root, exist_ok=True)
+        self._load()
+
+    @staticmethod
+    def make_key(image_path: str, params: Dict[str, Any]) -> str:
+        digest = hashlib.sha256()
+        with open(image_path, "rb") as image_file:
+            for block in iter(lambda: image_file.read(1 << 20), b""):
+                digest.update(block)
+        digest.update(json.dumps(params, sort_keys=True).encode("utf-8"))
+        return digest.hexdigest()
+
+    @property
+    def size(self) -> int:
+        return sum(self._entries.values())
+
+    def _entry_dir(self, key: str) -> str:
+        return os.path.join(self.root, key)
+
+    def _load(self) -> None:
+        entries = []
+        for key in os.listdir(self.root):
+            entry_dir = self._entry_dir(key)
+            if key.startswith(".") or not os.path.isdir(entry_dir):
+                # Leftover of an interrupted store
+                shutil.rmtree(entry_dir, ignore_errors=True)
+                continue
+            size = sum(
+                os.path.getsize(os.path.join(entry_dir, name))
+                for name in os.listdir(entry_dir)
+            )
+            entries.append((os.path.getmtime(entry_dir), key, size))
+        for _, key, size in sorted(entries):
+            self._entries[key] = size
+        logger.debug(f"Result cache loaded: {len(self._entries)} entries")
+
+    def lookup(self, key: str) -> Optional[Dict[str, str]]:
+        """Returns the cached files of `key` by name, or None on a miss."""
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            entry_dir = self._entry_dir(key)
+            os.utime(entry_dir)
+            return {
+                name: os.path.join(entry_dir, name) for name in os.listdir(entry_dir)
+            }
+
+    def store(self, key: str, files: Dict[str, str]) -> None:
+        """Adds the files (name -> source path) of a finished generation."""
+        entry_dir = self._entry_dir(key)
+        tmp_dir = os.path.join(self.root, f".{key}.{uuid.uuid4().hex}")
+        os.makedirs(tmp_dir)
+        size = 0
+        for name, src in files.items():
+            link_or_copy(src, os.path.join(tmp_dir, name))
+            size += os.path.getsize(src)
+        with self._lock:
+            if key in self._entries:
+                # Another job produced the same entry in the meantime
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+                return
+            os.rename(tmp_dir, entry_dir)
+            self._entries[key] = size
+            self._evict()
+
+    def _evict(self) -> None:
+        # Keep at least the newest entry, even if it alone exceeds the budget
+        while self.size > self.max_bytes and len(self._entries) > 1:
+            key, _ = self._entries.popitem(last=False)
+            shutil.rmtree(self._entry_dir(key), ignore_errors=True)
+            self.evictions += 1
+            logger.debug(f"Result cache evicted {key}")
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "size_bytes": self.size,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
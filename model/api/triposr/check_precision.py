@@ -0,0 +1,106 @@
+import argparse
+import logging
+import os
+import time
+
+import torch
+
+from tsr.engine import TSREngine
+from tsr.precision import PRECISIONS, chamfer_distance, compare_scene_codes
+
+logging.basicConfig(
+    format="%(asctime)s - %(levelname)s - %(message)s", level=logging.INFO
+)
+parser = argparse.ArgumentParser(
+    description="Compares the scene codes and meshes of a reduced precision mode against fp32."
+)
+parser.add_argument("image", type=str, nargs="+", help="Path to input image(s).")
+parser.add_argument(
+    "--precision",
+    default="int8",
+    type=str,
+    choices=[p for p in PRECISIONS if p != "fp32"],
+    help="Precision mode to check against fp32. Default: 'int8'",
+)
+parser.add_argument(
+    "--device",
+    default="cpu",
+    type=str,
+    help="Device to use. int8 only runs on CPU. Default: 'cpu'",
+)
+parser.add_argument(
+    "--pretrained-model-name-or-path",
+    default="stabilityai/TripoSR",
+    type=str,
+    help="Path to the pretrained model. Could be either a huggingface model id is or a local path. Default: 'stabilityai/TripoSR'",
+)
+parser.add_argument(
+    "--mc-resolution",
+    default=256,
+    type=int,
+    help="Marching cubes grid resolution. Default: 256",
+)
+parser.add_argument(
+    "--no-remove-bg",
+    action="store_true",
+    help="If specified, the background will NOT be automatically removed from the input image. Default: false",
+)
+parser.add_argument(
+    "--output-dir",
+    default="output/",
+    type=str,
+    help="Directory where the preprocessed inputs are saved. Default: 'output/'",
+)
+args = parser.parse_args()
+
+engine = TSREngine(
+    args.pretrained_model_name_or_path,
+    device=args.device,
+    remove_bg=not args.no_remove_bg,
+)
+os.makedirs(args.output_dir, exist_ok=True)
+images = [
+    engine.preprocess(image_path, args.output_dir, args.no_remove_bg)
+    for image_path in args.image
+]
+
+
+def run(engine):
+    """Scene codes, meshes and mean model time of every image."""
+    results, elapsed = [], 0.0
+    for image in images:
+        start_time = time.perf_counter()
+        scene_codes = engine.encode_batch([image])
+        elapsed += time.perf_counter() - start_time
+        with torch.no_grad():
+            mesh = engine.model.extract_mesh(
+                scene_codes, True, resolution=args.mc_resolution
+            )[0]
+        results.append((scene_codes[0], mesh))
+    logging.info(
+        f"{engine.precision}: model ran in {elapsed / len(images) * 1000.0:.2f}ms per image"
+    )
+    return results
+
+
+reference = run(engine)
+# A new engine, initialized like the API one: the precision is applied before the
+# constant tokens of the backbone are precomputed
+del engine
+engine = TSREngine(
+    args.pretrained_model_name_or_path,
+    device=args.device,
+    remove_bg=False,
+    precision=args.precision,
+)
+reduced = run(engine)
+
+for image_path, (ref_code, ref_mesh), (code, mesh) in zip(
+    args.image, reference, reduced
+):
+    errors = compare_scene_codes(ref_code, code)
+    logging.info(
+        f"{image_path}: scene code relative error {errors['relative_error']:.4f}, "
+        f"max abs error {errors['max_abs_error']:.4f}, "
+        f"mesh Chamfer distance {chamfer_distance(ref_mesh, mesh):.5f}"
+    )
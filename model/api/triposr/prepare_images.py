@@ -0,0 +1,35 @@
+import argparse
+import logging
+
+from tsr.prepared_images import PreparedImageStore
+
+logging.basicConfig(
+    format="%(asctime)s - %(levelname)s - %(message)s", level=logging.INFO
+)
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    "images_dir", type=str, help="Directory of the image library to prepare."
+)
+parser.add_argument(
+    "--output-dir",
+    default="/data/storage/prepared",
+    type=str,
+    help="Directory where the prepared images are stored. Default: '/data/storage/prepared'",
+)
+parser.add_argument(
+    "--foreground-ratio",
+    default=0.85,
+    type=float,
+    help="Ratio of the foreground size to the image size. Default: 0.85",
+)
+parser.add_argument(
+    "--size",
+    default=512,
+    type=int,
+    help="Size of the prepared images, the conditioning image size of the model. Default: 512",
+)
+args = parser.parse_args()
+
+store = PreparedImageStore(args.output_dir, size=args.size)
+count = store.prepare_all(args.images_dir, args.foreground_ratio)
+logging.info(f"Prepared {count} images in {args.output_dir}")
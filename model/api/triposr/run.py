@@ -1,44 +1,12 @@
 import argparse
+import json
 import logging
 import os
-import time
-
-import numpy as np
-import rembg
-import torch
-import xatlas
-from PIL import Image
-
-from tsr.system import TSR
-from tsr.utils import remove_background, resize_foreground, save_gif
-from tsr.bake_texture import bake_texture
-
-
-class Timer:
-    def __init__(self):
-        self.items = {}
-        self.time_scale = 1000.0  # ms
-        self.time_unit = "ms"
-
-    def start(self, name: str) -> None:
-        if torch.cuda.is_available():
-            torch.cuda.synchronize()
-        self.items[name] = time.time()
-        logging.info(f"{name} ...")
-
-    def end(self, name: str) -> float:
-        if name not in self.items:
-            return
-        if torch.cuda.is_available():
-            torch.cuda.synchronize()
-        start_time = self.items.pop(name)
-        delta = time.time() - start_time
-        t = delta * self.time_scale
-        logging.info(f"{name} finished in {t:.2f}{self.time_unit}.")
-
-
-timer = Timer()
+from concurrent.futures import ThreadPoolExecutor
 
+from tsr.engine import TSREngine
+from tsr.instrumentation import generation_metrics
+from tsr.memory_budget import MemorySettings
 
 logging.basicConfig(
     format="%(asctime)s - %(levelname)s - %(message)s", level=logging.INFO
@@ -63,12 +31,73 @@ parser.add_argument(
     type=int,
     help="Evaluation chunk size for surface extraction and rendering. Smaller chunk size reduces VRAM usage but increases computation time. 0 for no chunking. Default: 8192",
 )
+parser.add_argument(
+    "--precision",
+    default="fp32",
+    type=str,
+    choices=["fp32", "bf16", "int8"],
+    help="Precision of the image tokenizer and the backbone: float32, bfloat16 autocast, or dynamically quantized int8 linear layers (CPU only). Check the quality of a mode with check_precision.py. Default: 'fp32'",
+)
+parser.add_argument(
+    "--no-fuse-projections",
+    action="store_true",
+    help="If specified, the attention layers of the backbone compute their query, key and value projections separately instead of with a single fused GEMM. Default: false",
+)
+parser.add_argument(
+    "--compile-query",
+    action="store_true",
+    help="If specified, the triplane query used by mesh extraction, rendering and texture baking is compiled (torch.compile, or TorchScript tracing) and warmed up for --chunk-size at startup, and the fastest of the compiled and eager versions is used. Default: false",
+)
+parser.add_argument(
+    "--max-rays-per-batch",
+    default=65536,
+    type=int,
+    help="Rays rendered per renderer call, smaller values reduce the memory used by --render. Default: 65536",
+)
+parser.add_argument(
+    "--ff-chunk-size",
+    default=None,
+    type=int,
+    help="Tokens per feed-forward call in the backbone, smaller values reduce memory usage. Default: no chunking",
+)
+parser.add_argument(
+    "--attention-slice-size",
+    default=None,
+    type=int,
+    help="Attention heads computed at a time in the backbone, smaller values reduce memory usage. Default: all heads at once",
+)
+parser.add_argument(
+    "--auto-memory",
+    action="store_true",
+    help="If specified, --chunk-size, --max-rays-per-batch, --ff-chunk-size and --attention-slice-size are ignored and selected from the memory available to the process instead. Default: false",
+)
+parser.add_argument(
+    "--tune-chunk-size",
+    action="store_true",
+    help="If specified, the query chunk size is replaced by the fastest one on this host, up to --chunk-size (or the one selected by --auto-memory). Default: false",
+)
+parser.add_argument(
+    "--chunk-tuning-dir",
+    default=None,
+    type=str,
+    help="Directory where chunk size benchmarks are stored per host type, so that --tune-chunk-size only benchmarks once. Default: no store",
+)
 parser.add_argument(
     "--mc-resolution",
     default=256,
     type=int,
     help="Marching cubes grid resolution. Default: 256",
 )
+parser.add_argument(
+    "--no-coarse-to-fine",
+    action="store_true",
+    help="If specified, the density is queried on the whole marching cubes grid, instead of on a coarse grid refined near the surface only. Default: false",
+)
+parser.add_argument(
+    "--no-streaming-mesh",
+    action="store_true",
+    help="If specified, the whole density volume is computed before running marching cubes, instead of running marching cubes slab by slab. Default: false",
+)
 parser.add_argument(
     "--no-remove-bg",
     action="store_true",
@@ -104,103 +133,99 @@ parser.add_argument(
     type=int,
     help="Texture atlas resolution, only useful with --bake-texture. Default: 2048",
 )
+parser.add_argument(
+    "--no-scene-cache",
+    action="store_true",
+    help="If specified, scene codes are neither cached nor rounded to float16, and every image goes through the model. Default: false",
+)
+parser.add_argument(
+    "--scene-cache-dir",
+    default=None,
+    type=str,
+    help="Directory where scene codes are cached, so that re-running an image with other meshing or rendering settings skips the model. Default: no disk cache",
+)
+parser.add_argument(
+    "--prepared-dir",
+    default=None,
+    type=str,
+    help="Directory where preprocessed input images are stored and looked up, see prepare_images.py. Default: no store",
+)
+parser.add_argument(
+    "--max-batch-size",
+    default=1,
+    type=int,
+    help="Number of images run through the model together. Images are then processed concurrently and each one is saved into its own numbered subdirectory of --output-dir. Default: 1",
+)
+parser.add_argument(
+    "--max-batch-wait-ms",
+    default=50.0,
+    type=float,
+    help="How long the first image of a batch waits for the others, only useful with --max-batch-size. Default: 50",
+)
 parser.add_argument(
     "--render",
     action="store_true",
     help="If specified, save a NeRF-rendered gif. Default: false",
 )
+parser.add_argument(
+    "--no-skip-empty-space",
+    action="store_true",
+    help="If specified, the gif is rendered by evaluating every sample of every ray, instead of skipping empty space and stopping rays once they are opaque. Default: false",
+)
 args = parser.parse_args()
 
-output_dir = args.output_dir
-os.makedirs(output_dir, exist_ok=True)
-
-device = args.device
-if not torch.cuda.is_available():
-    device = "cpu"
-
-timer.start("Initializing model")
-model = TSR.from_pretrained(
+engine = TSREngine(
     args.pretrained_model_name_or_path,
-    config_name="config.yaml",
-    weight_name="model.ckpt",
+    device=args.device,
+    chunk_size=args.chunk_size,
+    remove_bg=not args.no_remove_bg,
+    scene_cache=not args.no_scene_cache,
+    scene_cache_dir=args.scene_cache_dir,
+    prepared_dir=args.prepared_dir,
+    max_batch_size=args.max_batch_size,
+    max_batch_wait_ms=args.max_batch_wait_ms,
+    precision=args.precision,
+    compile_query=args.compile_query,
+    fuse_projections=not args.no_fuse_projections,
+    memory_settings=MemorySettings(
+        args.chunk_size,
+        args.max_rays_per_batch,
+        args.ff_chunk_size,
+        args.attention_slice_size,
+    ),
+    auto_memory=args.auto_memory,
+    workers=max(args.max_batch_size, 1),
+    tune_chunk_size=args.tune_chunk_size,
+    chunk_tuning_dir=args.chunk_tuning_dir,
 )
-model.renderer.set_chunk_size(args.chunk_size)
-model.to(device)
-timer.end("Initializing model")
-
-timer.start("Processing images")
-images = []
-
-if args.no_remove_bg:
-    rembg_session = None
-else:
-    rembg_session = rembg.new_session()
-
-for i, image_path in enumerate(args.image):
-    if args.no_remove_bg:
-        image = np.array(Image.open(image_path).convert("RGB"))
-    else:
-        image = remove_background(Image.open(image_path), rembg_session)
-        image = resize_foreground(image, args.foreground_ratio)
-        image = np.array(image).astype(np.float32) / 255.0
-        image = image[:, :, :3] * image[:, :, 3:4] + (1 - image[:, :, 3:4]) * 0.5
-        image = Image.fromarray((image * 255.0).astype(np.uint8))
-        image.save(os.path.join(output_dir, f"input.png"))
-    images.append(image)
-timer.end("Processing images")
 
-for i, image in enumerate(images):
-    logging.info(f"Running image {i + 1}/{len(images)} ...")
 
-    timer.start("Running model")
-    with torch.no_grad():
-        scene_codes = model([image], device=device)
-    timer.end("Running model")
-
-    if args.render:
-        timer.start("Rendering")
-        n_views = 24
-        # Validate n_views
-        if not isinstance(n_views, int):
-            raise TypeError(f"n_views must be an integer, got {type(n_views).__name__}")
-        if n_views < 1 or n_views > 30:
-            raise ValueError(f"n_views must be between 1 and 30, got {n_views}")
-
-        render_images = model.render(scene_codes, n_views=n_views, return_type="pil")
-        for ri, render_image in enumerate(render_images[0]):
-            render_image.save(os.path.join(output_dir, f"render_{ri:03d}.png"))
-        save_gif(render_images[0], os.path.join(output_dir, f"render.gif"), fps=24)
-        timer.end("Rendering")
-
-    timer.start("Extracting mesh")
-    meshes = model.extract_mesh(
-        scene_codes, not args.bake_texture, resolution=args.mc_resolution
+def run_image(i, image_path):
+    logging.info(f"Running image {i + 1}/{len(args.image)} ...")
+    output_dir = args.output_dir
+    if args.max_batch_size > 1 and len(args.image) > 1:
+        output_dir = os.path.join(output_dir, str(i))
+    outputs = engine.generate(
+        image_path,
+        output_dir,
+        mc_resolution=args.mc_resolution,
+        no_remove_bg=args.no_remove_bg,
+        foreground_ratio=args.foreground_ratio,
+        model_save_format=args.model_save_format,
+        bake_texture=args.bake_texture,
+        texture_resolution=args.texture_resolution,
+        render=args.render,
+        skip_empty_space=not args.no_skip_empty_space,
+        coarse_to_fine=not args.no_coarse_to_fine,
+        streaming_mesh=not args.no_streaming_mesh,
     )
-    timer.end("Extracting mesh")
-
-    out_mesh_path = os.path.join(output_dir, f"mesh.{args.model_save_format}")
-    if args.bake_texture:
-        out_texture_path = os.path.join(output_dir, "texture.png")
+    # Machine-readable record of the run, the columns of the model_metrics table
+    metrics = generation_metrics(outputs)
+    metrics["initialization_time_ms"] = engine.initialization_time_ms
+    metrics["total_time_ms"] += engine.initialization_time_ms
+    with open(os.path.join(output_dir, "metrics.json"), "w") as f:
+        json.dump(metrics, f)
 
-        timer.start("Baking texture")
-        bake_output = bake_texture(
-            meshes[0], model, scene_codes[0], args.texture_resolution
-        )
-        timer.end("Baking texture")
 
-        timer.start("Exporting mesh and texture")
-        xatlas.export(
-            out_mesh_path,
-            meshes[0].vertices[bake_output["vmapping"]],
-            bake_output["indices"],
-            bake_output["uvs"],
-            meshes[0].vertex_normals[bake_output["vmapping"]],
-        )
-        Image.fromarray((bake_output["colors"] * 255.0).astype(np.uint8)).transpose(
-            Image.FLIP_TOP_BOTTOM
-        ).save(out_texture_path)
-        timer.end("Exporting mesh and texture")
-    else:
-        timer.start("Exporting mesh")
-        meshes[0].export(out_mesh_path)
-        timer.end("Exporting mesh")
+with ThreadPoolExecutor(max_workers=max(args.max_batch_size, 1)) as executor:
+    list(executor.map(run_image, range(len(args.image)), args.image))
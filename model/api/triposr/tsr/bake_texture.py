@@ -134,13 +134,16 @@ def rasterize_position_atlas(
     return fbo_np
 
 
-def positions_to_colors(model, scene_code, positions_texture, texture_resolution):
+def positions_to_colors(
+    model, scene_code, positions_texture, texture_resolution, chunk_size=None
+):
     positions = torch.tensor(positions_texture.reshape(-1, 4)[:, :-1])
     with torch.no_grad():
         queried_grid = model.renderer.query_triplane(
             model.decoder,
             positions,
             scene_code,
+            chunk_size,
         )
     rgb_f = queried_grid["color"].numpy().reshape(-1, 3)
     rgba_f = np.insert(rgb_f, 3, positions_texture.reshape(-1, 4)[:, -1], axis=1)
@@ -148,7 +151,7 @@ def positions_to_colors(model, scene_code, positions_texture, texture_resolution
     return rgba_f.reshape(texture_resolution, texture_resolution, 4)
 
 
-def bake_texture(mesh, model, scene_code, texture_resolution):
+def bake_texture(mesh, model, scene_code, texture_resolution, chunk_size=None):
     texture_padding = round(max(2, texture_resolution / 256))
     atlas = make_atlas(mesh, texture_resolution, texture_padding)
     positions_texture = rasterize_position_atlas(
@@ -160,7 +163,7 @@ def bake_texture(mesh, model, scene_code, texture_resolution):
         texture_padding,
     )
     colors_texture = positions_to_colors(
-        model, scene_code, positions_texture, texture_resolution
+        model, scene_code, positions_texture, texture_resolution, chunk_size
     )
     return {
         "vmapping": atlas["vmapping"],
@@ -0,0 +1,72 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List, Sequence, Tuple
+
+
+class DynamicBatcher:
+    """
+    Groups concurrent calls into batches.
+
+    `submit` blocks until its item has been processed. A background thread
+    waits for the first item, then keeps collecting items for at most
+    `max_wait_ms` or until `max_batch_size` items are pending, and calls
+    `batch_fn` once on the whole batch. `batch_fn` must return one result
+    per item, in order.
+    """
+
+    def __init__(
+        self,
+        batch_fn: Callable[[List[Any]], Sequence[Any]],
+        max_batch_size: int = 4,
+        max_wait_ms: float = 50.0,
+    ):
+        self.batch_fn = batch_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self._queue: "queue.Queue[Tuple[Any, Future, float]]" = queue.Queue()
+        self._thread = threading.Thread(
+            target=self._run, name="dynamic-batcher", daemon=True
+        )
+        self._thread.start()
+
+    def submit(self, item: Any) -> Tuple[Any, Dict[str, Any]]:
+        """Returns the result of `item` and the batch it was processed in."""
+        future: Future = Future()
+        self._queue.put((item, future, time.perf_counter()))
+        return future.result()
+
+    def _collect(self) -> List[Tuple[Any, Future, float]]:
+        batch = [self._queue.get()]
+        deadline = batch[0][2] + self.max_wait_ms / 1000.0
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = self._collect()
+            start_time = time.perf_counter()
+            try:
+                results = self.batch_fn([item for item, _, _ in batch])
+            except Exception as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future, submit_time), result in zip(batch, results):
+                future.set_result(
+                    (
+                        result,
+                        {
+                            "batch_size": len(batch),
+                            "batch_wait_ms": (start_time - submit_time) * 1000.0,
+                        },
+                    )
+                )
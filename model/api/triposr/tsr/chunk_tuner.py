@@ -0,0 +1,163 @@
+import hashlib
+import json
+import logging
+import os
+import platform
+import time
+import uuid
+from datetime import datetime
+from typing import Any, Dict, Optional, Sequence
+
+import torch
+
+CHUNK_SIZES = (2048, 4096, 8192, 12288, 14336, 16384, 32768, 65536)
+
+
+class ChunkSizeTuner:
+    """
+    Benchmarks the triplane query, which dominates mesh extraction, rendering
+    and texture baking, at several chunk sizes and picks the fastest one for
+    the current host. The best size depends on the caches and the number of
+    cores, so results are stored in `cache_dir` per host signature (CPU or
+    GPU model, core and thread counts, torch version and model), and hosts
+    of the same type sharing the directory only benchmark once.
+    """
+
+    def __init__(
+        self,
+        cache_dir: Optional[str] = None,
+        candidates: Sequence[int] = CHUNK_SIZES,
+        n_points: int = 1 << 18,
+        n_repeats: int = 2,
+    ):
+        self.cache_dir = cache_dir
+        self.candidates = sorted(candidates)
+        self.n_points = n_points
+        self.n_repeats = n_repeats
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def host_signature(device: str, model_name: str = "") -> Dict[str, Any]:
+        if torch.device(device).type == "cuda":
+            processor = torch.cuda.get_device_name(torch.device(device))
+        else:
+            processor = platform.processor() or platform.machine()
+            try:
+                with open("/proc/cpuinfo") as f:
+                    for line in f:
+                        if line.startswith("model name"):
+                            processor = line.split(":", 1)[1].strip()
+                            break
+            except OSError:
+                pass
+        return {
+            "processor": processor,
+            "cpu_count": os.cpu_count(),
+            "threads": torch.get_num_threads(),
+            "torch": torch.__version__,
+            "model": model_name,
+        }
+
+    def _path(self, signature: Dict[str, Any]) -> str:
+        digest = hashlib.sha256(json.dumps(signature, sort_keys=True).encode("utf-8"))
+        return os.path.join(self.cache_dir, f"{digest.hexdigest()}.json")
+
+    def benchmark(self, model, candidates: Sequence[int]) -> Dict[int, float]:
+        """
+        Query throughput of `model`, in points per second, by chunk size. The
+        chunk size is passed to each query, the renderer is left untouched
+        for the generations running meanwhile.
+        """
+        scene_code = model.token_scene_code()
+        radius = model.renderer.cfg.radius
+        positions = (
+            torch.rand(self.n_points, 3, device=scene_code.device) * 2 - 1
+        ) * radius
+        throughput = {}
+        with torch.no_grad():
+            for candidate in candidates:
+
+                def query():
+                    model.renderer.query_triplane(
+                        model.decoder, positions, scene_code, chunk_size=candidate
+                    )
+
+                # warm-up, e.g. allocator and thread pool
+                query()
+                if scene_code.is_cuda:
+                    torch.cuda.synchronize()
+                start_time = time.perf_counter()
+                for _ in range(self.n_repeats):
+                    query()
+                if scene_code.is_cuda:
+                    torch.cuda.synchronize()
+                elapsed = time.perf_counter() - start_time
+                throughput[candidate] = self.n_points * self.n_repeats / elapsed
+                logging.info(
+                    f"Chunk size {candidate}: {throughput[candidate]:.0f} points/s"
+                )
+        return throughput
+
+    def tune(
+        self,
+        model,
+        device: str,
+        model_name: str = "",
+        max_chunk_size: Optional[int] = None,
+        force: bool = False,
+    ) -> Dict[str, Any]:
+        """
+        Returns the fastest chunk size of at most `max_chunk_size` under
+        "chunk_size", along with the measured throughputs and the host
+        signature. Only the candidates within `max_chunk_size` are run, so
+        the benchmark stays within the memory bound. Stored results for this
+        host are reused unless `force`, and completed with the candidates
+        they miss.
+        """
+        candidates = [
+            candidate
+            for candidate in self.candidates
+            if max_chunk_size is None or candidate <= max_chunk_size
+        ]
+        signature = self.host_signature(device, model_name)
+        result = None
+        if self.cache_dir is not None and not force:
+            try:
+                with open(self._path(signature)) as f:
+                    result = json.load(f)
+                # JSON keys are strings
+                result["throughput"] = {
+                    int(k): v for k, v in result["throughput"].items()
+                }
+            except (OSError, ValueError, KeyError):
+                result = None
+        missing = [
+            candidate
+            for candidate in candidates
+            if result is None or candidate not in result["throughput"]
+        ]
+        if result is None or missing:
+            throughput = result["throughput"] if result is not None else {}
+            result = {
+                "signature": signature,
+                "throughput": {**throughput, **self.benchmark(model, missing)},
+                "tuned_at": datetime.utcnow().isoformat(),
+            }
+            if self.cache_dir is not None:
+                # Write then rename, so that concurrent readers never see a partial file
+                tmp_path = f"{self._path(signature)}.{uuid.uuid4().hex}.tmp"
+                with open(tmp_path, "w") as f:
+                    json.dump(result, f)
+                os.replace(tmp_path, self._path(signature))
+
+        allowed = {
+            chunk_size: throughput
+            for chunk_size, throughput in result["throughput"].items()
+            if max_chunk_size is None or chunk_size <= max_chunk_size
+        }
+        if allowed:
+            result["chunk_size"] = max(allowed, key=allowed.get)
+        else:
+            result["chunk_size"] = max_chunk_size
+        return result
@@ -0,0 +1,387 @@
+import logging
+import os
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+import rembg
+import torch
+import xatlas
+from PIL import Image
+
+from .bake_texture import bake_texture as bake_texture_atlas
+from .batching import DynamicBatcher
+from .chunk_tuner import ChunkSizeTuner
+from .instrumentation import Timer, resource_usage
+from .memory_budget import MemorySettings, available_memory, select_memory_settings
+from .precision import apply_precision, precision_context
+from .prepared_images import PreparedImageStore
+from .scene_cache import SceneCodeCache
+from .system import TSR
+from .utils import save_gif
+
+
+class TSREngine:
+    """
+    Resident TripoSR pipeline.
+
+    The TSR weights and the rembg session are loaded once when the engine is
+    created, so every subsequent call to `generate` only pays for the actual
+    preprocessing, inference, rendering and mesh extraction. With
+    `scene_cache`, scene codes are cached as float16 by preprocessed image, in
+    memory and optionally in `scene_cache_dir`, so images seen before skip the
+    backbone. Likewise preprocessed inputs are kept in `prepared_dir` when it
+    is given.
+
+    With `max_batch_size` > 1, images encoded concurrently (e.g. by several
+    job workers) within `max_batch_wait_ms` of each other go through the
+    image tokenizer and the backbone as a single batch.
+
+    `precision` selects how the image tokenizer and the backbone run: "fp32",
+    "bf16" (autocast) or "int8" (dynamically quantized linear layers, CPU
+    only). Scene codes are cached per precision. With `fuse_projections`, the
+    attention layers of the backbone compute their query, key and value
+    projections with a single GEMM. The part of the backbone that only
+    depends on the learned triplane tokens is computed once, at load time.
+    With `compile_query`, the triplane query is compiled and warmed up for
+    `chunk_size` at load time.
+
+    `memory_settings` bounds the peak memory of a generation, see
+    `tsr/memory_budget.py`; by default only the query is chunked, by
+    `chunk_size`. With `auto_memory`, the settings are instead selected once
+    the weights are loaded, from the memory left in the container for
+    `workers` concurrent generations. With `tune_chunk_size`, the query
+    chunk size is then replaced by the fastest one on this host that fits
+    the settings, benchmarked once per host type and stored in
+    `chunk_tuning_dir` when it is given, see `tune_chunk_size`.
+    """
+
+    def __init__(
+        self,
+        pretrained_model_name_or_path: str = "stabilityai/TripoSR",
+        device: str = "cuda:0",
+        chunk_size: int = 8192,
+        remove_bg: bool = True,
+        scene_cache: bool = True,
+        scene_cache_dir: Optional[str] = None,
+        prepared_dir: Optional[str] = None,
+        max_batch_size: int = 1,
+        max_batch_wait_ms: float = 0.0,
+        precision: str = "fp32",
+        compile_query: bool = False,
+        fuse_projections: bool = True,
+        memory_settings: Optional[MemorySettings] = None,
+        auto_memory: bool = False,
+        workers: int = 1,
+        tune_chunk_size: bool = False,
+        chunk_tuning_dir: Optional[str] = None,
+    ):
+        timer = Timer()
+        self.model_name = pretrained_model_name_or_path
+        self.precision = precision
+        self.scene_cache = None
+        if scene_cache:
+            self.scene_cache = SceneCodeCache(scene_cache_dir)
+        self.max_batch_size = max_batch_size
+        self.max_batch_wait_ms = max_batch_wait_ms
+        self.batcher = None
+        if max_batch_size > 1:
+            self.batcher = DynamicBatcher(
+                self.encode_batch, max_batch_size, max_batch_wait_ms
+            )
+        self.device = device if torch.cuda.is_available() else "cpu"
+
+        timer.start("Initializing model")
+        self.model = TSR.from_pretrained(
+            pretrained_model_name_or_path,
+            config_name="config.yaml",
+            weight_name="model.ckpt",
+        )
+        self.model.to(self.device)
+        if fuse_projections:
+            fused = self.model.backbone.fuse_qkv_projections()
+            logging.info(f"Fused the QKV projections of {fused} attention layers")
+        apply_precision(self.model, precision)
+        with precision_context(precision, self.device):
+            self.model.precompute_constant_tokens()
+        if auto_memory:
+            budget = available_memory()
+            memory_settings = select_memory_settings(budget, workers)
+            logging.info(
+                f"Selected {memory_settings} for {workers} workers "
+                f"with {budget} bytes available"
+            )
+        elif memory_settings is None:
+            memory_settings = MemorySettings(chunk_size, 65536, None, None)
+        self.set_memory_settings(memory_settings)
+        # Largest chunk size allowed by the memory settings, for the tuner
+        self.max_chunk_size = memory_settings.chunk_size
+        self.chunk_tuner = ChunkSizeTuner(chunk_tuning_dir)
+        self.chunk_tuning = None
+        if tune_chunk_size:
+            self.tune_chunk_size(compile_query=False)
+        self.compile_query = compile_query
+        if compile_query:
+            backend = self.model.compile_query(self.memory_settings.chunk_size)
+            logging.info(f"Triplane query backend: {backend}")
+        self.prepared_images = PreparedImageStore(
+            prepared_dir,
+            size=self.model.cfg.cond_image_size,
+            rembg_session=rembg.new_session() if remove_bg else None,
+        )
+        self.initialization_time_ms = timer.end("Initializing model")
+
+    def set_memory_settings(self, settings: MemorySettings) -> None:
+        self.memory_settings = settings
+        self.model.renderer.set_chunk_size(settings.chunk_size)
+        self.model.backbone.set_chunk_feed_forward(settings.ff_chunk_size)
+        self.model.backbone.set_attention_slice(settings.attention_slice_size)
+
+    def tune_chunk_size(
+        self, force: bool = False, compile_query: Optional[bool] = None
+    ) -> Dict[str, Any]:
+        """
+        Switches the query to the chunk size with the highest throughput on
+        this host, up to the one of the memory settings the engine started
+        with. The stored benchmark for this host type is reused unless
+        `force`. The compiled query is warmed up again for the new size,
+        when the engine compiles it. Returns the tuning result.
+        """
+        if compile_query is None:
+            compile_query = self.compile_query
+        self.chunk_tuning = self.chunk_tuner.tune(
+            self.model,
+            self.device,
+            model_name=self.model_name,
+            max_chunk_size=self.max_chunk_size,
+            force=force,
+        )
+        chunk_size = self.chunk_tuning["chunk_size"]
+        logging.info(f"Tuned query chunk size: {chunk_size}")
+        self.set_memory_settings(self.memory_settings._replace(chunk_size=chunk_size))
+        if compile_query:
+            backend = self.model.compile_query(chunk_size)
+            logging.info(f"Triplane query backend: {backend}")
+        return self.chunk_tuning
+
+    def preprocess(
+        self,
+        image_path: str,
+        output_dir: str,
+        no_remove_bg: bool = False,
+        foreground_ratio: float = 0.85,
+    ) -> Image.Image:
+        if no_remove_bg:
+            return np.array(Image.open(image_path).convert("RGB"))
+        image = self.prepared_images.prepare(image_path, foreground_ratio)
+        image.save(os.path.join(output_dir, f"input.png"))
+        return image
+
+    def encode_batch(self, images: List[Any]) -> torch.FloatTensor:
+        with torch.no_grad(), precision_context(self.precision, self.device):
+            return self.model(images, device=self.device).float()
+
+    def encode(self, image) -> Tuple[torch.FloatTensor, Dict[str, Any]]:
+        """
+        Scene codes of a preprocessed image, from the cache when possible, and
+        the size of the batch they were computed in (0 on a cache hit) along
+        with the time spent waiting for that batch to fill. With the cache
+        enabled, computed scene codes are rounded to float16 like cached ones;
+        without it they are returned as computed.
+        """
+        if self.scene_cache is None:
+            return self.encode_uncached(image)
+        namespace = self.model_name
+        if self.precision != "fp32":
+            namespace = f"{self.model_name}:{self.precision}"
+        key = SceneCodeCache.make_key(image, namespace)
+        scene_code = self.scene_cache.get(key)
+        if scene_code is not None:
+            logging.info("Scene code cache hit")
+            batch = {"batch_size": 0, "batch_wait_ms": 0.0}
+            return scene_code[None].to(self.device, torch.float32), batch
+        scene_code, batch = self.encode_uncached(image)
+        # The cached float16 value, as on a hit, so the result does not depend
+        # on the cache state
+        scene_code = self.scene_cache.put(key, scene_code[0])
+        return scene_code[None].to(self.device, torch.float32), batch
+
+    def encode_uncached(self, image) -> Tuple[torch.FloatTensor, Dict[str, Any]]:
+        if self.batcher is None:
+            scene_code = self.encode_batch([image])[0]
+            batch = {"batch_size": 1, "batch_wait_ms": 0.0}
+        else:
+            scene_code, batch = self.batcher.submit(image)
+        return scene_code[None].to(self.device), batch
+
+    def generate(
+        self,
+        image_path: str,
+        output_dir: str,
+        chunk_size: Optional[int] = None,
+        mc_resolution: int = 256,
+        no_remove_bg: bool = False,
+        foreground_ratio: float = 0.85,
+        model_save_format: str = "obj",
+        bake_texture: bool = False,
+        texture_resolution: int = 2048,
+        render: bool = False,
+        n_views: int = 24,
+        skip_empty_space: bool = True,
+        coarse_to_fine: bool = True,
+        streaming_mesh: bool = True,
+        progress: Optional[Callable[[str, float], None]] = None,
+    ) -> Dict[str, Any]:
+        """
+        Run the full pipeline on a single image and write the results to
+        `output_dir`. Returns the paths of the produced files, the batch the
+        image was encoded in under "batch", the memory settings it ran with
+        under "memory", and the time of every stage along with the resources
+        of the process under "stats", see `tsr/instrumentation.py`.
+
+        `chunk_size` replaces the query chunk size of the memory settings for
+        this generation only; the model is shared by concurrent generations.
+
+        `progress` is called with the stage ("preprocess", "backbone",
+        "render", "extract", "bake" or "export") and its completion in
+        percent, when a stage starts and ends and, while rendering and
+        extracting the mesh, after every chunk.
+        """
+        # A timer per call, so that concurrent generations do not share stages
+        timer = Timer()
+        os.makedirs(output_dir, exist_ok=True)
+        # Passed to the queries of this generation only, the model is shared
+        if chunk_size is None:
+            chunk_size = self.model.renderer.chunk_size
+
+        def report(stage, fraction):
+            if progress is not None:
+                progress(stage, round(fraction * 100.0, 1))
+
+        timer.start("Processing images")
+        report("preprocess", 0.0)
+        image = self.preprocess(image_path, output_dir, no_remove_bg, foreground_ratio)
+        report("preprocess", 1.0)
+        timer.end("Processing images")
+
+        timer.start("Running model")
+        report("backbone", 0.0)
+        scene_codes, batch = self.encode(image)
+        report("backbone", 1.0)
+        timer.end("Running model")
+        batch = {
+            **batch,
+            "max_batch_size": self.max_batch_size,
+            "max_batch_wait_ms": self.max_batch_wait_ms,
+        }
+        logging.info(
+            f"Batch of {batch['batch_size']} images "
+            f"(max {self.max_batch_size}, window {self.max_batch_wait_ms:.2f}ms) "
+            f"waited {batch['batch_wait_ms']:.2f}ms"
+        )
+
+        memory = {
+            **self.memory_settings._asdict(),
+            "chunk_size": chunk_size,
+        }
+        logging.info(
+            f"Memory settings: chunk size {memory['chunk_size']}, "
+            f"rays per batch {memory['max_rays_per_batch']}, "
+            f"feed-forward chunk {memory['ff_chunk_size']}, "
+            f"attention slice {memory['attention_slice_size']}"
+        )
+
+        outputs = {
+            "mesh": os.path.join(output_dir, f"mesh.{model_save_format}"),
+            "batch": batch,
+            "memory": memory,
+        }
+
+        if render:
+            timer.start("Rendering")
+            # Validate n_views
+            if not isinstance(n_views, int):
+                raise TypeError(
+                    f"n_views must be an integer, got {type(n_views).__name__}"
+                )
+            if n_views < 1 or n_views > 30:
+                raise ValueError(f"n_views must be between 1 and 30, got {n_views}")
+
+            report("render", 0.0)
+            render_images = self.model.render(
+                scene_codes,
+                n_views=n_views,
+                return_type="pil",
+                max_rays_per_batch=memory["max_rays_per_batch"],
+                skip_empty_space=skip_empty_space,
+                chunk_size=chunk_size,
+                progress=lambda fraction: report("render", fraction),
+            )
+            for ri, render_image in enumerate(render_images[0]):
+                render_image.save(os.path.join(output_dir, f"render_{ri:03d}.png"))
+            outputs["render"] = os.path.join(output_dir, "render.gif")
+            save_gif(render_images[0], outputs["render"], fps=24)
+            timer.end("Rendering")
+
+        timer.start("Extracting mesh")
+        report("extract", 0.0)
+        meshes = self.model.extract_mesh(
+            scene_codes,
+            not bake_texture,
+            resolution=mc_resolution,
+            coarse_to_fine=coarse_to_fine,
+            streaming=streaming_mesh,
+            chunk_size=chunk_size,
+            progress=lambda fraction: report("extract", fraction),
+        )
+        timer.end("Extracting mesh")
+
+        if bake_texture:
+            outputs["texture"] = os.path.join(output_dir, "texture.png")
+            self.export_baked(
+                meshes[0],
+                scene_codes[0],
+                outputs,
+                texture_resolution,
+                chunk_size,
+                timer,
+                report,
+            )
+        else:
+            timer.start("Exporting mesh")
+            report("export", 0.0)
+            meshes[0].export(outputs["mesh"])
+            report("export", 1.0)
+            timer.end("Exporting mesh")
+
+        outputs["stats"] = {
+            "stages_ms": timer.timings,
+            "total_time_ms": sum(timer.timings.values()),
+            **resource_usage(),
+        }
+        return outputs
+
+    def export_baked(
+        self, mesh, scene_code, outputs, texture_resolution, chunk_size, timer, report
+    ):
+        timer.start("Baking texture")
+        report("bake", 0.0)
+        bake_output = bake_texture_atlas(
+            mesh, self.model, scene_code, texture_resolution, chunk_size
+        )
+        report("bake", 1.0)
+        timer.end("Baking texture")
+
+        timer.start("Exporting mesh and texture")
+        report("export", 0.0)
+        xatlas.export(
+            outputs["mesh"],
+            mesh.vertices[bake_output["vmapping"]],
+            bake_output["indices"],
+            bake_output["uvs"],
+            mesh.vertex_normals[bake_output["vmapping"]],
+        )
+        Image.fromarray((bake_output["colors"] * 255.0).astype(np.uint8)).transpose(
+            Image.FLIP_TOP_BOTTOM
+        ).save(outputs["texture"])
+        report("export", 1.0)
+        timer.end("Exporting mesh and texture")
@@ -0,0 +1,91 @@
+import logging
+import resource
+import sys
+import time
+from typing import Any, Dict
+
+import torch
+
+# Column of the model_metrics table of every stage timed by the engine
+STAGE_METRICS = {
+    "Initializing model": "initialization_time_ms",
+    "Processing images": "processing_time_ms",
+    "Running model": "running_time_ms",
+    "Rendering": "rendering_time_ms",
+    "Extracting mesh": "mesh_extraction_time_ms",
+    "Baking texture": "texture_baking_time_ms",
+    "Exporting mesh": "mesh_export_time_ms",
+    "Exporting mesh and texture": "mesh_export_time_ms",
+}
+
+
+class Timer:
+    """
+    Times named stages, logging them as they start and end and keeping the
+    elapsed time of each one in `timings` (in ms, by stage name).
+    """
+
+    def __init__(self):
+        self.items = {}
+        self.timings = {}
+        self.time_scale = 1000.0  # ms
+        self.time_unit = "ms"
+
+    def start(self, name: str) -> None:
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        self.items[name] = time.time()
+        logging.info(f"{name} ...")
+
+    def end(self, name: str) -> float:
+        if name not in self.items:
+            return
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        start_time = self.items.pop(name)
+        delta = time.time() - start_time
+        t = delta * self.time_scale
+        self.timings[name] = self.timings.get(name, 0.0) + t
+        logging.info(f"{name} finished in {t:.2f}{self.time_unit}.")
+        return t
+
+
+def resource_usage() -> Dict[str, Any]:
+    """
+    Peak resident memory of the process so far, in MiB, and the number of
+    intra-op and inter-op threads torch runs with.
+    """
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes
+    peak_rss_mb = peak_rss / 1024**2 if sys.platform == "darwin" else peak_rss / 1024
+    return {
+        "peak_rss_mb": peak_rss_mb,
+        "torch_threads": torch.get_num_threads(),
+        "torch_interop_threads": torch.get_num_interop_threads(),
+    }
+
+
+def generation_metrics(outputs: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Flattens the "stats", "batch" and "memory" records of a generation into
+    the columns of the model_metrics table. Stages that did not run count
+    as 0ms.
+    """
+    stats = outputs["stats"]
+    metrics = {
+        column: 0.0
+        for column in STAGE_METRICS.values()
+        if column != "texture_baking_time_ms"
+    }
+    for stage, elapsed in stats["stages_ms"].items():
+        column = STAGE_METRICS.get(stage)
+        if column is None:
+            logging.warning(f"Stage {stage} has no metric column")
+            continue
+        metrics[column] = metrics.get(column, 0.0) + elapsed
+    metrics["total_time_ms"] = sum(stats["stages_ms"].values())
+    metrics.update(outputs["batch"])
+    metrics.update(outputs["memory"])
+    for key in ("peak_rss_mb", "torch_threads", "torch_interop_threads"):
+        metrics[key] = stats[key]
+    return metrics
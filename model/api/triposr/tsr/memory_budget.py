@@ -0,0 +1,81 @@
+import os
+from typing import NamedTuple, Optional
+
+
+class MemorySettings(NamedTuple):
+    """Knobs trading speed for peak memory of a generation."""
+
+    # Points per triplane query, for mesh extraction, rendering and baking
+    chunk_size: int
+    # Rays rendered per renderer call
+    max_rays_per_batch: int
+    # Tokens per backbone feed-forward call, None for all at once
+    ff_chunk_size: Optional[int]
+    # Attention heads per attention call, None for all at once
+    attention_slice_size: Optional[int]
+
+
+# Settings by memory available per concurrent generation, on top of the
+# weights, from the largest budget to the smallest. Peaks at TripoSR size:
+# the gif rendering holds ~400MB of samples at 65536 rays per batch, a
+# backbone block ~300MB per image (~180MB with feed-forward chunks of 256
+# tokens), and streaming mesh extraction ~150MB at resolution 256.
+MEMORY_TIERS = [
+    (2 * 1024**3, MemorySettings(14336, 65536, None, None)),
+    (1024**3, MemorySettings(8192, 32768, 1024, None)),
+    (512 * 1024**2, MemorySettings(4096, 16384, 512, 4)),
+    (0, MemorySettings(2048, 8192, 256, 1)),
+]
+
+
+def _read_int(path: str) -> Optional[int]:
+    try:
+        with open(path) as f:
+            value = f.read().strip()
+    except OSError:
+        return None
+    # cgroup v2 writes "max" when there is no limit
+    return int(value) if value.isdigit() else None
+
+
+def available_memory() -> Optional[int]:
+    """
+    Bytes this process can still allocate: the cgroup (container) memory
+    limit minus its current usage when there is a limit, otherwise the
+    MemAvailable of the host. None when neither can be read.
+    """
+    for limit_path, usage_path in (
+        ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory.current"),
+        (
+            "/sys/fs/cgroup/memory/memory.limit_in_bytes",
+            "/sys/fs/cgroup/memory/memory.usage_in_bytes",
+        ),
+    ):
+        limit = _read_int(limit_path)
+        # cgroup v1 reports a huge number when there is no limit
+        if limit is None or limit >= 1 << 60:
+            continue
+        usage = _read_int(usage_path) or 0
+        return max(limit - usage, 0)
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def select_memory_settings(budget: Optional[int], workers: int = 1) -> MemorySettings:
+    """
+    Settings for `workers` concurrent generations sharing `budget` bytes,
+    the largest tier that fits. Without a budget, the fastest settings.
+    """
+    if budget is None:
+        return MEMORY_TIERS[0][1]
+    per_worker = budget // max(workers, 1)
+    for min_budget, settings in MEMORY_TIERS:
+        if per_worker >= min_budget:
+            return settings
+    return MEMORY_TIERS[-1][1]
@@ -1,10 +1,55 @@
-from typing import Callable, Optional, Tuple
+from functools import lru_cache, reduce
+from typing import Callable, Iterator, NamedTuple, Optional, Tuple
 
 import numpy as np
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from torchmcubes import marching_cubes
 
+from ..utils import scale_tensor
+
+
+@lru_cache(maxsize=16)
+def grid_axis(
+    resolution: int,
+    points_range: Tuple[float, float],
+    target_range: Optional[Tuple[float, float]] = None,
+    device: torch.device = torch.device("cpu"),
+    dtype: torch.dtype = torch.float32,
+) -> torch.FloatTensor:
+    """Coordinates of the grid planes along one axis, scaled to `target_range`."""
+    axis = torch.linspace(*points_range, resolution)
+    if target_range is not None:
+        axis = scale_tensor(axis, points_range, target_range)
+    return axis.to(device, dtype)
+
+
+def grid_coordinates(
+    resolution: int,
+    points_range: Tuple[float, float],
+    target_range: Optional[Tuple[float, float]] = None,
+    device: torch.device = torch.device("cpu"),
+    dtype: torch.dtype = torch.float32,
+) -> torch.FloatTensor:
+    """
+    All the `resolution`^3 grid vertices, scaled to `target_range`. Built on
+    demand and not cached: at 256 they take 200MB. Mesh extraction does not
+    use them, it queries slabs built from the cached `grid_axis`.
+    """
+    axis = grid_axis(resolution, points_range, target_range, device, dtype)
+    return torch.stack(torch.meshgrid(axis, axis, axis, indexing="ij"), dim=-1).view(
+        -1, 3
+    )
+
+
+class CoarseGrid(NamedTuple):
+    axis: torch.FloatTensor  # grid coordinates along one axis
+    k: torch.LongTensor  # coarse cell of each grid vertex along one axis
+    t: torch.FloatTensor  # position of each grid vertex in its coarse cell
+    values: torch.FloatTensor  # coarse planes, interpolated along the last two axes
+    cells: torch.BoolTensor  # coarse cells to refine, by grid cell on the last axes
+
 
 class IsosurfaceHelper(nn.Module):
     points_range: Tuple[float, float] = (0, 1)
@@ -19,34 +64,261 @@ class MarchingCubeHelper(IsosurfaceHelper):
         super().__init__()
         self.resolution = resolution
         self.mc_func: Callable = marching_cubes
-        self._grid_vertices: Optional[torch.FloatTensor] = None
 
     @property
     def grid_vertices(self) -> torch.FloatTensor:
-        if self._grid_vertices is None:
-            # keep the vertices on CPU so that we can support very large resolution
-            x, y, z = (
-                torch.linspace(*self.points_range, self.resolution),
-                torch.linspace(*self.points_range, self.resolution),
-                torch.linspace(*self.points_range, self.resolution),
+        # keep the vertices on CPU so that we can support very large resolution
+        return grid_coordinates(self.resolution, self.points_range)
+
+    def scaled_grid_vertices(
+        self,
+        target_range: Tuple[float, float],
+        device: torch.device = torch.device("cpu"),
+        dtype: torch.dtype = torch.float32,
+    ) -> torch.FloatTensor:
+        return grid_coordinates(
+            self.resolution, self.points_range, target_range, device, dtype
+        )
+
+    def slab_ranges(self, max_points: int = 1 << 20) -> Iterator[Tuple[int, int]]:
+        """Ranges of planes along the first axis of at most `max_points` vertices."""
+        planes = max(1, max_points // self.resolution**2)
+        for start in range(0, self.resolution, planes):
+            yield start, min(start + planes, self.resolution)
+
+    def plane_vertices(
+        self,
+        target_range: Tuple[float, float],
+        start: int,
+        stop: int,
+        device: torch.device = torch.device("cpu"),
+        dtype: torch.dtype = torch.float32,
+    ) -> torch.FloatTensor:
+        """The grid vertices of planes [start, stop), scaled to `target_range`."""
+        axis = grid_axis(
+            self.resolution, self.points_range, target_range, device, dtype
+        )
+        planes = torch.meshgrid(axis[start:stop], axis, axis, indexing="ij")
+        return torch.stack(planes, dim=-1).view(-1, 3)
+
+    def grid_slabs(
+        self,
+        target_range: Tuple[float, float],
+        max_points: int = 1 << 20,
+        device: torch.device = torch.device("cpu"),
+        dtype: torch.dtype = torch.float32,
+    ) -> Iterator[Tuple[int, torch.FloatTensor]]:
+        """
+        Yields the grid vertices scaled to `target_range` by slabs of planes
+        along the first axis, at most `max_points` at a time, along with the
+        index of the first plane of the slab. Slabs are contiguous parts of
+        `grid_vertices`, built on the fly so the whole grid is never in memory.
+        """
+        for start, stop in self.slab_ranges(max_points):
+            yield start, self.plane_vertices(target_range, start, stop, device, dtype)
+
+    def coarse_grid(
+        self,
+        query: Callable[[torch.FloatTensor], torch.FloatTensor],
+        target_range: Tuple[float, float],
+        stride: int = 4,
+    ) -> CoarseGrid:
+        """
+        Evaluates `query` (signed, the surface being at 0) on a coarse grid
+        made of every `stride`-th vertex, see `refine_planes`. `query` is given
+        grid vertices scaled to `target_range`.
+        """
+        res = self.resolution
+        coarse = torch.arange(0, res, stride)
+        if coarse[-1] != res - 1:
+            coarse = torch.cat([coarse, torch.tensor([res - 1])])
+        nc = len(coarse)
+        axis = grid_axis(res, self.points_range, target_range)
+        cx, cy, cz = torch.meshgrid(
+            axis[coarse], axis[coarse], axis[coarse], indexing="ij"
+        )
+        coarse_values = query(torch.stack([cx, cy, cz], dim=-1).view(-1, 3))
+        device = coarse_values.device
+        coarse_values = coarse_values.view(nc, nc, nc)
+
+        # Coarse cells straddling the surface, and their neighbours
+        positive = coarse_values > 0
+        corners = [
+            positive[dx : nc - 1 + dx, dy : nc - 1 + dy, dz : nc - 1 + dz]
+            for dx in (0, 1)
+            for dy in (0, 1)
+            for dz in (0, 1)
+        ]
+        cells = reduce(torch.logical_or, corners) & ~reduce(torch.logical_and, corners)
+        cells = (
+            F.max_pool3d(cells[None, None].float(), 3, stride=1, padding=1)[0, 0] > 0
+        )
+
+        # Grid vertex i lies in coarse cell k[i], at fraction t[i] of it
+        i = torch.arange(res)
+        k = (torch.bucketize(i, coarse, right=True) - 1).clamp(max=nc - 2)
+        t = (i - coarse[k]) / (coarse[k + 1] - coarse[k])
+        t = t.to(device, coarse_values.dtype)
+        k = k.to(device)
+        # Interpolated along the last two axes once, the first axis is done by slab
+        values = coarse_values
+        for dim in (2, 1):
+            shape = [1, 1, 1]
+            shape[dim] = res
+            values = torch.lerp(
+                values.index_select(dim, k),
+                values.index_select(dim, k + 1),
+                t.view(shape),
             )
-            x, y, z = torch.meshgrid(x, y, z, indexing="ij")
-            verts = torch.cat(
-                [x.reshape(-1, 1), y.reshape(-1, 1), z.reshape(-1, 1)], dim=-1
-            ).reshape(-1, 3)
-            self._grid_vertices = verts
-        return self._grid_vertices
+        kc = k[:-1]
+        cells = cells.index_select(1, kc).index_select(2, kc)
+        return CoarseGrid(axis=axis, k=k, t=t, values=values, cells=cells)
 
-    def forward(
+    def refine_planes(
         self,
-        level: torch.FloatTensor,
+        query: Callable[[torch.FloatTensor], torch.FloatTensor],
+        coarse: CoarseGrid,
+        start: int,
+        stop: int,
+    ) -> torch.FloatTensor:
+        """
+        Values of `query` on planes [start, stop) of the grid, evaluated
+        exactly only near the surface found on the coarse grid.
+
+        Coarse cells whose corners do not all have the same sign, and their
+        neighbours, are refined: `query` is evaluated at all the grid vertices
+        inside them. Elsewhere the values are trilinearly interpolated from
+        the coarse grid, which keeps their sign, so marching cubes only finds
+        the surface in the refined cells.
+        """
+        res = self.resolution
+        k, t = coarse.k[start:stop], coarse.t[start:stop]
+        values = torch.lerp(
+            coarse.values.index_select(0, k),
+            coarse.values.index_select(0, k + 1),
+            t.view(-1, 1, 1),
+        )
+
+        # Grid cell j lies in coarse cell k[j], refine the vertices of its 8 corners
+        lo, hi = max(start - 1, 0), min(stop, res - 1)
+        fine_cells = coarse.cells.index_select(0, coarse.k[lo:hi])
+        refine = torch.zeros_like(values, dtype=torch.bool)
+        for dx in (0, 1):
+            j0, j1 = max(start - dx, lo), min(stop - dx, hi)
+            if j1 <= j0:
+                continue
+            cells = fine_cells[j0 - lo : j1 - lo]
+            planes = slice(j0 + dx - start, j1 + dx - start)
+            for dy in (0, 1):
+                for dz in (0, 1):
+                    refine[planes, dy : res - 1 + dy, dz : res - 1 + dz] |= cells
+        indices = refine.nonzero()
+        if len(indices) > 0:
+            positions = torch.stack(
+                [
+                    coarse.axis[indices[:, 0].cpu() + start],
+                    coarse.axis[indices[:, 1].cpu()],
+                    coarse.axis[indices[:, 2].cpu()],
+                ],
+                dim=-1,
+            )
+            refined = query(positions).to(values)
+            values[indices[:, 0], indices[:, 1], indices[:, 2]] = refined
+        return values.view(-1)
+
+    def coarse_to_fine(
+        self,
+        query: Callable[[torch.FloatTensor], torch.FloatTensor],
+        target_range: Tuple[float, float],
+        stride: int = 4,
+    ) -> torch.FloatTensor:
+        """
+        Values of `query` (signed, the surface being at 0) on the whole grid,
+        evaluated exactly only near the surface, see `refine_planes`.
+        """
+        coarse = self.coarse_grid(query, target_range, stride)
+        return self.refine_planes(query, coarse, 0, self.resolution)
+
+    def stream(
+        self,
+        level_planes: Callable[[int, int], torch.FloatTensor],
+        max_points: int = 1 << 20,
     ) -> Tuple[torch.FloatTensor, torch.LongTensor]:
-        level = -level.view(self.resolution, self.resolution, self.resolution)
+        """
+        Same as `forward`, but the level of planes [start, stop) is requested
+        from `level_planes` slab by slab, and marching cubes runs on each slab
+        along with the last plane of the previous one. The vertices on that
+        shared plane are produced by both slabs and merged, so only a slab of
+        the level volume is ever in memory.
+        """
+        res = self.resolution
+        vertices, faces = [], []
+        n_vertices = 0
+        shared_level = None
+        shared_keys = shared_ids = None
+        for start, stop in self.slab_ranges(max_points):
+            level = level_planes(start, stop).view(stop - start, res, res)
+            offset = start
+            if shared_level is not None:
+                level = torch.cat([shared_level, level])
+                offset = start - 1
+            shared_level = level[-1:]
+            if level.shape[0] < 2:
+                continue
+            v_pos, t_pos_idx = self._marching_cubes(level)
+            v_pos[:, 0] += offset
+            t_pos_idx = t_pos_idx.long()
+
+            ids = torch.empty(len(v_pos), dtype=torch.long, device=v_pos.device)
+            keep = torch.ones(len(v_pos), dtype=torch.bool, device=v_pos.device)
+            first = (v_pos[:, 0] == offset).nonzero()[:, 0]
+            if shared_keys is not None and len(shared_keys) > 0 and len(first) > 0:
+                order = torch.argsort(shared_keys)
+                keys = self._plane_keys(v_pos[first])
+                pos = torch.searchsorted(shared_keys[order], keys).clamp(
+                    max=len(order) - 1
+                )
+                found = shared_keys[order][pos] == keys
+                ids[first[found]] = shared_ids[order[pos[found]]]
+                keep[first[found]] = False
+            ids[keep] = n_vertices + torch.arange(int(keep.sum()), device=v_pos.device)
+            n_vertices += int(keep.sum())
+            vertices.append(v_pos[keep])
+            faces.append(ids[t_pos_idx])
+
+            last = (v_pos[:, 0] == offset + level.shape[0] - 1).nonzero()[:, 0]
+            shared_keys = self._plane_keys(v_pos[last])
+            shared_ids = ids[last]
+
+        if not vertices:
+            return torch.zeros(0, 3), torch.zeros(0, 3, dtype=torch.long)
+        v_pos = torch.cat(vertices) / (res - 1.0)
+        return v_pos, torch.cat(faces)
+
+    @staticmethod
+    def _plane_keys(v_pos: torch.FloatTensor) -> torch.LongTensor:
+        # Vertices of a plane by their in-plane coordinates, up to rounding
+        quantized = torch.round(v_pos[:, 1:] * 2**16).long()
+        return quantized[:, 0] * 2**32 + quantized[:, 1]
+
+    def _marching_cubes(
+        self, level: torch.FloatTensor
+    ) -> Tuple[torch.FloatTensor, torch.LongTensor]:
+        level = -level
         try:
             v_pos, t_pos_idx = self.mc_func(level.detach(), 0.0)
         except AttributeError:
             print("torchmcubes was not compiled with CUDA support, use CPU version instead.")
             v_pos, t_pos_idx = self.mc_func(level.detach().cpu(), 0.0)
-        v_pos = v_pos[..., [2, 1, 0]]
+        # Vertices in grid index order
+        return v_pos[..., [2, 1, 0]], t_pos_idx
+
+    def forward(
+        self,
+        level: torch.FloatTensor,
+    ) -> Tuple[torch.FloatTensor, torch.LongTensor]:
+        v_pos, t_pos_idx = self._marching_cubes(
+            level.view(self.resolution, self.resolution, self.resolution)
+        )
         v_pos = v_pos / (self.resolution - 1.0)
         return v_pos.to(level.device), t_pos_idx.to(level.device)
@@ -1,9 +1,11 @@
+import functools
+import logging
+import time
 from dataclasses import dataclass
-from typing import Dict
+from typing import Dict, Optional
 
 import torch
 import torch.nn.functional as F
-from einops import rearrange, reduce
 
 from ..utils import (
     BaseModule,
@@ -14,6 +16,37 @@ from ..utils import (
 )
 
 
+class TriplaneQuery(torch.nn.Module):
+    """
+    Samples a triplane at positions (N, 3) already normalized to (-1, 1) and
+    decodes the features. Only uses shape-agnostic tensor ops, so that it can
+    be compiled or traced once and run on chunks of any size.
+    """
+
+    def __init__(self, decoder: torch.nn.Module, feature_reduction: str):
+        super().__init__()
+        self.decoder = decoder
+        self.feature_reduction = feature_reduction
+
+    def forward(
+        self, triplane: torch.Tensor, positions: torch.Tensor
+    ) -> Dict[str, torch.Tensor]:
+        indices2D = torch.stack(
+            (positions[:, [0, 1]], positions[:, [0, 2]], positions[:, [1, 2]]),
+            dim=0,
+        )
+        out = F.grid_sample(
+            triplane, indices2D[:, None], align_corners=False, mode="bilinear"
+        )[:, :, 0]
+        if self.feature_reduction == "concat":
+            out = out.permute(2, 0, 1).flatten(1)
+        elif self.feature_reduction == "mean":
+            out = out.mean(dim=0).transpose(0, 1)
+        else:
+            raise NotImplementedError
+        return self.decoder(out)
+
+
 class TriplaneNeRFRenderer(BaseModule):
     @dataclass
     class Config(BaseModule.Config):
@@ -26,11 +59,20 @@ class TriplaneNeRFRenderer(BaseModule):
         num_samples_per_ray: int = 128
         randomized: bool = False
 
+        # Empty-space skipping, used when an occupancy grid is given
+        occupancy_grid_resolution: int = 64
+        occupancy_density_threshold: float = 0.1
+        occupancy_dilation: int = 1
+        samples_per_segment: int = 16
+        early_termination_transmittance: float = 1e-3
+
     cfg: Config
 
     def configure(self) -> None:
         assert self.cfg.feature_reduction in ["concat", "mean"]
         self.chunk_size = 0
+        # (decoder, kernel) set by compile_query
+        self.query_kernel = None
 
     def set_chunk_size(self, chunk_size: int):
         assert (
@@ -38,12 +80,89 @@ class TriplaneNeRFRenderer(BaseModule):
         ), "chunk_size must be a non-negative integer (0 for no chunking)."
         self.chunk_size = chunk_size
 
+    def compile_query(
+        self,
+        decoder: torch.nn.Module,
+        triplane: torch.Tensor,
+        chunk_size: int,
+        n_repeats: int = 3,
+    ) -> str:
+        """
+        Compiles the `TriplaneQuery` of `decoder`, with `torch.compile` and by
+        tracing it with TorchScript, and keeps the fastest of these kernels
+        and the eager module. Every kernel is warmed up on `triplane` with a
+        full chunk and a partial one, checked against the eager outputs and
+        timed on `n_repeats` full chunks, so a backend that fails or is slower
+        on this machine is simply not used. Returns the backend kept.
+        """
+        self.query_kernel = None
+        kernel = TriplaneQuery(decoder, self.cfg.feature_reduction)
+        positions = (
+            torch.rand(
+                max(chunk_size, 2), 3, device=triplane.device, dtype=triplane.dtype
+            )
+            * 2
+            - 1
+        )
+        candidates = [("eager", lambda: kernel)]
+        if hasattr(torch, "compile"):
+            candidates.append(("compile", lambda: torch.compile(kernel, dynamic=True)))
+        candidates.append(
+            (
+                "trace",
+                lambda: torch.jit.trace(
+                    kernel, (triplane, positions), strict=False, check_trace=False
+                ),
+            )
+        )
+
+        def elapsed(compiled):
+            if triplane.is_cuda:
+                torch.cuda.synchronize()
+            start_time = time.perf_counter()
+            for _ in range(n_repeats):
+                compiled(triplane, positions)
+            if triplane.is_cuda:
+                torch.cuda.synchronize()
+            return time.perf_counter() - start_time
+
+        best, best_time = "eager", None
+        for backend, build in candidates:
+            try:
+                with torch.no_grad():
+                    compiled = build()
+                    for x in (positions, positions[: positions.shape[0] // 2]):
+                        expected = kernel(triplane, x)
+                        for k, v in compiled(triplane, x).items():
+                            torch.testing.assert_close(
+                                v, expected[k], rtol=1e-3, atol=1e-3
+                            )
+                    t = elapsed(compiled)
+            except Exception as e:
+                logging.warning(f"Could not {backend} the triplane query: {e}")
+                continue
+            logging.info(
+                f"Triplane query with {backend}: {t / n_repeats * 1000.0:.2f}ms "
+                f"per chunk of {positions.shape[0]}"
+            )
+            if best_time is None or t < best_time:
+                best, best_time = backend, t
+                self.query_kernel = None if backend == "eager" else (decoder, compiled)
+        return best
+
     def query_triplane(
         self,
         decoder: torch.nn.Module,
         positions: torch.Tensor,
         triplane: torch.Tensor,
+        chunk_size: Optional[int] = None,
     ) -> Dict[str, torch.Tensor]:
+        """
+        Density and color at `positions`, queried `chunk_size` points at a
+        time (default: the chunk size of the renderer).
+        """
+        if chunk_size is None:
+            chunk_size = self.chunk_size
         input_shape = positions.shape[:-1]
         positions = positions.view(-1, 3)
 
@@ -53,29 +172,15 @@ class TriplaneNeRFRenderer(BaseModule):
             positions, (-self.cfg.radius, self.cfg.radius), (-1, 1)
         )
 
-        def _query_chunk(x):
-            indices2D: torch.Tensor = torch.stack(
-                (x[..., [0, 1]], x[..., [0, 2]], x[..., [1, 2]]),
-                dim=-3,
-            )
-            out: torch.Tensor = F.grid_sample(
-                rearrange(triplane, "Np Cp Hp Wp -> Np Cp Hp Wp", Np=3),
-                rearrange(indices2D, "Np N Nd -> Np () N Nd", Np=3),
-                align_corners=False,
-                mode="bilinear",
+        if self.query_kernel is not None and self.query_kernel[0] is decoder:
+            _query_chunk = functools.partial(self.query_kernel[1], triplane)
+        else:
+            _query_chunk = functools.partial(
+                TriplaneQuery(decoder, self.cfg.feature_reduction), triplane
             )
-            if self.cfg.feature_reduction == "concat":
-                out = rearrange(out, "Np Cp () N -> N (Np Cp)", Np=3)
-            elif self.cfg.feature_reduction == "mean":
-                out = reduce(out, "Np Cp () N -> N Cp", Np=3, reduction="mean")
-            else:
-                raise NotImplementedError
-
-            net_out: Dict[str, torch.Tensor] = decoder(out)
-            return net_out
-
-        if self.chunk_size > 0:
-            net_out = chunk_batch(_query_chunk, self.chunk_size, positions)
+
+        if chunk_size > 0:
+            net_out = chunk_batch(_query_chunk, chunk_size, positions)
         else:
             net_out = _query_chunk(positions)
 
@@ -90,12 +195,100 @@ class TriplaneNeRFRenderer(BaseModule):
 
         return net_out
 
+    def build_occupancy_grid(
+        self,
+        decoder: torch.nn.Module,
+        triplane: torch.Tensor,
+        chunk_size: Optional[int] = None,
+    ) -> torch.BoolTensor:
+        """
+        Coarse occupancy of the bounding box: the density is queried at the
+        cell centers of a `occupancy_grid_resolution`^3 grid, and cells above
+        `occupancy_density_threshold` are marked occupied, along with their
+        `occupancy_dilation` neighbours so that thin structures between cell
+        centers are not skipped.
+        """
+        resolution = self.cfg.occupancy_grid_resolution
+        centers = (
+            torch.arange(resolution, device=triplane.device, dtype=triplane.dtype) + 0.5
+        ) / resolution * 2 * self.cfg.radius - self.cfg.radius
+        cells = torch.stack(
+            torch.meshgrid(centers, centers, centers, indexing="ij"), -1
+        )
+        density = self.query_triplane(decoder, cells.view(-1, 3), triplane, chunk_size)[
+            "density_act"
+        ].view(resolution, resolution, resolution)
+        occupied = density > self.cfg.occupancy_density_threshold
+        if self.cfg.occupancy_dilation > 0:
+            occupied = (
+                F.max_pool3d(
+                    occupied[None, None].float(),
+                    kernel_size=2 * self.cfg.occupancy_dilation + 1,
+                    stride=1,
+                    padding=self.cfg.occupancy_dilation,
+                )[0, 0]
+                > 0
+            )
+        return occupied
+
+    def lookup_occupancy(
+        self, occupancy_grid: torch.BoolTensor, positions: torch.Tensor
+    ) -> torch.BoolTensor:
+        resolution = occupancy_grid.shape[0]
+        indices = (
+            ((positions + self.cfg.radius) / (2 * self.cfg.radius) * resolution)
+            .long()
+            .clamp(0, resolution - 1)
+        )
+        return occupancy_grid[indices[..., 0], indices[..., 1], indices[..., 2]]
+
+    def query_samples(
+        self,
+        decoder: torch.nn.Module,
+        triplane: torch.Tensor,
+        xyz: torch.Tensor,
+        deltas: torch.Tensor,
+        occupancy_grid: torch.BoolTensor,
+        chunk_size: Optional[int] = None,
+    ) -> Dict[str, torch.Tensor]:
+        """
+        Same outputs as `query_triplane` on all the samples of the rays, but
+        the decoder only runs on samples in occupied cells, and the samples
+        of a ray are no longer evaluated once its transmittance is below
+        `early_termination_transmittance`. Rays are walked in segments of
+        `samples_per_segment` samples; skipped samples have no density.
+        """
+        n_rays, n_samples = xyz.shape[:2]
+        density_act = torch.zeros(
+            n_rays, n_samples, 1, dtype=xyz.dtype, device=xyz.device
+        )
+        color = torch.zeros(n_rays, n_samples, 3, dtype=xyz.dtype, device=xyz.device)
+        occupied = self.lookup_occupancy(occupancy_grid, xyz)
+        transmittance = torch.ones(n_rays, dtype=xyz.dtype, device=xyz.device)
+        for start in range(0, n_samples, self.cfg.samples_per_segment):
+            segment = slice(start, start + self.cfg.samples_per_segment)
+            active = transmittance > self.cfg.early_termination_transmittance
+            if not active.any():
+                break
+            mask = occupied[:, segment] & active[:, None]
+            if mask.any():
+                out = self.query_triplane(
+                    decoder, xyz[:, segment][mask], triplane, chunk_size
+                )
+                density_act[:, segment][mask] = out["density_act"]
+                color[:, segment][mask] = out["color"]
+            alpha = 1 - torch.exp(-deltas[segment] * density_act[:, segment, 0])
+            transmittance = transmittance * torch.prod(1 - alpha, dim=-1)
+        return {"density_act": density_act, "color": color}
+
     def _forward(
         self,
         decoder: torch.nn.Module,
         triplane: torch.Tensor,
         rays_o: torch.Tensor,
         rays_d: torch.Tensor,
+        occupancy_grid: Optional[torch.BoolTensor] = None,
+        chunk_size: Optional[int] = None,
         **kwargs,
     ):
         rays_shape = rays_o.shape[:-1]
@@ -104,7 +297,11 @@ class TriplaneNeRFRenderer(BaseModule):
         n_rays = rays_o.shape[0]
 
         t_near, t_far, rays_valid = rays_intersect_bbox(rays_o, rays_d, self.cfg.radius)
+        if not rays_valid.any():
+            # No ray hits the bounding box, e.g. a batch of border pixels
+            return torch.ones(*rays_shape, 3, dtype=rays_o.dtype, device=rays_o.device)
         t_near, t_far = t_near[rays_valid], t_far[rays_valid]
+        rays_o, rays_d = rays_o[rays_valid], rays_d[rays_valid]
 
         t_vals = torch.linspace(
             0, 1, self.cfg.num_samples_per_ray + 1, device=triplane.device
@@ -116,15 +313,21 @@ class TriplaneNeRFRenderer(BaseModule):
             rays_o[:, None, :] + z_vals[..., None] * rays_d[..., None, :]
         )  # (N_rays, N_sample, 3)
 
-        mlp_out = self.query_triplane(
-            decoder=decoder,
-            positions=xyz,
-            triplane=triplane,
-        )
-
         eps = 1e-10
         # deltas = z_vals[:, 1:] - z_vals[:, :-1] # (N_rays, N_samples)
         deltas = t_vals[1:] - t_vals[:-1]  # (N_rays, N_samples)
+
+        if occupancy_grid is None:
+            mlp_out = self.query_triplane(
+                decoder=decoder,
+                positions=xyz,
+                triplane=triplane,
+                chunk_size=chunk_size,
+            )
+        else:
+            mlp_out = self.query_samples(
+                decoder, triplane, xyz, deltas, occupancy_grid, chunk_size
+            )
         alpha = 1 - torch.exp(
             -deltas * mlp_out["density_act"][..., 0]
         )  # (N_rays, N_samples)
@@ -157,13 +360,28 @@ class TriplaneNeRFRenderer(BaseModule):
         triplane: torch.Tensor,
         rays_o: torch.Tensor,
         rays_d: torch.Tensor,
+        occupancy_grid: Optional[torch.BoolTensor] = None,
+        chunk_size: Optional[int] = None,
     ) -> Dict[str, torch.Tensor]:
+        """
+        Renders the rays, querying the triplane `chunk_size` points at a time
+        (default: the chunk size of the renderer).
+        """
         if triplane.ndim == 4:
-            comp_rgb = self._forward(decoder, triplane, rays_o, rays_d)
+            comp_rgb = self._forward(
+                decoder, triplane, rays_o, rays_d, occupancy_grid, chunk_size
+            )
         else:
             comp_rgb = torch.stack(
                 [
-                    self._forward(decoder, triplane[i], rays_o[i], rays_d[i])
+                    self._forward(
+                        decoder,
+                        triplane[i],
+                        rays_o[i],
+                        rays_d[i],
+                        None if occupancy_grid is None else occupancy_grid[i],
+                        chunk_size,
+                    )
                     for i in range(triplane.shape[0])
                 ],
                 dim=0,
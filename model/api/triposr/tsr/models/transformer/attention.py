@@ -121,6 +121,7 @@ class Attention(nn.Module):
         super().__init__()
         self.inner_dim = out_dim if out_dim is not None else dim_head * heads
         self.query_dim = query_dim
+        self.is_cross_attention = cross_attention_dim is not None
         self.cross_attention_dim = (
             cross_attention_dim if cross_attention_dim is not None else query_dim
         )
@@ -144,6 +145,7 @@ class Attention(nn.Module):
         # is split across the batch axis to save memory
         # You can set slice_size with `set_attention_slice`
         self.sliceable_head_dim = heads
+        self.slice_size = None
 
         self.added_kv_proj_dim = added_kv_proj_dim
         self.only_cross_attention = only_cross_attention
@@ -221,6 +223,20 @@ class Attention(nn.Module):
             )
         self.set_processor(processor)
 
+    def set_attention_slice(self, slice_size: Optional[int]) -> None:
+        """
+        Computes the attention `slice_size` heads at a time (None for all at
+        once). This bounds the memory of the attention scores where they are
+        materialized, in `AttnProcessor`; `scaled_dot_product_attention` does
+        not materialize them on most backends, so there it only trades a
+        little speed.
+        """
+        if slice_size is not None and not 0 < slice_size <= self.sliceable_head_dim:
+            raise ValueError(
+                f"slice_size {slice_size} has to be between 1 and {self.sliceable_head_dim}."
+            )
+        self.slice_size = slice_size
+
     def set_processor(self, processor: "AttnProcessor") -> None:
         self.processor = processor
 
@@ -448,37 +464,82 @@ class Attention(nn.Module):
 
     @torch.no_grad()
     def fuse_projections(self, fuse=True):
-        is_cross_attention = self.cross_attention_dim != self.query_dim
-        device = self.to_q.weight.data.device
-        dtype = self.to_q.weight.data.dtype
-
-        if not is_cross_attention:
-            # fetch weight matrices.
-            concatenated_weights = torch.cat(
-                [self.to_q.weight.data, self.to_k.weight.data, self.to_v.weight.data]
+        """
+        Concatenates the query, key and value projections into `to_qkv` for
+        self-attention, or the key and value projections into `to_kv` for
+        cross-attention, so that `project_qkv` runs one GEMM instead of three
+        or two. The weights of the separate projections become views of the
+        fused ones, so fusing takes no extra memory.
+        """
+        if self.is_cross_attention:
+            names, fused_name = ["to_k", "to_v"], "to_kv"
+        else:
+            names, fused_name = ["to_q", "to_k", "to_v"], "to_qkv"
+        layers = [getattr(self, name) for name in names]
+        weight = torch.cat([layer.weight for layer in layers])
+        has_bias = layers[0].bias is not None
+        fused = self.linear_cls(
+            weight.shape[1],
+            weight.shape[0],
+            bias=has_bias,
+            device=weight.device,
+            dtype=weight.dtype,
+        )
+        fused.weight.copy_(weight)
+        if has_bias:
+            fused.bias.copy_(torch.cat([layer.bias for layer in layers]))
+        fused.requires_grad_(layers[0].weight.requires_grad)
+
+        start = 0
+        for layer in layers:
+            stop = start + layer.out_features
+            layer.weight = nn.Parameter(
+                fused.weight[start:stop], requires_grad=fused.weight.requires_grad
             )
-            in_features = concatenated_weights.shape[1]
-            out_features = concatenated_weights.shape[0]
+            if has_bias:
+                layer.bias = nn.Parameter(
+                    fused.bias[start:stop], requires_grad=fused.bias.requires_grad
+                )
+            start = stop
+        setattr(self, fused_name, fused)
 
-            # create a new single projection layer and copy over the weights.
-            self.to_qkv = self.linear_cls(
-                in_features, out_features, bias=False, device=device, dtype=dtype
-            )
-            self.to_qkv.weight.copy_(concatenated_weights)
+        self.fused_projections = fuse
 
-        else:
-            concatenated_weights = torch.cat(
-                [self.to_k.weight.data, self.to_v.weight.data]
-            )
-            in_features = concatenated_weights.shape[1]
-            out_features = concatenated_weights.shape[0]
+    def project_qkv(
+        self,
+        hidden_states: torch.Tensor,
+        encoder_hidden_states: Optional[torch.Tensor] = None,
+        query: Optional[torch.Tensor] = None,
+    ):
+        """
+        Query, key and value projections of the processors, through the fused
+        `to_qkv` or `to_kv` projection when `fuse_projections` was called. A
+        `query` computed beforehand with `to_q` is used as is.
+        """
+        if (
+            self.fused_projections
+            and encoder_hidden_states is None
+            and query is None
+            and hasattr(self, "to_qkv")
+        ):
+            return self.to_qkv(hidden_states).chunk(3, dim=-1)
 
-            self.to_kv = self.linear_cls(
-                in_features, out_features, bias=False, device=device, dtype=dtype
+        if query is None:
+            query = self.to_q(hidden_states)
+
+        if encoder_hidden_states is None:
+            encoder_hidden_states = hidden_states
+        elif self.norm_cross:
+            encoder_hidden_states = self.norm_encoder_hidden_states(
+                encoder_hidden_states
             )
-            self.to_kv.weight.copy_(concatenated_weights)
 
-        self.fused_projections = fuse
+        if self.fused_projections and hasattr(self, "to_kv"):
+            key, value = self.to_kv(encoder_hidden_states).chunk(2, dim=-1)
+        else:
+            key = self.to_k(encoder_hidden_states)
+            value = self.to_v(encoder_hidden_states)
+        return query, key, value
 
 
 class AttnProcessor:
@@ -492,6 +553,7 @@ class AttnProcessor:
         hidden_states: torch.FloatTensor,
         encoder_hidden_states: Optional[torch.FloatTensor] = None,
         attention_mask: Optional[torch.FloatTensor] = None,
+        query: Optional[torch.FloatTensor] = None,
     ) -> torch.Tensor:
         residual = hidden_states
 
@@ -517,24 +579,30 @@ class AttnProcessor:
                 1, 2
             )
 
-        query = attn.to_q(hidden_states)
-
-        if encoder_hidden_states is None:
-            encoder_hidden_states = hidden_states
-        elif attn.norm_cross:
-            encoder_hidden_states = attn.norm_encoder_hidden_states(
-                encoder_hidden_states
-            )
-
-        key = attn.to_k(encoder_hidden_states)
-        value = attn.to_v(encoder_hidden_states)
+        query, key, value = attn.project_qkv(
+            hidden_states, encoder_hidden_states, query
+        )
 
         query = attn.head_to_batch_dim(query)
         key = attn.head_to_batch_dim(key)
         value = attn.head_to_batch_dim(value)
 
-        attention_probs = attn.get_attention_scores(query, key, attention_mask)
-        hidden_states = torch.bmm(attention_probs, value)
+        if attn.slice_size is None:
+            attention_probs = attn.get_attention_scores(query, key, attention_mask)
+            hidden_states = torch.bmm(attention_probs, value)
+        else:
+            # query is (batch_size * heads, seq_len, head_dim)
+            hidden_states = query.new_empty(
+                query.shape[0], query.shape[1], value.shape[-1]
+            )
+            for start in range(0, query.shape[0], attn.slice_size):
+                end = start + attn.slice_size
+                attention_probs = attn.get_attention_scores(
+                    query[start:end],
+                    key[start:end],
+                    None if attention_mask is None else attention_mask[start:end],
+                )
+                hidden_states[start:end] = torch.bmm(attention_probs, value[start:end])
         hidden_states = attn.batch_to_head_dim(hidden_states)
 
         # linear proj
@@ -572,6 +640,7 @@ class AttnProcessor2_0:
         hidden_states: torch.FloatTensor,
         encoder_hidden_states: Optional[torch.FloatTensor] = None,
         attention_mask: Optional[torch.FloatTensor] = None,
+        query: Optional[torch.FloatTensor] = None,
     ) -> torch.FloatTensor:
         residual = hidden_states
 
@@ -604,17 +673,9 @@ class AttnProcessor2_0:
                 1, 2
             )
 
-        query = attn.to_q(hidden_states)
-
-        if encoder_hidden_states is None:
-            encoder_hidden_states = hidden_states
-        elif attn.norm_cross:
-            encoder_hidden_states = attn.norm_encoder_hidden_states(
-                encoder_hidden_states
-            )
-
-        key = attn.to_k(encoder_hidden_states)
-        value = attn.to_v(encoder_hidden_states)
+        query, key, value = attn.project_qkv(
+            hidden_states, encoder_hidden_states, query
+        )
 
         inner_dim = key.shape[-1]
         head_dim = inner_dim // attn.heads
@@ -626,9 +687,36 @@ class AttnProcessor2_0:
 
         # the output of sdp = (batch, num_heads, seq_len, head_dim)
         # TODO: add support for attn.scale when we move to Torch 2.1
-        hidden_states = F.scaled_dot_product_attention(
-            query, key, value, attn_mask=attention_mask, dropout_p=0.0, is_causal=False
-        )
+        if attn.slice_size is None:
+            hidden_states = F.scaled_dot_product_attention(
+                query,
+                key,
+                value,
+                attn_mask=attention_mask,
+                dropout_p=0.0,
+                is_causal=False,
+            )
+        else:
+            heads = [
+                slice(start, start + attn.slice_size)
+                for start in range(0, attn.heads, attn.slice_size)
+            ]
+            hidden_states = torch.cat(
+                [
+                    F.scaled_dot_product_attention(
+                        query[:, h],
+                        key[:, h],
+                        value[:, h],
+                        attn_mask=(
+                            None if attention_mask is None else attention_mask[:, h]
+                        ),
+                        dropout_p=0.0,
+                        is_causal=False,
+                    )
+                    for h in heads
+                ],
+                dim=1,
+            )
 
         hidden_states = hidden_states.transpose(1, 2).reshape(
             batch_size, -1, attn.heads * head_dim
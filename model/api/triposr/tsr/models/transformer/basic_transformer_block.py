@@ -152,6 +152,19 @@ class BasicTransformerBlock(nn.Module):
         attention_mask: Optional[torch.FloatTensor] = None,
         encoder_hidden_states: Optional[torch.FloatTensor] = None,
         encoder_attention_mask: Optional[torch.FloatTensor] = None,
+    ) -> torch.FloatTensor:
+        hidden_states = self.self_attention(
+            hidden_states, attention_mask, encoder_hidden_states
+        )
+        return self.cross_attention_and_feed_forward(
+            hidden_states, encoder_hidden_states, encoder_attention_mask
+        )
+
+    def self_attention(
+        self,
+        hidden_states: torch.FloatTensor,
+        attention_mask: Optional[torch.FloatTensor] = None,
+        encoder_hidden_states: Optional[torch.FloatTensor] = None,
     ) -> torch.FloatTensor:
         # Notice that normalization is always applied before the real computation in the following blocks.
         # 0. Self-Attention
@@ -165,8 +178,27 @@ class BasicTransformerBlock(nn.Module):
             attention_mask=attention_mask,
         )
 
-        hidden_states = attn_output + hidden_states
+        return attn_output + hidden_states
 
+    def cross_attention_query(
+        self, hidden_states: torch.FloatTensor
+    ) -> Optional[torch.FloatTensor]:
+        """Query projection of the cross-attention for the output of `self_attention`."""
+        if self.attn2 is None:
+            return None
+        return self.attn2.to_q(self.norm2(hidden_states))
+
+    def cross_attention_and_feed_forward(
+        self,
+        hidden_states: torch.FloatTensor,
+        encoder_hidden_states: Optional[torch.FloatTensor] = None,
+        encoder_attention_mask: Optional[torch.FloatTensor] = None,
+        cross_attention_query: Optional[torch.FloatTensor] = None,
+    ) -> torch.FloatTensor:
+        """
+        Rest of the block after `self_attention`. `cross_attention_query`, from
+        `cross_attention_query`, skips the query projection.
+        """
         # 3. Cross-Attention
         if self.attn2 is not None:
             norm_hidden_states = self.norm2(hidden_states)
@@ -175,6 +207,7 @@ class BasicTransformerBlock(nn.Module):
                 norm_hidden_states,
                 encoder_hidden_states=encoder_hidden_states,
                 attention_mask=encoder_attention_mask,
+                query=cross_attention_query,
             )
             hidden_states = attn_output + hidden_states
 
@@ -183,17 +216,11 @@ class BasicTransformerBlock(nn.Module):
 
         if self._chunk_size is not None:
             # "feed_forward_chunk_size" can be used to save memory
-            if norm_hidden_states.shape[self._chunk_dim] % self._chunk_size != 0:
-                raise ValueError(
-                    f"`hidden_states` dimension to be chunked: {norm_hidden_states.shape[self._chunk_dim]} has to be divisible by chunk size: {self._chunk_size}. Make sure to set an appropriate `chunk_size` when calling `unet.enable_forward_chunking`."
-                )
-
-            num_chunks = norm_hidden_states.shape[self._chunk_dim] // self._chunk_size
             ff_output = torch.cat(
                 [
                     self.ff(hid_slice)
-                    for hid_slice in norm_hidden_states.chunk(
-                        num_chunks, dim=self._chunk_dim
+                    for hid_slice in norm_hidden_states.split(
+                        self._chunk_size, dim=self._chunk_dim
                     )
                 ],
                 dim=self._chunk_dim,
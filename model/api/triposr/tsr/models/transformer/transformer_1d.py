@@ -36,17 +36,27 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import logging
 from dataclasses import dataclass
-from typing import Optional
+from typing import NamedTuple, Optional
 
 import torch
 import torch.nn.functional as F
 from torch import nn
 
 from ...utils import BaseModule
+from .attention import Attention, AttnProcessor2_0
 from .basic_transformer_block import BasicTransformerBlock
 
 
+class ConstantInput(NamedTuple):
+    """Request-independent part of `Transformer1D.forward`, for one item."""
+
+    residual: torch.Tensor
+    hidden_states: torch.Tensor
+    cross_attention_query: Optional[torch.Tensor]
+
+
 class Transformer1D(BaseModule):
     @dataclass
     class Config(BaseModule.Config):
@@ -119,6 +129,50 @@ class Transformer1D(BaseModule):
 
         self.gradient_checkpointing = self.cfg.gradient_checkpointing
 
+        # set by precompute_constant_input
+        self.constant_input: Optional[ConstantInput] = None
+
+    def set_chunk_feed_forward(self, chunk_size: Optional[int]) -> None:
+        """
+        Runs the feed-forward of every block on `chunk_size` tokens at a time
+        (None for all at once), which bounds the size of its hidden layer.
+        """
+        for block in self.transformer_blocks:
+            block.set_chunk_feed_forward(chunk_size, dim=1)
+
+    def set_attention_slice(self, slice_size: Optional[int]) -> None:
+        """
+        Computes the attention of every layer `slice_size` heads at a time
+        (None for all at once), see `Attention.set_attention_slice`.
+        """
+        for module in self.modules():
+            if isinstance(module, Attention):
+                module.set_attention_slice(slice_size)
+
+    def fuse_qkv_projections(self) -> int:
+        """
+        Fuses the projections of every self- and cross-attention layer, see
+        `Attention.fuse_projections`, and makes sure they all run
+        `AttnProcessor2_0` (`scaled_dot_product_attention`) when this version
+        of torch has it. Returns the number of attention layers fused.
+        """
+        fused = 0
+        for name, module in self.named_modules():
+            if not isinstance(module, Attention):
+                continue
+            module.fuse_projections()
+            fused += 1
+            if isinstance(module.processor, AttnProcessor2_0):
+                continue
+            if hasattr(F, "scaled_dot_product_attention") and module.scale_qk:
+                module.set_processor(AttnProcessor2_0())
+            else:
+                logging.warning(
+                    f"{name} runs {type(module.processor).__name__}, "
+                    "not scaled_dot_product_attention"
+                )
+        return fused
+
     def forward(
         self,
         hidden_states: torch.Tensor,
@@ -177,18 +231,97 @@ class Transformer1D(BaseModule):
             encoder_attention_mask = encoder_attention_mask.unsqueeze(1)
 
         # 1. Input
-        batch, _, seq_len = hidden_states.shape
         residual = hidden_states
+        hidden_states = self.project_input(hidden_states)
+
+        # 2. Blocks
+        hidden_states = self.run_blocks(
+            hidden_states,
+            attention_mask,
+            encoder_hidden_states,
+            encoder_attention_mask,
+        )
+
+        # 3. Output
+        return self.project_output(hidden_states, residual)
+
+    def precompute_constant_input(self, hidden_states: torch.Tensor) -> None:
+        """
+        Caches everything `forward` computes from `hidden_states` (one item)
+        alone, for inputs that are the same for every request such as the
+        learned triplane tokens: the input norm and projection, the
+        self-attention of the first block and the query of its
+        cross-attention. `forward_constant_input` then starts from there.
+        The cache has to be rebuilt whenever the weights change.
+        """
+        self.constant_input = None
+        if self.cfg.only_cross_attention:
+            # the first self-attention already depends on the encoder states
+            return
+        first_block = self.transformer_blocks[0]
+        with torch.no_grad():
+            projected = self.project_input(hidden_states)
+            projected = first_block.self_attention(projected)
+            self.constant_input = ConstantInput(
+                residual=hidden_states,
+                hidden_states=projected,
+                cross_attention_query=first_block.cross_attention_query(projected),
+            )
 
+    def forward_constant_input(
+        self,
+        batch_size: int,
+        encoder_hidden_states: Optional[torch.Tensor] = None,
+        encoder_attention_mask: Optional[torch.Tensor] = None,
+    ):
+        """
+        Same as `forward` on `batch_size` copies of the hidden states given to
+        `precompute_constant_input`, without an attention mask.
+        """
+        if encoder_attention_mask is not None and encoder_attention_mask.ndim == 2:
+            encoder_attention_mask = (
+                1 - encoder_attention_mask.to(self.constant_input.residual.dtype)
+            ) * -10000.0
+            encoder_attention_mask = encoder_attention_mask.unsqueeze(1)
+
+        def expand(tensor):
+            if tensor is None:
+                return None
+            return tensor.expand(batch_size, *tensor.shape[1:])
+
+        hidden_states = self.transformer_blocks[0].cross_attention_and_feed_forward(
+            expand(self.constant_input.hidden_states),
+            encoder_hidden_states,
+            encoder_attention_mask,
+            expand(self.constant_input.cross_attention_query),
+        )
+        hidden_states = self.run_blocks(
+            hidden_states,
+            None,
+            encoder_hidden_states,
+            encoder_attention_mask,
+            start=1,
+        )
+        return self.project_output(hidden_states, expand(self.constant_input.residual))
+
+    def project_input(self, hidden_states: torch.Tensor) -> torch.Tensor:
+        batch, _, seq_len = hidden_states.shape
         hidden_states = self.norm(hidden_states)
         inner_dim = hidden_states.shape[1]
         hidden_states = hidden_states.permute(0, 2, 1).reshape(
             batch, seq_len, inner_dim
         )
-        hidden_states = self.proj_in(hidden_states)
+        return self.proj_in(hidden_states)
 
-        # 2. Blocks
-        for block in self.transformer_blocks:
+    def run_blocks(
+        self,
+        hidden_states: torch.Tensor,
+        attention_mask: Optional[torch.Tensor],
+        encoder_hidden_states: Optional[torch.Tensor],
+        encoder_attention_mask: Optional[torch.Tensor],
+        start: int = 0,
+    ) -> torch.Tensor:
+        for block in self.transformer_blocks[start:]:
             if self.training and self.gradient_checkpointing:
                 hidden_states = torch.utils.checkpoint.checkpoint(
                     block,
@@ -205,11 +338,15 @@ class Transformer1D(BaseModule):
                     encoder_hidden_states=encoder_hidden_states,
                     encoder_attention_mask=encoder_attention_mask,
                 )
+        return hidden_states
 
-        # 3. Output
+    def project_output(
+        self, hidden_states: torch.Tensor, residual: torch.Tensor
+    ) -> torch.Tensor:
+        batch, channels, seq_len = residual.shape
         hidden_states = self.proj_out(hidden_states)
         hidden_states = (
-            hidden_states.reshape(batch, seq_len, inner_dim)
+            hidden_states.reshape(batch, seq_len, hidden_states.shape[-1])
             .permute(0, 2, 1)
             .contiguous()
         )
@@ -0,0 +1,77 @@
+import contextlib
+from typing import ContextManager, Dict
+
+import torch
+import torch.nn as nn
+import trimesh
+
+PRECISIONS = ("fp32", "bf16", "int8")
+
+
+def apply_precision(model: nn.Module, precision: str) -> None:
+    """
+    Prepares the image tokenizer and the backbone of a TSR model for
+    `precision`. "int8" replaces their `nn.Linear` layers in place with
+    dynamically quantized ones (int8 weights, activations quantized per
+    batch), which only run on CPU. "fp32" and "bf16" leave the weights as
+    they are, bf16 being applied by `precision_context` around the forward.
+    """
+    if precision not in PRECISIONS:
+        raise ValueError(f"precision must be one of {PRECISIONS}, got {precision}")
+    if precision != "int8":
+        return
+    for name in ("image_tokenizer", "backbone"):
+        module = getattr(model, name)
+        if next(module.parameters()).device.type != "cpu":
+            raise ValueError("int8 precision is only supported on CPU")
+        setattr(
+            model,
+            name,
+            torch.ao.quantization.quantize_dynamic(
+                module, {nn.Linear}, dtype=torch.qint8
+            ),
+        )
+
+
+def precision_context(precision: str, device: str) -> ContextManager:
+    """Autocast context in which the model forward runs for `precision`."""
+    if precision == "bf16":
+        return torch.autocast(torch.device(device).type, dtype=torch.bfloat16)
+    return contextlib.nullcontext()
+
+
+def chamfer_distance(
+    mesh_a: trimesh.Trimesh, mesh_b: trimesh.Trimesh, n_points: int = 10000
+) -> float:
+    """
+    Symmetric Chamfer distance between two meshes, the mean distance from
+    `n_points` points sampled on each surface to the nearest point sampled
+    on the other one.
+    """
+    points_a = torch.from_numpy(trimesh.sample.sample_surface(mesh_a, n_points)[0])
+    points_b = torch.from_numpy(trimesh.sample.sample_surface(mesh_b, n_points)[0])
+
+    def nearest(source, target):
+        return torch.cat(
+            [
+                torch.cdist(source[i : i + 1024], target).min(dim=1).values
+                for i in range(0, source.shape[0], 1024)
+            ]
+        )
+
+    return (
+        nearest(points_a, points_b).mean() + nearest(points_b, points_a).mean()
+    ).item() / 2
+
+
+def compare_scene_codes(
+    reference: torch.Tensor, other: torch.Tensor
+) -> Dict[str, float]:
+    """Relative L2 error and maximum absolute error of `other` against `reference`."""
+    reference, other = reference.float(), other.float()
+    return {
+        "relative_error": (
+            (other - reference).norm() / reference.norm().clamp_min(1e-12)
+        ).item(),
+        "max_abs_error": (other - reference).abs().max().item(),
+    }
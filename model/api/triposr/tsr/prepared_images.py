@@ -0,0 +1,97 @@
+import hashlib
+import logging
+import os
+import uuid
+from typing import Any, Optional
+
+import numpy as np
+import PIL.Image
+import rembg
+import torch
+
+from .utils import ImagePreprocessor, remove_background, resize_foreground
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".webp")
+
+
+class PreparedImageStore:
+    """
+    Model inputs prepared from source images: background removed, foreground
+    resized, composited on gray and resized to the conditioning size.
+
+    Prepared images are stored in `cache_dir` under the hash of the source
+    image bytes and the foreground ratio. `prepare` computes and stores them
+    on a miss, and `prepare_all` fills the store for a whole image library
+    ahead of time.
+    """
+
+    def __init__(
+        self,
+        cache_dir: Optional[str] = None,
+        size: int = 512,
+        rembg_session: Any = None,
+    ):
+        self.cache_dir = cache_dir
+        self.size = size
+        self.rembg_session = rembg_session
+        self.image_processor = ImagePreprocessor()
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _path(self, image_path: str, foreground_ratio: float) -> str:
+        digest = hashlib.sha256(f"{self.size}:{foreground_ratio}:".encode("utf-8"))
+        with open(image_path, "rb") as image_file:
+            for block in iter(lambda: image_file.read(1 << 20), b""):
+                digest.update(block)
+        return os.path.join(self.cache_dir, f"{digest.hexdigest()}.png")
+
+    def _compute(self, image_path: str, foreground_ratio: float) -> PIL.Image.Image:
+        image = PIL.Image.open(image_path)
+        # remove_background skips images that already have a transparent background
+        if self.rembg_session is None and not (
+            image.mode == "RGBA" and image.getextrema()[3][0] < 255
+        ):
+            self.rembg_session = rembg.new_session()
+        image = remove_background(image, self.rembg_session)
+        image = resize_foreground(image, foreground_ratio)
+        image = np.array(image).astype(np.float32) / 255.0
+        image = image[:, :, :3] * image[:, :, 3:4] + (1 - image[:, :, 3:4]) * 0.5
+        image = self.image_processor.convert_and_resize(
+            torch.from_numpy(image), self.size
+        )
+        return PIL.Image.fromarray(
+            (image.clamp(0, 1).numpy() * 255.0).round().astype(np.uint8)
+        )
+
+    def prepare(
+        self, image_path: str, foreground_ratio: float = 0.85
+    ) -> PIL.Image.Image:
+        if self.cache_dir is None:
+            return self._compute(image_path, foreground_ratio)
+        path = self._path(image_path, foreground_ratio)
+        if os.path.exists(path):
+            try:
+                return PIL.Image.open(path).convert("RGB")
+            except OSError as e:
+                # A truncated or corrupt file is prepared again and replaced
+                logging.warning(f"Failed to read prepared image {path}: {e}")
+        image = self._compute(image_path, foreground_ratio)
+        # Write then rename, so that concurrent readers never see a partial file
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp.png"
+        image.save(tmp_path)
+        os.replace(tmp_path, path)
+        return image
+
+    def prepare_all(self, images_dir: str, foreground_ratio: float = 0.85) -> int:
+        """Prepares every image below `images_dir`, returns how many were found."""
+        count = 0
+        for root, _, names in os.walk(images_dir):
+            for name in sorted(names):
+                if not name.lower().endswith(IMAGE_EXTENSIONS):
+                    continue
+                try:
+                    self.prepare(os.path.join(root, name), foreground_ratio)
+                    count += 1
+                except Exception as e:
+                    logging.error(f"Failed to prepare {name}: {e}")
+        return count
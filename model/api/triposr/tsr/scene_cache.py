@@ -0,0 +1,109 @@
+import hashlib
+import os
+import threading
+import uuid
+from collections import OrderedDict
+from typing import Optional
+
+import numpy as np
+import torch
+
+
+class SceneCodeCache:
+    """
+    Cache of scene codes (triplanes) keyed by the hash of the preprocessed
+    input image, so that re-meshing, re-rendering or texture baking of an
+    already seen image skips the image tokenizer and the backbone.
+
+    Scene codes are kept as float16 tensors: the most recently used ones in
+    memory and, when `cache_dir` is given, all of them on disk (bounded by
+    `max_disk_items`) where they are loaded memory-mapped.
+    """
+
+    def __init__(
+        self,
+        cache_dir: Optional[str] = None,
+        max_memory_items: int = 8,
+        max_disk_items: int = 1024,
+        mmap: bool = True,
+    ):
+        self.cache_dir = cache_dir
+        self.max_memory_items = max_memory_items
+        self.max_disk_items = max_disk_items
+        self.mmap = mmap
+        self._memory: "OrderedDict[str, torch.Tensor]" = OrderedDict()
+        self._lock = threading.Lock()
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(image, namespace: str = "") -> str:
+        image = np.ascontiguousarray(np.asarray(image))
+        digest = hashlib.sha256(namespace.encode("utf-8"))
+        digest.update(str((image.shape, image.dtype.str)).encode("utf-8"))
+        digest.update(image.tobytes())
+        return digest.hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.pt")
+
+    def get(self, key: str) -> Optional[torch.Tensor]:
+        """Returns the float16 scene code of `key`, or None on a miss."""
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return self._memory[key]
+        if self.cache_dir is None or not os.path.exists(self._path(key)):
+            return None
+        try:
+            scene_code = torch.load(
+                self._path(key), map_location="cpu", weights_only=True, mmap=self.mmap
+            )
+        except (OSError, RuntimeError):
+            return None
+        os.utime(self._path(key))
+        self._remember(key, scene_code)
+        return scene_code
+
+    def put(self, key: str, scene_code: torch.Tensor) -> torch.Tensor:
+        """
+        Stores `scene_code` and returns its float16 copy, the value later hits
+        return, so that callers can use the same value on misses.
+        """
+        scene_code = scene_code.detach().to("cpu", torch.float16).contiguous()
+        self._remember(key, scene_code)
+        if self.cache_dir is None:
+            return scene_code
+        # Write then rename, so that concurrent readers never see a partial file
+        tmp_path = f"{self._path(key)}.{uuid.uuid4().hex}.tmp"
+        torch.save(scene_code, tmp_path)
+        os.replace(tmp_path, self._path(key))
+        self._evict_disk()
+        return scene_code
+
+    def _remember(self, key: str, scene_code: torch.Tensor) -> None:
+        with self._lock:
+            self._memory[key] = scene_code
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_memory_items:
+                self._memory.popitem(last=False)
+
+    def _evict_disk(self) -> None:
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(".pt"):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                entries.append((os.path.getmtime(path), path))
+            except OSError:
+                # Removed by a concurrent eviction
+                continue
+        if len(entries) <= self.max_disk_items:
+            return
+        entries.sort()
+        for _, path in entries[: len(entries) - self.max_disk_items]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
@@ -1,7 +1,7 @@
 import math
 import os
 from dataclasses import dataclass, field
-from typing import List, Union
+from typing import Callable, List, Optional, Union
 
 import numpy as np
 import PIL.Image
@@ -109,16 +109,30 @@ class TSR(BaseModule):
             input_image_tokens, "B Nv C Nt -> B (Nv Nt) C", Nv=1
         )
 
-        tokens: torch.Tensor = self.tokenizer(batch_size)
+        if getattr(self.backbone, "constant_input", None) is not None:
+            tokens = self.backbone.forward_constant_input(
+                batch_size, encoder_hidden_states=input_image_tokens
+            )
+        else:
+            tokens: torch.Tensor = self.tokenizer(batch_size)
 
-        tokens = self.backbone(
-            tokens,
-            encoder_hidden_states=input_image_tokens,
-        )
+            tokens = self.backbone(
+                tokens,
+                encoder_hidden_states=input_image_tokens,
+            )
 
         scene_codes = self.post_processor(self.tokenizer.detokenize(tokens))
         return scene_codes
 
+    def precompute_constant_tokens(self) -> None:
+        """
+        The triplane tokens are learned embeddings, the same for every image,
+        so the part of the backbone that only depends on them is computed
+        once here and reused by `forward`. Call it again after changing the
+        weights of the tokenizer or the backbone.
+        """
+        self.backbone.precompute_constant_input(self.tokenizer(1))
+
     def render(
         self,
         scene_codes,
@@ -129,7 +143,22 @@ class TSR(BaseModule):
         height: int = 256,
         width: int = 256,
         return_type: str = "pil",
+        batch_views: bool = True,
+        max_rays_per_batch: int = 65536,
+        skip_empty_space: bool = False,
+        chunk_size: Optional[int] = None,
+        progress: Optional[Callable[[float], None]] = None,
     ):
+        """
+        Renders `n_views` views around each scene code. With `batch_views`, the
+        rays of all views are concatenated and rendered `max_rays_per_batch`
+        at a time (queries are still chunked by `chunk_size`, by default the
+        chunk size of the renderer), rather than one view per renderer call. With `skip_empty_space`, an occupancy
+        grid is built once per scene code and the renderer only evaluates the
+        samples in occupied space, up to where the rays become opaque.
+        `progress` is called with the fraction of the rays rendered so far
+        after every renderer call.
+        """
         rays_o, rays_d = get_spherical_cameras(
             n_views, elevation_deg, camera_distance, fovy_deg, height, width
         )
@@ -147,19 +176,78 @@ class TSR(BaseModule):
             else:
                 raise NotImplementedError
 
+        if batch_views:
+            flat_rays_o = rays_o.reshape(-1, 3)
+            flat_rays_d = rays_d.reshape(-1, 3)
+
+        def report_progress(index, fraction):
+            if progress is not None:
+                progress((index + fraction) / len(scene_codes))
+
         images = []
-        for scene_code in scene_codes:
+        for index, scene_code in enumerate(scene_codes):
+            occupancy_grid = None
+            if skip_empty_space:
+                with torch.no_grad():
+                    occupancy_grid = self.renderer.build_occupancy_grid(
+                        self.decoder, scene_code, chunk_size
+                    )
+            if batch_views:
+                n_rays = flat_rays_o.shape[0]
+                rgb = []
+                for i in range(0, n_rays, max_rays_per_batch):
+                    with torch.no_grad():
+                        rgb.append(
+                            self.renderer(
+                                self.decoder,
+                                scene_code,
+                                flat_rays_o[i : i + max_rays_per_batch],
+                                flat_rays_d[i : i + max_rays_per_batch],
+                                occupancy_grid,
+                                chunk_size,
+                            )
+                        )
+                    report_progress(index, min(i + max_rays_per_batch, n_rays) / n_rays)
+                rgb = torch.cat(rgb).view(n_views, height, width, 3)
+                images.append([process_output(image) for image in rgb])
+                continue
             images_ = []
             for i in range(n_views):
                 with torch.no_grad():
                     image = self.renderer(
-                        self.decoder, scene_code, rays_o[i], rays_d[i]
+                        self.decoder,
+                        scene_code,
+                        rays_o[i],
+                        rays_d[i],
+                        occupancy_grid,
+                        chunk_size,
                     )
                 images_.append(process_output(image))
+                report_progress(index, (i + 1) / n_views)
             images.append(images_)
 
         return images
 
+    def token_scene_code(self) -> torch.FloatTensor:
+        """
+        Scene code of the bare triplane tokens, without any image. It has the
+        shape and the value range of real scene codes, so it is used to warm
+        up and benchmark the triplane query.
+        """
+        with torch.no_grad():
+            tokens = self.tokenizer.detokenize(self.tokenizer(1))
+            return self.post_processor(tokens)[0]
+
+    def compile_query(self, chunk_size: int) -> str:
+        """
+        Compiles the triplane query of the renderer for `chunk_size`, warming
+        it up on `token_scene_code`, see `TriplaneNeRFRenderer.compile_query`.
+        Returns the backend kept.
+        """
+        return self.renderer.compile_query(
+            self.decoder, self.token_scene_code(), chunk_size
+        )
+
     def set_marching_cubes_resolution(self, resolution: int):
         if (
             self.isosurface_helper is not None
@@ -168,21 +256,88 @@ class TSR(BaseModule):
             return
         self.isosurface_helper = MarchingCubeHelper(resolution)
 
-    def extract_mesh(self, scene_codes, has_vertex_color, resolution: int = 256, threshold: float = 25.0):
+    def extract_mesh(
+        self,
+        scene_codes,
+        has_vertex_color,
+        resolution: int = 256,
+        threshold: float = 25.0,
+        coarse_to_fine: bool = False,
+        coarse_stride: int = 4,
+        streaming: bool = False,
+        chunk_size: Optional[int] = None,
+        progress: Optional[Callable[[float], None]] = None,
+    ):
+        """
+        Extracts the `threshold` isosurface of the density of each scene code
+        with marching cubes on a `resolution`^3 grid. With `coarse_to_fine`,
+        the density is only queried on a grid `coarse_stride` times coarser
+        and at the grid vertices near the surface found there, see
+        `MarchingCubeHelper.refine_planes`. With `streaming`, marching cubes
+        runs slab by slab as the density is queried, so the density volume is
+        never in memory as a whole, see `MarchingCubeHelper.stream`. The
+        density is queried `chunk_size` points at a time (default: the chunk
+        size of the renderer).
+        `progress` is called with the fraction of the grid queried so far
+        after every slab.
+        """
         self.set_marching_cubes_resolution(resolution)
+        radius_range = (-self.renderer.cfg.radius, self.renderer.cfg.radius)
         meshes = []
-        for scene_code in scene_codes:
-            with torch.no_grad():
-                density = self.renderer.query_triplane(
-                    self.decoder,
-                    scale_tensor(
-                        self.isosurface_helper.grid_vertices.to(scene_codes.device),
-                        self.isosurface_helper.points_range,
-                        (-self.renderer.cfg.radius, self.renderer.cfg.radius),
-                    ),
-                    scene_code,
-                )["density_act"]
-            v_pos, t_pos_idx = self.isosurface_helper(-(density - threshold))
+        for index, scene_code in enumerate(scene_codes):
+
+            def query(points):
+                return (
+                    self.renderer.query_triplane(
+                        self.decoder,
+                        points.to(scene_code.device, scene_code.dtype),
+                        scene_code,
+                        chunk_size,
+                    )["density_act"][..., 0]
+                    - threshold
+                )
+
+            coarse = None
+            if coarse_to_fine:
+                with torch.no_grad():
+                    coarse = self.isosurface_helper.coarse_grid(
+                        query, radius_range, coarse_stride
+                    )
+
+            def level_planes(start, stop):
+                # Queried slab by slab, the grid coordinates are never all in memory
+                with torch.no_grad():
+                    if coarse is not None:
+                        level = -self.isosurface_helper.refine_planes(
+                            query, coarse, start, stop
+                        )
+                    else:
+                        level = -query(
+                            self.isosurface_helper.plane_vertices(
+                                radius_range,
+                                start,
+                                stop,
+                                device=scene_code.device,
+                                dtype=scene_code.dtype,
+                            )
+                        )
+                if progress is not None:
+                    progress((index + stop / resolution) / len(scene_codes))
+                return level
+
+            if streaming:
+                v_pos, t_pos_idx = self.isosurface_helper.stream(level_planes)
+                v_pos = v_pos.to(scene_code.device)
+                t_pos_idx = t_pos_idx.to(scene_code.device)
+            else:
+                level = torch.empty(
+                    resolution**3, device=scene_code.device, dtype=scene_code.dtype
+                )
+                for start, stop in self.isosurface_helper.slab_ranges():
+                    level[start * resolution**2 : stop * resolution**2] = (
+                        level_planes(start, stop)
+                    )
+                v_pos, t_pos_idx = self.isosurface_helper(level)
             v_pos = scale_tensor(
                 v_pos,
                 self.isosurface_helper.points_range,
@@ -195,6 +350,7 @@ class TSR(BaseModule):
                         self.decoder,
                         v_pos,
                         scene_code,
+                        chunk_size,
                     )["color"]
             mesh = trimesh.Trimesh(
                 vertices=v_pos.cpu().numpy(),
@@ -1,6 +1,5 @@
 import importlib
 import math
-from collections import defaultdict
 from dataclasses import dataclass
 from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 import warnings
@@ -151,8 +150,20 @@ def rays_intersect_bbox(
     return t_near, t_far, rays_valid
 
 
-def chunk_batch(func: Callable, chunk_size: int, *args, **kwargs) -> Any:
-    if chunk_size <= 0:
+def chunk_batch(
+    func: Callable, chunk_size: int, *args, out_buffers: Any = None, **kwargs
+) -> Any:
+    """
+    Calls `func` on chunks of `chunk_size` rows of the tensor arguments and
+    merges its outputs along the first dimension.
+
+    Outputs are written into tensors allocated from the first chunk, or into
+    `out_buffers` (with the same structure as the return value of `func`)
+    when it is given, instead of being concatenated at the end. Outputs whose
+    chunks do not have as many rows as the inputs are concatenated as before.
+    With `chunk_size <= 0`, `func` is called once on all the rows.
+    """
+    if chunk_size <= 0 and out_buffers is None:
         return func(*args, **kwargs)
     B = None
     for arg in list(args) + list(kwargs.values()):
@@ -162,7 +173,16 @@ def chunk_batch(func: Callable, chunk_size: int, *args, **kwargs) -> Any:
     assert (
         B is not None
     ), "No tensor found in args or kwargs, cannot determine batch size."
-    out = defaultdict(list)
+    if chunk_size <= 0:
+        # A single chunk, whose outputs are still written into `out_buffers`
+        chunk_size = max(1, B)
+    out = out_buffers
+    if isinstance(out, torch.Tensor):
+        out = {0: out}
+    elif isinstance(out, (tuple, list)):
+        out = {i: buffer for i, buffer in enumerate(out)}
+    # key -> output tensor filled chunk by chunk, or list of chunks to concatenate
+    out_merged: Dict[Any, Any] = {}
     out_type = None
     # max(1, B) to support B == 0
     for i in range(0, max(1, B), chunk_size):
@@ -191,15 +211,35 @@ def chunk_batch(func: Callable, chunk_size: int, *args, **kwargs) -> Any:
                 f"Return value of func must be in type [torch.Tensor, list, tuple, dict], get {type(out_chunk)}."
             )
             exit(1)
+        rows = min(chunk_size, B - i)
         for k, v in out_chunk.items():
-            v = v if torch.is_grad_enabled() else v.detach()
-            out[k].append(v)
+            if isinstance(v, torch.Tensor) and not torch.is_grad_enabled():
+                v = v.detach()
+            merged = out_merged.get(k)
+            in_place = isinstance(v, torch.Tensor) and v.shape[0] == rows
+            if k not in out_merged:
+                if in_place:
+                    if out is not None and k in out:
+                        merged = out[k]
+                    else:
+                        merged = v.new_empty((B,) + v.shape[1:])
+                    merged[i : i + rows] = v
+                    out_merged[k] = merged
+                else:
+                    out_merged[k] = [v]
+            elif isinstance(merged, list):
+                merged.append(v)
+            elif in_place:
+                merged[i : i + rows] = v
+            else:
+                out_merged[k] = [merged[:i], v]
 
     if out_type is None:
         return None
 
-    out_merged: Dict[Any, Optional[torch.Tensor]] = {}
-    for k, v in out.items():
+    for k, v in out_merged.items():
+        if not isinstance(v, list):
+            continue
         if all([vv is None for vv in v]):
             # allow None in return value
             out_merged[k] = None
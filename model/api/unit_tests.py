@@ -1,19 +1,90 @@
 import pytest
-import subprocess
 from unittest.mock import patch, mock_open
-from model_api import generate_3d_model
+from model_api import (
+    generate_3d_model,
+    create_job,
+    get_job,
+    run_generation,
+    tune_chunk_size,
+)
+from jobs import JobQueue, JobState, QueueFullError
+from metrics_buffer import MetricsBuffer
+from models import ModelMetrics, ServiceMetrics
+from result_cache import ResultCache
+from tsr.batching import DynamicBatcher
+from tsr.chunk_tuner import ChunkSizeTuner
+from tsr.engine import TSREngine
+from tsr.instrumentation import generation_metrics
+from tsr.memory_budget import MEMORY_TIERS, select_memory_settings
+from tsr.models.isosurface import MarchingCubeHelper
+from tsr.models.nerf_renderer import TriplaneNeRFRenderer
+from tsr.models.network_utils import NeRFMLP
+from tsr.models.transformer.attention import AttnProcessor2_0
+from tsr.models.transformer.transformer_1d import Transformer1D
+from tsr.precision import apply_precision, chamfer_distance
+from tsr.prepared_images import PreparedImageStore
+from tsr.scene_cache import SceneCodeCache
+from tsr.system import TSR
+from tsr.utils import chunk_batch
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+from PIL import Image
+from datetime import datetime, timezone
+from sqlmodel import Session, SQLModel, create_engine, select
 from fastapi import HTTPException
+import json
 import os
+import threading
+import time
+import torch
+
+GENERATE_OUTPUTS = {
+    "mesh": "/data/storage/tmp/job/mesh.glb",
+    "render": "/data/storage/tmp/job/render.gif",
+    "batch": {
+        "batch_size": 1,
+        "batch_wait_ms": 0.0,
+        "max_batch_size": 1,
+        "max_batch_wait_ms": 50.0,
+    },
+    "memory": {
+        "chunk_size": 8192,
+        "max_rays_per_batch": 65536,
+        "ff_chunk_size": None,
+        "attention_slice_size": None,
+    },
+    "stats": {
+        "stages_ms": {
+            "Processing images": 10.0,
+            "Running model": 20.0,
+            "Rendering": 30.0,
+            "Extracting mesh": 40.0,
+            "Exporting mesh": 5.0,
+        },
+        "total_time_ms": 105.0,
+        "peak_rss_mb": 2048.0,
+        "torch_threads": 4,
+        "torch_interop_threads": 4,
+    },
+}
+
+
+@pytest.fixture(autouse=True)
+def no_result_cache():
+    # The generation tests below always miss the result cache, and log no metrics
+    with patch("model_api.lookup_result_cache", return_value=(None, None)), patch(
+        "model_api.log_generation_metrics"
+    ):
+        yield
 
 
 @pytest.mark.asyncio
-async def test_generate_3d_model_subprocess_success():
-    with patch("subprocess.run") as mock_run, patch(
+async def test_generate_3d_model_engine_success():
+    with patch("model_api.get_engine") as mock_engine, patch(
         "os.path.exists"
-    ) as mock_exists, patch("shutil.move") as mock_move:
+    ) as mock_exists, patch("os.replace") as mock_replace:
 
-        mock_run.return_value.stdout = "Model generated successfully"
-        mock_run.return_value.stderr = ""
+        mock_engine.return_value.generate.return_value = GENERATE_OUTPUTS
         mock_exists.return_value = True
 
         result = await generate_3d_model(
@@ -24,16 +95,24 @@ async def test_generate_3d_model_subprocess_success():
 
         assert "object_3d" in result
         assert "object_2d" in result
-        assert mock_run.called
-        assert mock_move.call_count == 2
+        assert result["metrics"]["rendering_time_ms"] == 30.0
+        assert result["metrics"]["total_time_ms"] == 105.0
+        assert mock_engine.return_value.generate.called
+        assert mock_replace.call_count == 2
+        # Each job gets its own scratch directory
+        job_dir = mock_engine.return_value.generate.call_args[0][1]
+        assert job_dir.startswith("/data/storage/tmp/")
 
 
 @pytest.mark.asyncio
-async def test_generate_3d_model_subprocess_failure():
-    with patch("subprocess.run") as mock_run:
-        mock_run.side_effect = subprocess.CalledProcessError(
-            1, "cmd", stderr="Error in model generation"
+async def test_generate_3d_model_engine_failure():
+    with patch("model_api.get_engine") as mock_engine, patch(
+        "os.path.exists"
+    ) as mock_exists:
+        mock_engine.return_value.generate.side_effect = RuntimeError(
+            "Error in model generation"
         )
+        mock_exists.return_value = True
 
         with pytest.raises(HTTPException) as exc_info:
             await generate_3d_model(
@@ -62,5 +141,766 @@ async def test_generate_3d_model_file_not_found():
         assert "Image not found" in str(exc_info.value.detail)
 
 
+def fake_generate(image_path, job_dir, **kwargs):
+    # Writes its outputs into the scratch directory, like the engine
+    os.makedirs(job_dir)
+    outputs = {**GENERATE_OUTPUTS}
+    for name in ("mesh", "render"):
+        outputs[name] = os.path.join(job_dir, os.path.basename(outputs[name]))
+        with open(outputs[name], "w") as f:
+            f.write(name)
+    return outputs
+
+
+def test_jobs_run_in_distinct_scratch_directories(tmp_path):
+    queue = JobQueue(run_generation, workers=2)
+    queue.start()
+    with patch("model_api.SCRATCH_DIR", str(tmp_path / "tmp")), patch(
+        "model_api.get_engine"
+    ) as mock_engine, patch(
+        "model_api.get_output_paths",
+        side_effect=lambda image_path: (
+            str(tmp_path / f"{os.path.basename(image_path)}.glb"),
+            str(tmp_path / f"{os.path.basename(image_path)}.gif"),
+        ),
+    ):
+        mock_engine.return_value.generate.side_effect = fake_generate
+        jobs = [queue.submit({"image_path": f"/images/{name}"}) for name in "ab"]
+        assert all(job.done.wait(timeout=5) for job in jobs)
+        queue.stop()
+
+    assert [job.state for job in jobs] == [JobState.SUCCEEDED] * 2
+    job_dirs = [call[0][1] for call in mock_engine.return_value.generate.call_args_list]
+    assert len(set(job_dirs)) == 2
+    # Removed once the outputs are published
+    assert not any(os.path.exists(job_dir) for job_dir in job_dirs)
+    assert open(jobs[0].result["object_3d"]).read() == "mesh"
+
+
+def test_scratch_directory_removed_when_generation_fails(tmp_path):
+    def failing_generate(image_path, job_dir, **kwargs):
+        fake_generate(image_path, job_dir)
+        raise RuntimeError("Error in model generation")
+
+    with patch("model_api.SCRATCH_DIR", str(tmp_path)), patch(
+        "model_api.get_engine"
+    ) as mock_engine:
+        mock_engine.return_value.generate.side_effect = failing_generate
+        with pytest.raises(RuntimeError):
+            run_generation("job", {"image_path": "/images/a.png"})
+
+    assert not os.path.exists(tmp_path / "job")
+
+
+@pytest.mark.asyncio
+async def test_create_job_returns_job_id():
+    # A queue of our own, stopped before the engine is unpatched
+    queue = JobQueue(run_generation, workers=1)
+    queue.start()
+    with patch("model_api.get_engine") as mock_engine, patch(
+        "model_api.get_job_queue", return_value=queue
+    ), patch("os.path.exists") as mock_exists, patch("os.replace"):
+        mock_engine.return_value.generate.return_value = GENERATE_OUTPUTS
+        mock_exists.return_value = True
+
+        response = await create_job(
+            {
+                "image_path": "/data/storage/images/plane/000002_plane_cessna caravan_flying.png"
+            }
+        )
+        assert "job_id" in response
+
+        job = await get_job(response["job_id"])
+        assert job["job_id"] == response["job_id"]
+        assert job["state"] in ("queued", "running", "succeeded")
+
+        assert queue.get(response["job_id"]).done.wait(timeout=5)
+        queue.stop()
+
+    assert queue.get(response["job_id"]).state == JobState.SUCCEEDED
+    assert mock_engine.return_value.generate.called
+
+
+@pytest.mark.asyncio
+async def test_create_job_queue_full():
+    queue = JobQueue(lambda job_id, params: params, workers=1, max_queued=1)
+    queue.submit({"image_path": "/data/storage/images/a.png"})
+    with pytest.raises(QueueFullError):
+        queue.submit({"image_path": "/data/storage/images/b.png"})
+
+    with patch("model_api.get_job_queue", return_value=queue), patch(
+        "os.path.exists", return_value=True
+    ):
+        with pytest.raises(HTTPException) as exc_info:
+            await create_job({"image_path": "/data/storage/images/c.png"})
+
+        assert exc_info.value.status_code == 429
+        assert exc_info.value.headers["X-Queue-Depth"] == "1"
+
+
+@pytest.mark.asyncio
+async def test_cached_result_has_the_fields_of_a_generation(tmp_path):
+    cached_files = {}
+    for name, content in [("mesh.glb", "mesh"), ("render.gif", "render")]:
+        cached_files[name] = str(tmp_path / name)
+        (tmp_path / name).write_text(content)
+    cached_files["run_data.json"] = str(tmp_path / "run_data.json")
+    (tmp_path / "run_data.json").write_text(
+        json.dumps({"memory": GENERATE_OUTPUTS["memory"], "metrics": {"x": 1.0}})
+    )
+    outputs = (str(tmp_path / "out.glb"), str(tmp_path / "out.gif"))
+
+    with patch(
+        "model_api.lookup_result_cache", return_value=("key", cached_files)
+    ), patch("model_api.get_output_paths", return_value=outputs), patch(
+        "model_api.get_job_queue", return_value=JobQueue(run_generation)
+    ), patch(
+        "os.path.exists", return_value=True
+    ):
+        result = await generate_3d_model({"image_path": "/data/storage/images/a.png"})
+
+    assert result["object_3d"] == outputs[0]
+    assert open(outputs[0]).read() == "mesh"
+    assert result["memory"] == GENERATE_OUTPUTS["memory"]
+    assert result["metrics"] == {"x": 1.0}
+
+
+@pytest.mark.asyncio
+async def test_cached_result_evicted_before_use_is_generated(tmp_path):
+    cached_files = {
+        "mesh.glb": str(tmp_path / "evicted" / "mesh.glb"),
+        "render.gif": str(tmp_path / "evicted" / "render.gif"),
+    }
+    outputs = (str(tmp_path / "out.glb"), str(tmp_path / "out.gif"))
+    queue = JobQueue(run_generation)
+
+    with patch(
+        "model_api.lookup_result_cache", return_value=("key", cached_files)
+    ), patch("model_api.get_output_paths", return_value=outputs), patch(
+        "model_api.get_job_queue", return_value=queue
+    ), patch(
+        "os.path.exists", return_value=True
+    ):
+        response = await create_job({"image_path": "/data/storage/images/a.png"})
+
+    job = queue.get(response["job_id"])
+    assert job.state == JobState.QUEUED
+    assert job.params["cache_key"] == "key"
+
+
+def test_stopping_a_full_queue_fails_the_waiting_jobs():
+    release = threading.Event()
+    queue = JobQueue(lambda job_id, params: release.wait(), workers=1, max_queued=2)
+    queue.start()
+    running = queue.submit({"image_path": "/data/storage/images/a.png"})
+    while running.state != JobState.RUNNING:
+        time.sleep(0.01)
+    waiting = [
+        queue.submit({"image_path": f"/data/storage/images/{name}.png"})
+        for name in "bc"
+    ]
+
+    stopper = threading.Thread(target=queue.stop)
+    stopper.start()
+    assert all(job.done.wait(timeout=5) for job in waiting)
+    release.set()
+    stopper.join(timeout=5)
+
+    assert not stopper.is_alive()
+    assert running.state == JobState.SUCCEEDED
+    assert [job.state for job in waiting] == [JobState.FAILED] * 2
+    with pytest.raises(QueueFullError):
+        queue.submit({"image_path": "/data/storage/images/d.png"})
+
+
+def test_job_progress_reported_by_handler():
+    def handler(job_id, params):
+        queue.report_progress(job_id, "extract", 50.0)
+        return {"progress": queue.get(job_id).to_dict()["progress"]}
+
+    queue = JobQueue(handler, workers=1)
+    queue.start()
+    job = queue.submit({"image_path": "/data/storage/images/a.png"})
+    assert job.done.wait(timeout=5)
+    queue.stop()
+
+    assert job.result["progress"] == {"stage": "extract", "percent": 50.0}
+
+
+def test_metrics_buffer_writes_in_bulk_and_drops_when_full(tmp_path):
+    db_engine = create_engine(f"sqlite:///{tmp_path / 'metrics.db'}")
+    SQLModel.metadata.create_all(db_engine, tables=[ServiceMetrics.__table__])
+    buffer = MetricsBuffer(db_engine, ServiceMetrics, batch_size=2, max_rows=3)
+    for i in range(5):
+        buffer.add(
+            service_name="model_api",
+            endpoint=f"/jobs/{i}",
+            response_time=1.0,
+            status_code=200,
+            timestamp=datetime.now(timezone.utc),
+        )
+
+    assert buffer.flush() == 3
+    assert buffer.stats() == {"buffered": 0, "written": 3, "dropped": 2, "failed": 0}
+    with Session(db_engine) as db:
+        endpoints = [m.endpoint for m in db.exec(select(ServiceMetrics)).all()]
+    assert endpoints == ["/jobs/0", "/jobs/1", "/jobs/2"]
+
+
+def test_result_cache_hit_and_miss(tmp_path):
+    image = tmp_path / "image.png"
+    image.write_bytes(b"image bytes")
+    mesh = tmp_path / "mesh.glb"
+    mesh.write_bytes(b"mesh")
+    cache = ResultCache(str(tmp_path / "cache"), max_bytes=1024)
+
+    key = cache.make_key(str(image), {"mc_resolution": 256})
+    assert key != cache.make_key(str(image), {"mc_resolution": 128})
+    assert cache.lookup(key) is None
+
+    cache.store(key, {"mesh.glb": str(mesh)})
+    cached_files = cache.lookup(key)
+    assert open(cached_files["mesh.glb"], "rb").read() == b"mesh"
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
+
+
+def test_result_cache_evicts_least_recently_used(tmp_path):
+    data = tmp_path / "data.bin"
+    data.write_bytes(b"x" * 400)
+    cache = ResultCache(str(tmp_path / "cache"), max_bytes=1000)
+
+    cache.store("a", {"mesh.glb": str(data)})
+    cache.store("b", {"mesh.glb": str(data)})
+    cache.lookup("a")
+    cache.store("c", {"mesh.glb": str(data)})
+
+    assert cache.lookup("b") is None
+    assert cache.lookup("a") is not None
+    assert cache.lookup("c") is not None
+    assert cache.stats()["evictions"] == 1
+    # The index is rebuilt from disk
+    assert ResultCache(str(tmp_path / "cache"), max_bytes=1000).stats()["entries"] == 2
+
+
+def test_scene_cache_returns_the_same_code_on_miss_and_hit(tmp_path):
+    cache = SceneCodeCache(str(tmp_path), max_memory_items=1, max_disk_items=2)
+    scene_code = torch.randn(3, 8, 4, 4)
+
+    stored = cache.put("a", scene_code)
+    cache.put("b", torch.randn(3, 8, 4, 4))
+
+    assert stored.dtype == torch.float16
+    assert torch.equal(cache.get("a"), stored)
+    # Entries removed by another process while evicting are skipped
+    with patch("os.path.getmtime", side_effect=FileNotFoundError):
+        cache.put("c", scene_code)
+
+
+def test_scene_codes_are_rounded_only_with_the_scene_cache():
+    # An engine without weights, computing random fp32 scene codes
+    engine = TSREngine.__new__(TSREngine)
+    engine.model_name, engine.precision, engine.device = "test", "fp32", "cpu"
+    engine.batcher = None
+    scene_code = torch.randn(3, 8, 4, 4)
+    image = torch.zeros(4, 4, 3, dtype=torch.uint8).numpy()
+
+    with patch.object(engine, "encode_batch", return_value=scene_code[None]):
+        engine.scene_cache = None
+        uncached, batch = engine.encode(image)
+        assert torch.equal(uncached[0], scene_code)
+        assert batch["batch_size"] == 1
+
+        engine.scene_cache = SceneCodeCache()
+        missed, _ = engine.encode(image)
+        hit, batch = engine.encode(image)
+    assert torch.equal(missed[0], scene_code.half().float())
+    assert torch.equal(hit, missed)
+    assert batch["batch_size"] == 0
+
+
+def test_prepared_image_store_hit_miss_and_corrupt_entry(tmp_path):
+    # A transparent background, which is not removed again
+    pixels = torch.zeros(64, 64, 4, dtype=torch.uint8)
+    pixels[16:48, 24:40] = torch.tensor([200, 50, 50, 255], dtype=torch.uint8)
+    image_path = tmp_path / "image.png"
+    Image.fromarray(pixels.numpy()).save(image_path)
+    store = PreparedImageStore(str(tmp_path / "prepared"), size=32)
+
+    with patch.object(store, "_compute", wraps=store._compute) as compute:
+        prepared = store.prepare(str(image_path))
+        assert compute.call_count == 1
+        assert prepared.size == (32, 32)
+
+        assert list(store.prepare(str(image_path)).getdata()) == list(
+            prepared.getdata()
+        )
+        assert compute.call_count == 1
+
+        # Other parameters or other image bytes are other entries
+        store.prepare(str(image_path), foreground_ratio=0.5)
+        assert compute.call_count == 2
+        pixels[16:48, 24:40, 1] = 150
+        Image.fromarray(pixels.numpy()).save(image_path)
+        store.prepare(str(image_path))
+        assert compute.call_count == 3
+
+        # A corrupt entry is prepared again and replaced
+        path = store._path(str(image_path), 0.85)
+        with open(path, "r+b") as f:
+            f.truncate(20)
+        repaired = store.prepare(str(image_path))
+        assert compute.call_count == 4
+        assert list(Image.open(path).convert("RGB").getdata()) == list(
+            repaired.getdata()
+        )
+
+
+def test_dynamic_batcher_groups_concurrent_items():
+    batches = []
+
+    def double(items):
+        batches.append(list(items))
+        return [item * 2 for item in items]
+
+    batcher = DynamicBatcher(double, max_batch_size=4, max_wait_ms=500)
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        results = list(executor.map(batcher.submit, [1, 2, 3, 4]))
+
+    assert [result for result, _ in results] == [2, 4, 6, 8]
+    # The full batch is run without waiting for the end of the window
+    assert len(batches) == 1
+    assert all(batch["batch_size"] == 4 for _, batch in results)
+    assert all(batch["batch_wait_ms"] < 500 for _, batch in results)
+
+
+def test_batched_views_match_per_view_renders():
+    renderer = TriplaneNeRFRenderer(
+        {"radius": 0.87, "density_activation": "exp", "num_samples_per_ray": 16}
+    )
+    renderer.set_chunk_size(100)
+    model = SimpleNamespace(
+        renderer=renderer,
+        decoder=NeRFMLP({"in_channels": 24, "n_neurons": 16, "n_hidden_layers": 2}),
+    )
+    scene_codes = torch.randn(2, 3, 8, 4, 4)
+
+    def render(**kwargs):
+        return TSR.render(
+            model, scene_codes, 3, height=8, width=8, return_type="pt", **kwargs
+        )
+
+    # Renderer calls that span several views
+    batched = render(batch_views=True, max_rays_per_batch=50)
+    per_view = render(batch_views=False)
+
+    for batched_images, images in zip(batched, per_view):
+        assert len(batched_images) == len(images) == 3
+        for batched_image, image in zip(batched_images, images):
+            assert torch.allclose(batched_image, image, atol=1e-6)
+
+
+def test_render_chunk_size_leaves_the_renderer_alone():
+    renderer = TriplaneNeRFRenderer(
+        {"radius": 0.87, "density_activation": "exp", "num_samples_per_ray": 16}
+    )
+    renderer.set_chunk_size(100)
+    model = SimpleNamespace(
+        renderer=renderer,
+        decoder=NeRFMLP({"in_channels": 24, "n_neurons": 16, "n_hidden_layers": 2}),
+    )
+
+    with patch(
+        "tsr.models.nerf_renderer.chunk_batch", wraps=chunk_batch
+    ) as mock_chunk_batch:
+        TSR.render(
+            model,
+            torch.randn(1, 3, 8, 4, 4),
+            2,
+            height=8,
+            width=8,
+            return_type="pt",
+            skip_empty_space=True,
+            chunk_size=37,
+        )
+
+    assert {call[0][1] for call in mock_chunk_batch.call_args_list} == {37}
+    assert renderer.chunk_size == 100
+
+
+class SphereDecoder(torch.nn.Module):
+    """Decodes the coordinates stored in `sphere_triplane` into a sphere."""
+
+    def __init__(self):
+        super().__init__()
+        self.queried = 0
+
+    def forward(self, features):
+        self.queried += len(features)
+        xyz = features[:, [0, 1, 3]]
+        density = 40 * (0.25 - (xyz**2).sum(dim=-1, keepdim=True))
+        return {"density": density, "features": xyz * 4}
+
+
+def sphere_triplane(resolution=32):
+    # Every plane stores its two coordinates, normalized to (-1, 1)
+    axis = (torch.arange(resolution) + 0.5) / resolution * 2 - 1
+    plane = torch.stack(torch.meshgrid(axis, axis, indexing="xy"))
+    return plane[None].repeat(3, 1, 1, 1)
+
+
+def test_empty_space_skipping_matches_dense_render():
+    renderer = TriplaneNeRFRenderer(
+        {
+            "radius": 0.87,
+            "density_activation": "exp",
+            "num_samples_per_ray": 64,
+            "occupancy_grid_resolution": 16,
+        }
+    )
+    model = SimpleNamespace(renderer=renderer, decoder=SphereDecoder())
+    scene_codes = sphere_triplane()[None]
+
+    def render(skip_empty_space):
+        model.decoder.queried = 0
+        images = TSR.render(
+            model,
+            scene_codes,
+            2,
+            height=16,
+            width=16,
+            return_type="pt",
+            skip_empty_space=skip_empty_space,
+        )[0]
+        return torch.stack(images), model.decoder.queried
+
+    dense, dense_queried = render(False)
+    skipped, skipped_queried = render(True)
+
+    # The sphere is in the image, and so is the background
+    assert dense.min() < 0.5 and dense.max() == 1.0
+    assert torch.allclose(skipped, dense, atol=1e-2)
+    # Occupancy grid included
+    assert skipped_queried < dense_queried / 2
+
+
+def test_rays_missing_the_box_render_the_background():
+    renderer = TriplaneNeRFRenderer({"radius": 0.87, "density_activation": "exp"})
+    decoder = SphereDecoder()
+    triplane = sphere_triplane()
+    occupancy_grid = renderer.build_occupancy_grid(decoder, triplane)
+    # Away from the box, then one ray through the sphere among them
+    rays_o = torch.tensor([[0.0, 0.0, 2.0]]).repeat(4, 1)
+    rays_d = torch.tensor([[0.0, 0.0, 1.0]]).repeat(4, 1)
+
+    for grid in (None, occupancy_grid):
+        with torch.no_grad():
+            assert torch.equal(
+                renderer(decoder, triplane, rays_o, rays_d, grid), torch.ones(4, 3)
+            )
+            rays_d[0] = torch.tensor([0.0, 0.0, -1.0])
+            rgb = renderer(decoder, triplane, rays_o, rays_d, grid)
+            rays_d[0] = torch.tensor([0.0, 0.0, 1.0])
+        assert rgb[0].max() < 1.0
+        assert torch.equal(rgb[1:], torch.ones(3, 3))
+
+
+def test_coarse_to_fine_matches_dense_grid_near_surface():
+    helper = MarchingCubeHelper(64)
+    queried = []
+
+    def sphere(points):
+        queried.append(len(points))
+        return 0.3 - (points - 0.5).norm(dim=-1)
+
+    dense = sphere(helper.grid_vertices)
+    values = helper.coarse_to_fine(sphere, (0, 1), stride=4)
+
+    # Same sign everywhere, exact values wherever the surface is
+    assert torch.equal(values > 0, dense > 0)
+    near_surface = dense.abs() < 1.0 / 63
+    assert torch.allclose(values[near_surface], dense[near_surface], atol=1e-6)
+    assert sum(queried[1:]) < queried[0] / 2
+
+
+def test_streaming_marching_cubes_matches_single_volume():
+    helper = MarchingCubeHelper(32)
+    level = ((helper.grid_vertices - 0.5).norm(dim=-1) - 0.3).view(32, 32, 32)
+
+    v_pos, t_pos_idx = helper(level)
+    streamed_v_pos, streamed_t_pos_idx = helper.stream(
+        lambda start, stop: level[start:stop], max_points=5 * 32 * 32
+    )
+
+    # Vertices of the planes shared by two slabs are merged
+    assert len(streamed_v_pos) == len(v_pos)
+    assert len(streamed_t_pos_idx) == len(t_pos_idx)
+    assert torch.allclose(
+        streamed_v_pos[streamed_t_pos_idx].mean(dim=1).sort(dim=0).values,
+        v_pos[t_pos_idx.long()].mean(dim=1).sort(dim=0).values,
+        atol=1e-6,
+    )
+
+
+def test_dense_slabs_match_single_marching_cubes_pass():
+    helper = MarchingCubeHelper(32)
+    radius_range = (-0.87, 0.87)
+
+    def sphere(points):
+        return 0.5 - points.norm(dim=-1)
+
+    v_pos, t_pos_idx = helper(-sphere(helper.scaled_grid_vertices(radius_range)))
+    level = torch.empty(32**3)
+    slabs = list(helper.slab_ranges(max_points=5 * 32 * 32))
+    for start, stop in slabs:
+        level[start * 32**2 : stop * 32**2] = -sphere(
+            helper.plane_vertices(radius_range, start, stop)
+        )
+    slab_v_pos, slab_t_pos_idx = helper(level)
+
+    assert len(slabs) == 7 and slabs[-1] == (30, 32)
+    assert len(v_pos) > 0
+    assert len(slab_v_pos) == len(v_pos)
+    assert len(slab_t_pos_idx) == len(t_pos_idx)
+    assert torch.allclose(slab_v_pos, v_pos)
+
+
+def test_chunk_batch_writes_into_output_buffers():
+    x = torch.arange(10.0)[:, None]
+    buffer = torch.empty(10, 2)
+
+    result = chunk_batch(
+        lambda x: {"double": torch.cat([x, x], dim=-1) * 2, "sum": x.sum(0)},
+        3,
+        x,
+        out_buffers={"double": buffer},
+    )
+
+    assert result["double"] is buffer
+    assert torch.equal(buffer, torch.cat([x, x], dim=-1) * 2)
+    # Outputs that are not row-wise are still concatenated
+    assert result["sum"].shape == (4,)
+
+    # Also without chunking, and `out` is left to `func`
+    buffer = torch.empty(10, 1)
+    result = chunk_batch(
+        lambda x, out: torch.mul(x, 3, out=out),
+        0,
+        x,
+        out=torch.empty(10, 1),
+        out_buffers=buffer,
+    )
+    assert result is buffer
+    assert torch.equal(buffer, x * 3)
+
+
+def test_int8_precision_quantizes_tokenizer_and_backbone():
+    model = torch.nn.Module()
+    model.image_tokenizer = torch.nn.Sequential(torch.nn.Linear(16, 16))
+    model.backbone = torch.nn.Sequential(torch.nn.Linear(16, 16))
+    model.decoder = torch.nn.Sequential(torch.nn.Linear(16, 16))
+    x = torch.randn(4, 16)
+    expected = model.backbone(x)
+
+    apply_precision(model, "int8")
+
+    assert not isinstance(model.image_tokenizer[0], torch.nn.Linear)
+    assert not isinstance(model.backbone[0], torch.nn.Linear)
+    assert isinstance(model.decoder[0], torch.nn.Linear)
+    assert torch.allclose(model.backbone(x), expected, atol=0.1)
+    with pytest.raises(ValueError):
+        apply_precision(model, "fp16")
+
+
+def test_chamfer_distance_of_shifted_mesh():
+    import trimesh
+
+    mesh = trimesh.creation.box()
+    shifted = trimesh.creation.box()
+    shifted.apply_translation([0.5, 0, 0])
+
+    assert chamfer_distance(mesh, mesh, n_points=2000) < 0.05
+    assert chamfer_distance(mesh, shifted, n_points=2000) > 0.1
+
+
+def test_compiled_triplane_query_matches_eager(monkeypatch):
+    # Only the TorchScript path, torch.compile takes too long for a unit test
+    monkeypatch.delattr(torch, "compile", raising=False)
+    renderer = TriplaneNeRFRenderer({"radius": 0.87, "density_activation": "exp"})
+    renderer.set_chunk_size(100)
+    decoder = NeRFMLP({"in_channels": 24, "n_neurons": 16, "n_hidden_layers": 2})
+    triplane = torch.randn(3, 8, 4, 4)
+    positions = torch.rand(250, 3) - 0.5
+
+    with torch.no_grad():
+        expected = renderer.query_triplane(decoder, positions, triplane)
+        backend = renderer.compile_query(decoder, triplane, 100)
+        result = renderer.query_triplane(decoder, positions, triplane)
+
+    assert backend in ("eager", "trace")
+    for k, v in expected.items():
+        assert torch.allclose(result[k], v, atol=1e-6)
+
+
+def test_fused_qkv_projections_match_separate_projections():
+    backbone = Transformer1D(
+        {
+            "in_channels": 32,
+            "num_attention_heads": 2,
+            "attention_head_dim": 16,
+            "num_layers": 2,
+            "cross_attention_dim": 24,
+            "attention_bias": True,
+        }
+    ).eval()
+    hidden_states = torch.randn(2, 32, 12)
+    encoder_hidden_states = torch.randn(2, 5, 24)
+
+    with torch.no_grad():
+        expected = backbone(hidden_states, encoder_hidden_states=encoder_hidden_states)
+        assert backbone.fuse_qkv_projections() == 4
+        result = backbone(hidden_states, encoder_hidden_states=encoder_hidden_states)
+
+    assert torch.allclose(result, expected, atol=1e-5)
+    block = backbone.transformer_blocks[0]
+    assert block.attn1.to_q.weight.data_ptr() == block.attn1.to_qkv.weight.data_ptr()
+    assert hasattr(block.attn2, "to_kv") and not hasattr(block.attn2, "to_qkv")
+    assert isinstance(block.attn2.processor, AttnProcessor2_0)
+
+
+def test_constant_input_matches_full_forward():
+    backbone = Transformer1D(
+        {
+            "in_channels": 32,
+            "num_attention_heads": 2,
+            "attention_head_dim": 16,
+            "num_layers": 2,
+            "cross_attention_dim": 24,
+        }
+    ).eval()
+    tokens = torch.randn(1, 32, 12)
+    encoder_hidden_states = torch.randn(3, 5, 24)
+
+    with torch.no_grad():
+        expected = backbone(
+            tokens.expand(3, -1, -1), encoder_hidden_states=encoder_hidden_states
+        )
+        backbone.precompute_constant_input(tokens)
+        result = backbone.forward_constant_input(
+            3, encoder_hidden_states=encoder_hidden_states
+        )
+
+    assert torch.allclose(result, expected, atol=1e-6)
+
+
+def test_memory_settings_shrink_with_the_budget_per_worker():
+    largest, smallest = MEMORY_TIERS[0][1], MEMORY_TIERS[-1][1]
+
+    assert select_memory_settings(None) == largest
+    assert select_memory_settings(64 * 1024**3, workers=4) == largest
+    assert select_memory_settings(1024**3, workers=4) == smallest
+    medium = select_memory_settings(3 * 1024**3, workers=2)
+    assert smallest.chunk_size < medium.chunk_size < largest.chunk_size
+
+
+def test_memory_settings_do_not_change_backbone_outputs():
+    backbone = Transformer1D(
+        {
+            "in_channels": 32,
+            "num_attention_heads": 4,
+            "attention_head_dim": 8,
+            "num_layers": 2,
+            "cross_attention_dim": 24,
+        }
+    ).eval()
+    hidden_states = torch.randn(2, 32, 13)
+    encoder_hidden_states = torch.randn(2, 5, 24)
+
+    with torch.no_grad():
+        expected = backbone(hidden_states, encoder_hidden_states=encoder_hidden_states)
+        backbone.set_chunk_feed_forward(5)
+        backbone.set_attention_slice(3)
+        result = backbone(hidden_states, encoder_hidden_states=encoder_hidden_states)
+
+    assert torch.allclose(result, expected, atol=1e-5)
+
+
+def test_chunk_tuner_picks_fastest_allowed_size_and_stores_it(tmp_path):
+    renderer = TriplaneNeRFRenderer({"radius": 0.87, "density_activation": "exp"})
+    renderer.set_chunk_size(100)
+    triplane = torch.randn(3, 8, 4, 4)
+    model = SimpleNamespace(
+        renderer=renderer,
+        decoder=NeRFMLP({"in_channels": 24, "n_neurons": 16, "n_hidden_layers": 2}),
+        token_scene_code=lambda: triplane,
+    )
+    tuner = ChunkSizeTuner(str(tmp_path), candidates=(64, 128, 256), n_points=512)
+
+    # The renderer of the running generations is left alone
+    with patch.object(renderer, "set_chunk_size") as set_chunk_size:
+        result = tuner.tune(model, "cpu", max_chunk_size=128)
+    set_chunk_size.assert_not_called()
+
+    # Sizes beyond the memory bound are not run
+    assert set(result["throughput"]) == {64, 128}
+    assert result["chunk_size"] in (64, 128)
+    assert renderer.chunk_size == 100
+    assert len(os.listdir(tmp_path)) == 1
+    # Stored results are reused, with the current bound
+    with patch.object(tuner, "benchmark") as benchmark:
+        reused = tuner.tune(model, "cpu", max_chunk_size=64)
+    benchmark.assert_not_called()
+    assert reused["chunk_size"] == 64
+    assert reused["throughput"] == result["throughput"]
+    # and only the sizes they miss are run
+    with patch.object(tuner, "benchmark", return_value={256: 1e12}) as benchmark:
+        larger = tuner.tune(model, "cpu", max_chunk_size=256)
+    benchmark.assert_called_once_with(model, [256])
+    assert larger["chunk_size"] == 256
+    assert set(larger["throughput"]) == {64, 128, 256}
+
+
+def test_tuning_refused_while_jobs_are_active():
+    queue = JobQueue(lambda job_id, params: params)
+    queue.submit({"image_path": "/data/storage/images/a.png"})
+
+    with patch("model_api.get_job_queue", return_value=queue), patch(
+        "model_api.get_engine"
+    ) as mock_engine:
+        with pytest.raises(HTTPException) as exc_info:
+            tune_chunk_size()
+
+    assert exc_info.value.status_code == 409
+    mock_engine.return_value.tune_chunk_size.assert_not_called()
+
+
+def test_generation_metrics_cover_every_stage():
+    outputs = {
+        **GENERATE_OUTPUTS,
+        "stats": {
+            **GENERATE_OUTPUTS["stats"],
+            "stages_ms": {
+                "Processing images": 10.0,
+                "Running model": 20.0,
+                "Extracting mesh": 40.0,
+                "Baking texture": 50.0,
+                "Exporting mesh and texture": 5.0,
+            },
+        },
+    }
+
+    metrics = generation_metrics(outputs)
+
+    assert metrics["texture_baking_time_ms"] == 50.0
+    assert metrics["mesh_export_time_ms"] == 5.0
+    # Stages that did not run
+    assert metrics["rendering_time_ms"] == 0.0
+    assert metrics["initialization_time_ms"] == 0.0
+    assert metrics["total_time_ms"] == 125.0
+    assert metrics["chunk_size"] == 8192
+    assert metrics["torch_threads"] == 4
+    assert set(metrics) <= set(ModelMetrics.__fields__)
+
+
 if __name__ == "__main__":
     pytest.main([__file__])
@@ -9,6 +9,7 @@ from models import (
     Usage,
     ServiceMetrics,
     ModelMetrics,
+    CacheMetrics,
 )
 
 # Database URL
@@ -3,7 +3,6 @@ from sqlmodel import Session, select
 import httpx
 import os
 import shutil
-from glob import glob
 from models import Image, ModelMetrics
 from services import get_db
 from typing import List
@@ -36,6 +35,32 @@ def log_model_metrics(db: Session, **kwargs):
     return new_metric
 
 
+def publish_outputs(output_dir: str, object_name: str):
+    """
+    Moves the mesh and render of one run from its scratch directory into the
+    objects and renders folders, then deletes the scratch directory.
+    """
+    try:
+        # Check if the 3D object was created
+        generated_object = os.path.join(output_dir, "mesh.glb")
+        if not os.path.exists(generated_object):
+            raise HTTPException(
+                status_code=500,
+                detail="Model generation did not produce expected output files",
+            )
+        # Define the output gif path
+        render_gif = os.path.join(output_dir, "render.gif")
+        object_3d_path = os.path.join(OBJECTS_DIR, f"{object_name}.glb")
+        object_2d_path = os.path.join(RENDERS_DIR, f"{object_name}.gif")
+        logger.debug(f"Paths generated by the model: {object_3d_path, object_2d_path}")
+        # Publish the results with atomic renames
+        os.replace(generated_object, object_3d_path)
+        os.replace(render_gif, object_2d_path)
+    finally:
+        # Delete the intermediate images along with the scratch directory
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+
 async def run_experiment(image_name: str, chunk_size: int, mc_resolution: int):
     async with httpx.AsyncClient(timeout=3600) as client:
         try:
@@ -97,38 +122,15 @@ async def run_experiments(db: Session = Depends(get_db)):
                             log_model_metrics(
                                 db=db,
                                 object_name=object_name,
+                                # Includes the chunk size the run used
                                 **result["metrics"],
-                                chunk_size=chunk_size,
                                 mc_resolution=mc_resolution,
                             )
 
-                            # Check if the 3D object was created
-                            generated_object = os.path.join(OBJECTS_DIR, "mesh.glb")
-                            if not os.path.exists(generated_object):
-                                raise HTTPException(
-                                    status_code=500,
-                                    detail="Model generation did not produce expected output files",
-                                )
-                            # Define the output gif path
-                            render_gif = os.path.join(OBJECTS_DIR, "render.gif")
-                            # Generate unique names for the output files
-                            object_3d_name = (
-                                f"{object_name}_{chunk_size}_{mc_resolution}.glb"
-                            )
-                            object_2d_name = (
-                                f"{object_name}_{chunk_size}_{mc_resolution}.gif"
-                            )
-                            object_3d_path = os.path.join(OBJECTS_DIR, object_3d_name)
-                            object_2d_path = os.path.join(RENDERS_DIR, object_2d_name)
-                            logger.debug(
-                                f"Paths generated by the model: {object_3d_path, object_2d_path}"
+                            publish_outputs(
+                                result["output_dir"],
+                                f"{object_name}_{chunk_size}_{mc_resolution}",
                             )
-                            # Move the results to the appropriate folders and delete intermediate images
-                            shutil.move(generated_object, object_3d_path)
-                            shutil.move(render_gif, object_2d_path)
-                            png_files = glob(os.path.join(OBJECTS_DIR, "*.png"))
-                            for png_file in png_files:
-                                os.remove(png_file)
 
                             logger.info(
                                 f"Experiment completed: {image.image_name}, chunk_size={chunk_size}, mc_resolution={mc_resolution}"
@@ -70,4 +70,4 @@ class ServiceMetrics(SQLModel, table=True):
     endpoint: str
     response_time: float
     status_code: int
-    timestamp: datetime = Field(default_factory=datetime.utcnow)
+    timestamp: datetime = Field(default_factory=datetime.utcnow, index=True)
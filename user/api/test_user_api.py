@@ -1,14 +1,19 @@
 import pytest
+from fastapi import HTTPException
 from fastapi.testclient import TestClient
-from unittest.mock import patch, AsyncMock
-from user_api import app, API_KEY
+from unittest.mock import patch, AsyncMock, MagicMock
+from user_api import app, API_KEY, follow_model_job, result_url
+import asyncio
+import httpx
+import json
 
 client = TestClient(app)
 
 
 @pytest.fixture
 def mock_httpx_client():
-    with patch("user_api.httpx.AsyncClient") as mock:
+    # Requests go through the shared client returned by get_http_client
+    with patch("user_api.get_http_client") as mock:
         yield mock
 
 
@@ -17,9 +22,7 @@ async def test_home(mock_httpx_client):
     pytest.skip("coroutine object")
     mock_response = AsyncMock()
     mock_response.json.return_value = ["category1", "category2"]
-    mock_httpx_client.return_value.__aenter__.return_value.get.return_value = (
-        mock_response
-    )
+    mock_httpx_client.return_value.get.return_value = mock_response
 
     response = client.get("/")
     assert response.status_code == 200
@@ -32,9 +35,7 @@ async def test_choose_category(mock_httpx_client):
     pytest.skip("coroutine object")
     mock_response = AsyncMock()
     mock_response.status_code = 200
-    mock_httpx_client.return_value.__aenter__.return_value.post.return_value = (
-        mock_response
-    )
+    mock_httpx_client.return_value.post.return_value = mock_response
 
     response = client.post(
         "/selected_category", data={"selected_category": "test_category"}
@@ -48,9 +49,7 @@ async def test_images(mock_httpx_client):
     pytest.skip("coroutine object")
     mock_response = AsyncMock()
     mock_response.json.return_value = ["image1.jpg", "image2.jpg"]
-    mock_httpx_client.return_value.__aenter__.return_value.get.return_value = (
-        mock_response
-    )
+    mock_httpx_client.return_value.get.return_value = mock_response
 
     response = client.get("/category/test_category")
     assert response.status_code == 200
@@ -63,9 +62,7 @@ async def test_choose_image(mock_httpx_client):
     pytest.skip("network connectivity")
     mock_response = AsyncMock()
     mock_response.status_code = 200
-    mock_httpx_client.return_value.__aenter__.return_value.put.return_value = (
-        mock_response
-    )
+    mock_httpx_client.return_value.put.return_value = mock_response
 
     response = client.post(
         "/selected_image", data={"selected_image_path": "/path/to/image.jpg"}
@@ -95,12 +92,159 @@ async def test_api_key_usage(mock_httpx_client):
     pytest.skip("coroutine object")
     mock_response = AsyncMock()
     mock_response.json.return_value = ["category1", "category2"]
-    mock_httpx_client.return_value.__aenter__.return_value.get.return_value = (
-        mock_response
-    )
+    mock_httpx_client.return_value.get.return_value = mock_response
 
     await client.get("/")
 
-    mock_httpx_client.return_value.__aenter__.return_value.get.assert_called_with(
+    mock_httpx_client.return_value.get.assert_called_with(
         "http://data-api/categories", headers={"Authorization": f"Bearer {API_KEY}"}
     )
+
+
+def mock_job_events(events):
+    """Client whose job event stream sends `events`, separated by keep-alives."""
+    response = MagicMock(status_code=200)
+
+    async def aiter_lines():
+        for event in events:
+            yield f"data: {json.dumps(event)}"
+            yield ": keep-alive"
+
+    response.aiter_lines = aiter_lines
+    mock_client = MagicMock()
+    mock_client.stream.return_value.__aenter__.return_value = response
+    return mock_client
+
+
+@pytest.mark.asyncio
+async def test_follow_model_job_relays_progress():
+    events = [
+        {"state": "queued", "progress": None},
+        {"state": "running", "progress": {"stage": "render", "percent": 50.0}},
+        {"state": "running", "progress": {"stage": "render", "percent": 50.0}},
+        {"state": "succeeded", "progress": None, "result": {}},
+    ]
+    updates = []
+
+    async def on_update(update):
+        updates.append(update)
+
+    job = await follow_model_job(mock_job_events(events), "job", on_update)
+
+    assert job["state"] == "succeeded"
+    assert updates == [
+        {"state": "queued", "progress": None},
+        {"state": "running", "progress": {"stage": "render", "percent": 50.0}},
+    ]
+
+
+@pytest.mark.asyncio
+async def test_follow_model_job_gives_up_on_stalled_job():
+    events = [
+        {"state": "running", "progress": {"stage": "extract", "percent": 10.0}},
+        {"state": "succeeded", "progress": None, "result": {}},
+    ]
+    with patch("user_api.MODEL_STALL_TIMEOUT", -1):
+        job = await follow_model_job(mock_job_events(events), "job")
+        queued = await follow_model_job(
+            mock_job_events([{"state": "queued", "progress": None}]), "job"
+        )
+
+    assert job["state"] == "running"
+    assert queued["state"] == "queued"
+
+
+@pytest.mark.asyncio
+async def test_follow_model_job_reports_lost_stream_as_failed():
+    mock_client = mock_job_events([])
+    response = mock_client.stream.return_value.__aenter__.return_value
+
+    async def aiter_lines():
+        yield f"data: {json.dumps({'state': 'queued', 'progress': None})}"
+        raise httpx.ReadTimeout("No keep-alive")
+
+    response.aiter_lines = aiter_lines
+    updates = []
+
+    async def on_update(update):
+        updates.append(update)
+
+    job = await follow_model_job(mock_client, "job", on_update)
+
+    assert job["state"] == "failed"
+    assert job["error"] == "Lost the connection to the model service"
+    assert updates == [{"state": "queued", "progress": None}]
+
+
+def test_websocket_reports_failed_state_when_model_api_is_lost(mock_httpx_client):
+    mock_client = mock_httpx_client.return_value
+    mock_client.get = AsyncMock(
+        return_value=MagicMock(
+            status_code=200, json=lambda: {"selected_image_path": "/data/a.png"}
+        )
+    )
+    mock_client.post = AsyncMock(
+        return_value=MagicMock(status_code=202, json=lambda: {"job_id": "job"})
+    )
+    mock_client.stream.side_effect = httpx.ConnectError("Connection refused")
+
+    with client.websocket_connect("/ws") as websocket:
+        assert json.loads(websocket.receive_text()) == {
+            "state": "failed",
+            "progress": None,
+            "error": "Lost the connection to the model service",
+        }
+        message = websocket.receive()
+
+    assert message["type"] == "websocket.close"
+    assert message["reason"] == "Failed to generate model"
+
+
+def test_result_file_is_served_by_content_hash(tmp_path):
+    (tmp_path / "renders").mkdir()
+    (tmp_path / "renders" / "object.gif").write_bytes(b"GIF89a" + bytes(1000))
+    with patch("user_api.RESULT_DIRS", {"renders": str(tmp_path / "renders")}), patch(
+        "user_api.log_response_time"
+    ):
+        url = asyncio.run(result_url(str(tmp_path / "renders" / "object.gif")))
+        response = client.get(url)
+        assert response.status_code == 200
+        assert "immutable" in response.headers["cache-control"]
+        etag = response.headers["etag"]
+
+        assert client.get(url, headers={"If-None-Match": etag}).status_code == 304
+        # Tokens are compared whole, weak validators included
+        for if_none_match, status_code in [
+            (f'"other", W/{etag}', 304),
+            (f'"{etag[1:-1]}0"', 200),
+            (f'"x{etag[1:-1]}"', 200),
+        ]:
+            response = client.get(url, headers={"If-None-Match": if_none_match})
+            assert response.status_code == status_code
+        partial = client.get(url, headers={"Range": "bytes=0-5"})
+        assert partial.status_code == 206
+        assert partial.content == b"GIF89a"
+        # An outdated hash leads to the current one
+        outdated = client.get(
+            "/results/renders/0123/object.gif", follow_redirects=False
+        )
+        assert outdated.status_code == 307
+        assert outdated.headers["location"] == url
+
+
+def test_result_url_outside_result_directories():
+    with pytest.raises(HTTPException) as exc_info:
+        asyncio.run(result_url("/data/storage/images/object.gif"))
+
+    assert exc_info.value.status_code == 500
+
+
+def test_http_client_shared_for_app_lifetime():
+    import user_api
+
+    with patch("user_api.log_response_time"), TestClient(app):
+        shared = user_api.get_http_client()
+        assert user_api.get_http_client() is shared
+        assert not shared.is_closed
+    assert shared.is_closed
+    assert user_api.http_client is None
@@ -1,17 +1,27 @@
 import os
+import asyncio
+import hashlib
 import httpx
 import json
-import base64
-from fastapi import FastAPI, Form, Request, WebSocket, HTTPException
-from fastapi.responses import RedirectResponse, FileResponse
+from fastapi import (
+    FastAPI,
+    Form,
+    Request,
+    WebSocket,
+    WebSocketDisconnect,
+    HTTPException,
+)
+from fastapi.responses import RedirectResponse, FileResponse, Response
 from fastapi.templating import Jinja2Templates
-from typing import List
+from typing import List, Optional
+from functools import lru_cache
+from contextlib import asynccontextmanager
 from fastapi.staticfiles import StaticFiles
 import time
 import logging
 import mimetypes
-from services import get_db
-from sqlmodel import Session
+from services import engine
+from metrics_buffer import MetricsBuffer
 from models import ServiceMetrics
 from datetime import datetime
 
@@ -24,8 +34,55 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+DATA_API_URL = "http://data_api:8000"
+MODEL_API_URL = "http://model_api:8001"
+API_KEY = os.getenv("API_KEY")
+# A running model job whose progress has not changed for this long is given up on
+MODEL_STALL_TIMEOUT = float(os.getenv("MODEL_STALL_TIMEOUT", "300"))  # seconds
+
+# Connections to the data and model APIs, kept alive and shared by every request
+HTTP_LIMITS = httpx.Limits(
+    max_connections=int(os.getenv("HTTP_MAX_CONNECTIONS", "100")),
+    max_keepalive_connections=int(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", "20")),
+    keepalive_expiry=float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "30")),  # seconds
+)
+# Timeouts per upstream, in seconds. The model job stream sends keep-alives every 15s
+DATA_API_TIMEOUT = httpx.Timeout(float(os.getenv("DATA_API_TIMEOUT", "10")))
+MODEL_API_TIMEOUT = httpx.Timeout(float(os.getenv("MODEL_API_TIMEOUT", "60")))
+
+http_client: Optional[httpx.AsyncClient] = None
+
+# Request metrics, kept in memory and written to the database in bulk
+service_metrics = MetricsBuffer(
+    engine,
+    ServiceMetrics,
+    batch_size=int(os.getenv("METRICS_BATCH_SIZE", "500")),
+    flush_interval=float(os.getenv("METRICS_FLUSH_INTERVAL", "2")),  # seconds
+    max_rows=int(os.getenv("METRICS_MAX_ROWS", "10000")),
+)
+
+
+def get_http_client() -> httpx.AsyncClient:
+    global http_client
+    if http_client is None:
+        http_client = httpx.AsyncClient(limits=HTTP_LIMITS, timeout=DATA_API_TIMEOUT)
+    return http_client
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Open the connection pool before serving requests, close it on shutdown
+    global http_client
+    get_http_client()
+    service_metrics.start()
+    yield
+    await http_client.aclose()
+    http_client = None
+    # Write the metrics still buffered
+    service_metrics.stop()
+
+
+app = FastAPI(lifespan=lifespan)
 
 templates = Jinja2Templates(directory="templates")
 
@@ -42,9 +99,44 @@ print(f"Contents of static directory: {os.listdir(static_dir)}")
 app.mount("/static", StaticFiles(directory=static_dir), name="static")
 app.mount("/data", StaticFiles(directory="/data"), name="data")
 
-DATA_API_URL = "http://data_api:8000"
-MODEL_API_URL = "http://model_api:8001"
-API_KEY = os.getenv("API_KEY")
+# Generated files, served under URLs that change with their content
+RESULT_DIRS = {
+    "objects": "/data/storage/objects",
+    "renders": "/data/storage/renders",
+}
+RESULT_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+
+@lru_cache(maxsize=1024)
+def file_digest(path: str, mtime_ns: int, size: int) -> str:
+    # Keyed by modification time and size, a regenerated file is hashed again
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()[:32]
+
+
+async def current_digest(path: str) -> str:
+    stat = os.stat(path)
+    return await asyncio.to_thread(file_digest, path, stat.st_mtime_ns, stat.st_size)
+
+
+async def result_url(path: str) -> str:
+    """URL of a generated object or render, with the hash of its content."""
+    kind = next((k for k, d in RESULT_DIRS.items() if os.path.dirname(path) == d), None)
+    if kind is None:
+        raise HTTPException(status_code=500, detail=f"Not a result file: {path}")
+    digest = await current_digest(path)
+    return f"/results/{kind}/{digest}/{os.path.basename(path)}"
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """Whether an If-None-Match header lists `etag`, compared weakly (RFC 9110)."""
+    tokens = [token.strip() for token in if_none_match.split(",")]
+    return "*" in tokens or any(
+        token.removeprefix("W/") == etag.removeprefix("W/") for token in tokens
+    )
 
 
 # Handle Websocket connection issues
@@ -67,16 +159,65 @@ def get_api_headers():
     return {"Authorization": f"Bearer {API_KEY}"}
 
 
+# Follow the server-sent events of a model job until it has finished, passing every
+# change of its state or progress to `on_update`. A job stalled while queued or
+# running is returned unfinished, and a lost event stream as a failed job
+async def follow_model_job(client, job_id, on_update=None):
+    job, last_update = None, None
+    last_change = time.monotonic()
+    try:
+        async with client.stream(
+            "GET",
+            f"{MODEL_API_URL}/jobs/{job_id}/events",
+            headers=get_api_headers(),
+            timeout=MODEL_API_TIMEOUT,
+        ) as response:
+            if response.status_code != 200:
+                return None
+            # Keep-alive comments arrive in between, so stalls are noticed without events
+            async for line in response.aiter_lines():
+                if line.startswith("data: "):
+                    job = json.loads(line[len("data: ") :])
+                    logger.debug(
+                        f"Model job {job_id}: {job['state']} {job['progress']}"
+                    )
+                    if job["state"] in ("succeeded", "failed"):
+                        return job
+                    update = {"state": job["state"], "progress": job["progress"]}
+                    if update != last_update:
+                        last_update = update
+                        last_change = time.monotonic()
+                        if on_update is not None:
+                            await on_update(update)
+                if (
+                    job is not None
+                    and job["state"] in ("queued", "running")
+                    and time.monotonic() - last_change > MODEL_STALL_TIMEOUT
+                ):
+                    logger.error(
+                        f"Model job {job_id} stalled {job['state']}: {job['progress']}"
+                    )
+                    return job
+    except httpx.HTTPError as e:
+        # Timeouts included, e.g. no keep-alive within MODEL_API_TIMEOUT
+        logger.error(f"Lost the events of model job {job_id}: {e!r}")
+        return {
+            "job_id": job_id,
+            "state": "failed",
+            "progress": None,
+            "error": "Lost the connection to the model service",
+        }
+    return None
+
+
 @app.get("/")
 async def home(request: Request):
     """
     Renders the home page template with the list of image categories.
     """
-    async with httpx.AsyncClient() as client:
-        response = await client.get(
-            f"{DATA_API_URL}/categories", headers=get_api_headers()
-        )
-        categories = response.json()
+    client = get_http_client()
+    response = await client.get(f"{DATA_API_URL}/categories", headers=get_api_headers())
+    categories = response.json()
     return templates.TemplateResponse(
         "home.html", {"request": request, "categories": categories}
     )
@@ -95,33 +236,33 @@ async def choose_category(request: Request, selected_category: str = Form(...)):
             status_code=422, detail="Please select at least one category."
         )
     selection_time = datetime.now().isoformat()
-    async with httpx.AsyncClient() as client:
-        response = await client.post(
-            f"{DATA_API_URL}/usages",
-            json={
-                "selected_category": selected_category,
-                "selection_time": selection_time,
-            },
-            headers=get_api_headers(),
-        )
-        if response.status_code != 200:
-            raise HTTPException(status_code=500, detail="Failed to create usage")
-        logger.debug(f"Selection time: {selection_time}")
-        logger.debug(f"Selected category: {selected_category}")
+    client = get_http_client()
+    response = await client.post(
+        f"{DATA_API_URL}/usages",
+        json={
+            "selected_category": selected_category,
+            "selection_time": selection_time,
+        },
+        headers=get_api_headers(),
+    )
+    if response.status_code != 200:
+        raise HTTPException(status_code=500, detail="Failed to create usage")
+    logger.debug(f"Selection time: {selection_time}")
+    logger.debug(f"Selected category: {selected_category}")
     return RedirectResponse(url=f"/category/{selected_category}", status_code=303)
 
 
 @app.get("/category/{category}")
 async def images(request: Request, category: str, page: int = 1):
     page_size = 9  # Number of images per page
-    async with httpx.AsyncClient() as client:
-        response = await client.get(
-            f"{DATA_API_URL}/images/{category}?page={page}&page_size={page_size}",
-            headers=get_api_headers(),
-        )
-        response.raise_for_status()
-        image_paths = response.json()
-        logger.debug(f"image paths: {image_paths}")
+    client = get_http_client()
+    response = await client.get(
+        f"{DATA_API_URL}/images/{category}?page={page}&page_size={page_size}",
+        headers=get_api_headers(),
+    )
+    response.raise_for_status()
+    image_paths = response.json()
+    logger.debug(f"image paths: {image_paths}")
     return templates.TemplateResponse(
         "images.html",
         {
@@ -136,12 +277,12 @@ async def images(request: Request, category: str, page: int = 1):
 @app.get("/category/load_more/{category}/{page}")
 async def load_more(category: str, page: int):
     page_size = 9
-    async with httpx.AsyncClient() as client:
-        response = await client.get(
-            f"{DATA_API_URL}/images/{category}?page={page}&page_size={page_size}",
-            headers=get_api_headers(),
-        )
-        image_paths = response.json()
+    client = get_http_client()
+    response = await client.get(
+        f"{DATA_API_URL}/images/{category}?page={page}&page_size={page_size}",
+        headers=get_api_headers(),
+    )
+    image_paths = response.json()
     return {"images": image_paths}
 
 
@@ -155,14 +296,14 @@ async def choose_image(request: Request, selected_image_path: str = Form(...)):
     - Renders the "result.html" template with the model's response data.
     """
     logger.debug(f"Selected image path: {selected_image_path}")
-    async with httpx.AsyncClient() as client:
-        response = await client.put(
-            f"{DATA_API_URL}/usages/latest",
-            json={"selected_image_path": selected_image_path},
-            headers=get_api_headers(),
-        )
-        if response.status_code != 200:
-            raise HTTPException(status_code=500, detail="Failed to update usage")
+    client = get_http_client()
+    response = await client.put(
+        f"{DATA_API_URL}/usages/latest",
+        json={"selected_image_path": selected_image_path},
+        headers=get_api_headers(),
+    )
+    if response.status_code != 200:
+        raise HTTPException(status_code=500, detail="Failed to update usage")
     return RedirectResponse(url="/generate_object", status_code=303)
 
 
@@ -174,46 +315,101 @@ async def generate_object_page(request: Request):
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
     await websocket.accept()
-    # Set 1 hour timeout
-    async with httpx.AsyncClient(timeout=httpx.Timeout(timeout=3600)) as client:
-        response = await client.get(
-            f"{DATA_API_URL}/usages/latest", headers=get_api_headers()
-        )
-        if response.status_code != 200:
-            await websocket.close(code=1000, reason="Failed to get latest usage")
-            return
-        latest_usage = response.json()
-        image_path = latest_usage.get("selected_image_path")
-        logger.debug(f"3D image path: {image_path}")
-        response = await client.post(
-            f"{MODEL_API_URL}/generate",
-            json={"image_path": image_path},
-            headers=get_api_headers(),
-        )
-        if response.status_code != 200:
-            await websocket.close(code=1000, reason="Failed to generate model")
-            return
-        model_data = response.json()
-        logger.debug(f"model data: {model_data}")
-        response = await client.put(
-            f"{DATA_API_URL}/usages/latest",
-            json={
-                "object_3d": model_data["object_3d"],
-                "object_2d": model_data["object_2d"],
-            },
-            headers=get_api_headers(),
+    client = get_http_client()
+    response = await client.get(
+        f"{DATA_API_URL}/usages/latest", headers=get_api_headers()
+    )
+    if response.status_code != 200:
+        await websocket.close(code=1000, reason="Failed to get latest usage")
+        return
+    latest_usage = response.json()
+    image_path = latest_usage.get("selected_image_path")
+    logger.debug(f"3D image path: {image_path}")
+    response = await client.post(
+        f"{MODEL_API_URL}/jobs",
+        json={"image_path": image_path},
+        headers=get_api_headers(),
+        timeout=MODEL_API_TIMEOUT,
+    )
+    if response.status_code == 429:
+        await websocket.close(code=1013, reason="Model service busy")
+        return
+    if response.status_code != 202:
+        await websocket.close(code=1000, reason="Failed to generate model")
+        return
+
+    # Relay the stages of the generation to the browser as they progress
+    async def send_update(update):
+        await websocket.send_text(json.dumps(update))
+
+    try:
+        job = await follow_model_job(client, response.json()["job_id"], send_update)
+    except WebSocketDisconnect:
+        logger.debug("Client left before the model job finished")
+        return
+    if job is not None and job["state"] in ("queued", "running"):
+        stalled = "queue" if job["state"] == "queued" else "worker"
+        await websocket.close(code=1011, reason=f"Model {stalled} stalled")
+        return
+    if job is None or job["state"] != "succeeded":
+        error = (job or {}).get("error") or "Failed to generate model"
+        await websocket.send_text(
+            json.dumps({"state": "failed", "progress": None, "error": error})
         )
-        if response.status_code != 200:
-            await websocket.close(code=1000, reason="Failed to update usage")
-            return
+        await websocket.close(code=1000, reason="Failed to generate model")
+        return
+    model_data = job["result"]
+    logger.debug(f"model data: {model_data}")
+    response = await client.put(
+        f"{DATA_API_URL}/usages/latest",
+        json={
+            "object_3d": model_data["object_3d"],
+            "object_2d": model_data["object_2d"],
+        },
+        headers=get_api_headers(),
+    )
+    if response.status_code != 200:
+        await websocket.close(code=1000, reason="Failed to update usage")
+        return
+
+    # Links rather than file contents, the browser fetches and caches them
+    await send_with_retries(
+        websocket,
+        json.dumps(
+            {
+                "render_url": await result_url(model_data["object_2d"]),
+                "object_url": await result_url(model_data["object_3d"]),
+                "object_path": model_data["object_3d"],
+            }
+        ),
+    )
 
-        with open(model_data["object_2d"], "rb") as image_file:
-            render_data = base64.b64encode(image_file.read()).decode("utf-8")
-            await send_with_retries(websocket, json.dumps({"render": render_data}))
 
-        await send_with_retries(
-            websocket, json.dumps({"object_path": model_data["object_3d"]})
+@app.get("/results/{kind}/{digest}/{name}")
+async def get_result_file(request: Request, kind: str, digest: str, name: str):
+    """
+    Serves a generated object or render by the hash of its content. The URL
+    changes whenever the file does, so responses are cached for a year with
+    the hash as a strong ETag; range and conditional requests are supported.
+    Outdated hashes are redirected to the current URL.
+    """
+    if kind not in RESULT_DIRS or name != os.path.basename(name):
+        raise HTTPException(status_code=404, detail="File not found")
+    path = os.path.join(RESULT_DIRS[kind], name)
+    if not os.path.isfile(path):
+        raise HTTPException(status_code=404, detail="File not found")
+    current = await current_digest(path)
+    if digest != current:
+        return RedirectResponse(
+            f"/results/{kind}/{current}/{name}",
+            status_code=307,
+            headers={"Cache-Control": "no-cache"},
         )
+    headers = {"ETag": f'"{digest}"', "Cache-Control": RESULT_CACHE_CONTROL}
+    if etag_matches(request.headers.get("if-none-match", ""), headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+    # Range and If-Range requests are handled by FileResponse
+    return FileResponse(path, headers=headers)
 
 
 @app.get("/download")
@@ -229,23 +425,19 @@ async def download_file(file: str):
 
 # Log the metrics that will be sent to Grafana via the postgreSQL database
 def log_response_time(
-    db: Session,
     service_name: str,
     endpoint: str,
     response_time: float,
     status_code: int,
 ):
-    new_metric = ServiceMetrics(
+    # Buffered, the rows are inserted in bulk by the writer thread
+    service_metrics.add(
         service_name=service_name,
         endpoint=endpoint,
         response_time=response_time,
         status_code=status_code,
         timestamp=datetime.utcnow(),
     )
-    db.add(new_metric)
-    db.commit()
-    db.refresh(new_metric)
-    return new_metric
 
 
 @app.middleware("http")
@@ -254,17 +446,11 @@ async def log_requests(request: Request, call_next):
     response = await call_next(request)
     response_time = (time.time() - start_time) * 1000  # Convert to milliseconds
 
-    # Use a new database session for logging
-    db = next(get_db())
-    try:
-        log_response_time(
-            db=db,
-            service_name="model_api",
-            endpoint=request.url.path,
-            response_time=response_time,
-            status_code=response.status_code,
-        )
-    finally:
-        db.close()  # Ensure the database session is closed
+    log_response_time(
+        service_name="model_api",
+        endpoint=request.url.path,
+        response_time=response_time,
+        status_code=response.status_code,
+    )
 
     return response